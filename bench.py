@@ -0,0 +1,390 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+建设工程质量安全检查助手 - 吞吐基准测试
+在本机启动一个模拟的 OpenAI 兼容 chat/completions 服务 (可配置延迟分布、5xx/429 注入、
+流式输出、分诊/专家/合并的固定 JSON 及格式错误输出)，用合成图片驱动完整分析流水线，
+报告 张/分钟、单张 P50/P95 耗时、内存峰值与上传字节数。不消耗 API 额度，结果可复现。
+另在子进程中测量冷启动导入耗时，并检查界面启动时未导入模型客户端 (openai)。
+
+用法：
+    python bench.py                                   # 全部场景 × 默认图片集
+    python bench.py --scenario staged,flaky --images 20 --sizes 1280x960
+    python bench.py --quick --repeat 3 --json bench.json --baseline bench_baseline.json
+"""
+
+import argparse, contextlib, json, math, os, random, re, subprocess, sys, tempfile, threading, time, tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image
+
+from engine import (
+    InspectionEngine, build_run, new_task, get_limiter, fmt_bytes, parse_router, parse_issues, parse_combined, build_ai_prompt,
+    METRICS, IMAGE_TOKENS, REGULATION_DB, RISK_LEVELS, ROUTER_PROMPT, warm_client,
+)
+
+# 场景：server 为模拟服务参数，run 覆盖分析批次参数
+SCENARIOS = {
+    "staged":   {"server": {"latency": 0.4}, "run": {"mode": "staged", "streaming": False}},
+    "combined": {"server": {"latency": 0.8}, "run": {"mode": "combined", "streaming": False}},
+    "stream":   {"server": {"latency": 0.4}, "run": {"mode": "staged", "streaming": True}},
+    "structured": {"server": {"latency": 0.4}, "run": {"mode": "staged", "streaming": False, "structured": True, "response_format": "json_schema"}},
+    # 模拟服务拒绝 response_format (400)：验证回退到紧凑行格式
+    "compact":  {"server": {"latency": 0.4, "response_format": False}, "run": {"mode": "staged", "streaming": True, "structured": True, "response_format": "json_object"}},
+    # 主服务大量 5xx：连续失败后熔断，流量切到备用服务
+    "failover": {"server": {"latency": 0.4, "error_rate": 0.6}, "backup": {"latency": 0.4},
+                 "run": {"mode": "staged", "streaming": False}},
+    # 主服务长尾延迟：超过其 P95 时向备用服务对冲
+    "hedge":    {"server": {"latency": 0.4, "sigma": 1.0}, "backup": {"latency": 0.4, "sigma": 0.2},
+                 "run": {"mode": "staged", "streaming": False, "hedge": True, "hedge_min_delay": 0.2}},
+    "flaky":    {"server": {"latency": 0.4, "error_rate": 0.05, "rate_limit_rate": 0.05, "malformed_rate": 0.1},
+                 "run": {"mode": "staged", "streaming": False}},
+    # 同一专家跨图片合并为多图调用；batchsplit 固定截断前两次多图输出，验证拆分重试
+    "batched":  {"server": {"latency": 0.4}, "run": {"mode": "staged", "streaming": False, "batch_images": 4}},
+    "batchsplit": {"server": {"latency": 0.4, "batch_faults": 2}, "run": {"mode": "staged", "streaming": False, "batch_images": 4}},
+}
+DEFAULT_SIZES = "1280x960,4032x3024"
+
+# ==================== 模拟服务 ====================
+def canned_issues(role, rng):
+    levels = ["严重安全隐患", "一般安全隐患", "严重质量缺陷", "一般质量缺陷"]
+    return [{"category": role, "risk_level": rng.choice(levels), "issue": f"【{role}】模拟问题 {i + 1}：作业面防护不到位",
+             "regulation": "JGJ 59-2011 第3.2条", "correction": "立即整改并复查", "confidence": round(rng.uniform(0.6, 0.95), 2)}
+            for i in range(rng.randint(1, 3))]
+
+def malform(text, rng):
+    """格式错误输出：前后夹杂说明文字 / 中途截断 / 完全不是 JSON"""
+    kind = rng.choice(("prose", "truncated", "garbage"))
+    if kind == "prose": return f"根据图片分析结果如下：\n```json\n{text}\n```\n以上供参考。"
+    if kind == "truncated": return text[:max(1, int(len(text) * rng.uniform(0.3, 0.9)))]
+    return "抱歉，我无法判断图片中的施工内容。"
+
+class MockServer:
+    """模拟的 OpenAI 兼容服务。按系统提示词区分分诊/专家/合并请求，返回固定结构的 JSON。
+    latency 为对数正态分布的中位数 (秒)，sigma 为其离散度；流式时首个分片在 ttfb 比例处发出。
+    batch_faults：前 N 次多图专家调用的输出从中间截断 (finish_reason=length)，确定性地触发拆分重试"""
+    def __init__(self, latency=0.4, sigma=0.35, ttfb=0.3, error_rate=0.0, rate_limit_rate=0.0, retry_after=0.2,
+                 malformed_rate=0.0, response_format=True, image_cost=0.3, batch_faults=0, seed=0):
+        self.latency, self.sigma, self.ttfb = latency, sigma, ttfb
+        self.image_cost = image_cost                # 多图请求每多一张图片，延迟增加的比例
+        self.error_rate, self.rate_limit_rate, self.retry_after, self.malformed_rate = error_rate, rate_limit_rate, retry_after, malformed_rate
+        self.response_format = response_format     # False 时以 400 拒绝带 response_format 的请求
+        self.batch_faults = batch_faults
+        self.rng, self._lock = random.Random(seed), threading.Lock()
+        self.stats = {"requests": 0, "bytes_in": 0, "errors": 0, "rate_limited": 0, "malformed": 0}
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # 保持 keep-alive，与真实服务一致
+            def log_message(self, *args): pass
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                server.handle(self, json.loads(body), len(body))
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}/v1"
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def draw(self):
+        """抽取本次请求的 (耗时, 故障类型, 是否格式错误, 随机源)"""
+        with self._lock:
+            delay = self.latency * math.exp(self.rng.gauss(0, self.sigma))
+            r = self.rng.random()
+            fault = "error" if r < self.error_rate else "429" if r < self.error_rate + self.rate_limit_rate else None
+            return delay, fault, self.rng.random() < self.malformed_rate, random.Random(self.rng.random())
+
+    def count(self, **kw):
+        with self._lock:
+            for k, v in kw.items(): self.stats[k] += v
+
+    def reply(self, req, rng):
+        """按请求的输出格式作答：原 JSON 数组 / response_format 的 JSON 对象 / 紧凑行格式"""
+        system = next((m["content"] for m in req["messages"] if m["role"] == "system"), "")
+        if system == ROUTER_PROMPT:
+            return json.dumps({"scene": "塔吊吊运钢筋，楼层临边作业", "roles": ["安全"] + rng.sample(["机械", "电气", "结构", "管道"], rng.randint(1, 3))}, ensure_ascii=False)
+        compact = "紧凑行格式" in system
+        def lines(issues, with_category):
+            return "\n".join(("{}|".format(i["category"]) if with_category else "") + f"{RISK_LEVELS.index(i['risk_level']) + 1}|{i['issue']}|{i['regulation']}|{i['correction']}|{i['confidence']}"
+                             for i in issues) or "无"
+        m = re.match(r"你是【(.+?)】", system)
+        if m:
+            n = re.search(r"本次共 (\d+) 张", system)
+            if n:   # 多图调用：每个问题带图号
+                issues = [dict(i, image=k) for k in range(1, int(n.group(1)) + 1) for i in canned_issues(m.group(1), rng)]
+                if compact: return "\n".join(f"{i['image']}|{line}" for i, line in zip(issues, lines(issues, False).split("\n"))) or "无"
+            else: issues = canned_issues(m.group(1), rng)
+            if compact: return lines(issues, False)
+            if req.get("response_format"): return json.dumps({"issues": issues}, ensure_ascii=False)
+            return json.dumps(issues, ensure_ascii=False)
+        roles = ["安全"] + rng.sample(["机械", "电气", "结构", "管道"], rng.randint(1, 3))
+        issues = [i for r in roles for i in canned_issues(r, rng)]
+        if compact: return f"专家:{','.join(roles)}\n" + lines(issues, True)
+        return json.dumps({"roles": roles, "issues": issues}, ensure_ascii=False)
+
+    def handle(self, h, req, n_bytes):
+        delay, fault, malformed, rng = self.draw()
+        self.count(requests=1, bytes_in=n_bytes)
+        if req.get("response_format") and not self.response_format: fault = "400"
+        if fault:
+            time.sleep(delay * 0.2)
+            status = {"429": 429, "400": 400}.get(fault, 500)
+            self.count(**{"rate_limited" if status == 429 else "errors": 1})
+            payload = json.dumps({"error": {"message": "mock fault", "type": "rate_limit" if status == 429 else "server_error"}}).encode()
+            h.send_response(status)
+            if status == 429: h.send_header("Retry-After", str(self.retry_after))
+            h.send_header("Content-Type", "application/json")
+            h.send_header("Content-Length", str(len(payload)))
+            h.end_headers()
+            h.wfile.write(payload)
+            return
+
+        text, finish_reason = self.reply(req, rng), "stop"
+        n_images = sum(1 for m in req["messages"] if isinstance(m["content"], list) for p in m["content"] if p.get("type") == "image_url")
+        with self._lock:
+            truncate = n_images > 1 and self.batch_faults > 0
+            if truncate: self.batch_faults -= 1
+        if truncate:
+            text, finish_reason = text[:len(text) // 2], "length"
+            self.count(malformed=1)
+        elif malformed:
+            text = malform(text, rng)
+            self.count(malformed=1)
+        delay *= 1 + self.image_cost * max(0, n_images - 1)
+        usage = {"prompt_tokens": n_images * IMAGE_TOKENS + sum(len(json.dumps(m["content"], ensure_ascii=False)) // 2 for m in req["messages"] if not isinstance(m["content"], list)),
+                 "completion_tokens": len(text) // 2}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        base = {"id": "chatcmpl-mock", "created": int(time.time()), "model": req.get("model", "mock")}
+
+        if not req.get("stream"):
+            time.sleep(delay)
+            payload = json.dumps({**base, "object": "chat.completion", "usage": usage,
+                                  "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": finish_reason}]}, ensure_ascii=False).encode()
+            h.send_response(200)
+            h.send_header("Content-Type", "application/json")
+            h.send_header("Content-Length", str(len(payload)))
+            h.end_headers()
+            h.wfile.write(payload)
+            return
+
+        time.sleep(delay * self.ttfb)
+        h.send_response(200)
+        h.send_header("Content-Type", "text/event-stream")
+        h.send_header("Transfer-Encoding", "chunked")
+        h.end_headers()
+        def send(obj):
+            data = f"data: {obj if isinstance(obj, str) else json.dumps(obj, ensure_ascii=False)}\n\n".encode()
+            h.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            h.wfile.flush()
+        pieces = [text[i:i + 24] for i in range(0, len(text), 24)] or [""]
+        for piece in pieces:
+            send({**base, "object": "chat.completion.chunk", "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]})
+            time.sleep(delay * (1 - self.ttfb) / len(pieces))
+        send({**base, "object": "chat.completion.chunk", "choices": [{"index": 0, "delta": {}, "finish_reason": finish_reason}]})
+        send({**base, "object": "chat.completion.chunk", "choices": [], "usage": usage})
+        send("[DONE]")
+        h.wfile.write(b"0\r\n\r\n")
+
+# ==================== 合成图片 ====================
+def make_images(folder, count, size, seed=0):
+    """生成类照片的合成图 (低频噪声放大 + 细节噪声)，JPEG 体积接近真实现场照片"""
+    w, h = size
+    paths = []
+    for i in range(count):
+        rng = random.Random(seed * 1000 + i)
+        base = Image.effect_noise((max(8, w // 32), max(8, h // 32)), 60).convert("RGB").resize((w, h), Image.BILINEAR)
+        detail = Image.effect_noise((w, h), 12 + rng.randint(0, 8)).convert("RGB")
+        img = Image.blend(base, detail, 0.25)
+        path = os.path.join(folder, f"bench_{w}x{h}_{i:03d}.jpg")
+        img.save(path, quality=90)
+        paths.append(path)
+    return paths
+
+# ==================== 执行与统计 ====================
+def percentile(values, q):
+    if not values: return 0.0
+    values = sorted(values)
+    return values[max(0, math.ceil(q * len(values)) - 1)]
+
+def run_scenario(name, scenario, images, workers, seed, tag=""):
+    """在全新的工作目录 (空结果缓存) 中分析一组图片，返回统计结果；tag 区分重复运行的厂商名 (健康/限流状态互不影响)"""
+    cwd, work = os.getcwd(), tempfile.mkdtemp(prefix="bench_")
+    os.chdir(work)
+    METRICS.clear()
+    done, finished, lock = [], threading.Event(), threading.Lock()
+    def on_done(task):
+        with lock:
+            done.append(task)
+            if len(done) == len(images): finished.set()
+    def backend(provider, srv):
+        return {"provider": provider, "base_url": srv.url, "api_key": "mock", "model": "mock-vl", "response_format": scenario["run"].get("response_format"),
+                "limiter": get_limiter(provider, 100000, 10 ** 9)}
+    backup = None
+    try:
+        with contextlib.ExitStack() as stack:
+            server = stack.enter_context(MockServer(seed=seed, **scenario["server"]))
+            run = build_run({"api_key": "mock"})
+            run.update(backend(f"mock-{name}{tag}", server), **scenario["run"])
+            if "backup" in scenario:
+                backup = stack.enter_context(MockServer(seed=seed + 1, **scenario["backup"]))
+                run["backends"] = [backend(f"mock-{name}{tag}", server), backend(f"mock-{name}{tag}-backup", backup)]
+            engine = InspectionEngine(workers, on_done=on_done)
+            tracemalloc.start()
+            t0 = time.monotonic()
+            for path in images: engine.submit(new_task(path), run)
+            finished.wait()
+            wall = time.monotonic() - t0
+            mem_peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+    finally:
+        os.chdir(cwd)
+
+    ok = [t for t in done if t['status'] == 'done']
+    lat = [t['metrics']['latency'] for t in ok]
+    calls = list(METRICS.calls)
+    return {
+        "scenario": name, "images": len(images), "ok": len(ok), "failed": len(images) - len(ok),
+        "wall": wall, "images_per_min": len(ok) / wall * 60 if wall else 0.0,
+        "p50": percentile(lat, 0.5), "p95": percentile(lat, 0.95),
+        "calls": len(calls), "retries": sum(c.get("retries", 0) for c in calls),
+        "parse_fail": sum(1 for c in calls if c.get("parse_ok") is False),
+        "payload_bytes": sum(c.get("upload_bytes", 0) for c in calls), "server_bytes_in": server.stats["bytes_in"],
+        "hedged": sum(1 for c in calls if c.get("hedged")), "failover": sum(c.get("failover", 0) for c in calls),
+        "backup_requests": backup.stats["requests"] if backup else 0,
+        "injected_faults": server.stats["errors"] + server.stats["rate_limited"], "injected_malformed": server.stats["malformed"],
+        "mem_peak": mem_peak, "issues": sum(len(t.get('data') or []) for t in ok),
+    }
+
+def bench_parsers(n=2000):
+    """解析/提示词函数的微基准，返回 {名称: 微秒/次}"""
+    rng = random.Random(0)
+    expert = json.dumps(canned_issues("安全", rng), ensure_ascii=False)
+    cases = {
+        "parse_router": lambda: parse_router('{"scene": "塔吊吊运钢筋", "roles": ["机械","安全","管道"]}'),
+        "parse_issues": lambda: parse_issues(expert, "安全"),
+        "parse_issues(fenced)": lambda: parse_issues(f"结果如下：```json\n{expert}\n```", "安全"),
+        "parse_issues(truncated)": lambda: parse_issues(expert[:len(expert) * 2 // 3], "安全"),
+        "parse_combined": lambda: parse_combined(json.dumps({"roles": ["安全"], "issues": json.loads(expert)}, ensure_ascii=False)),
+        "build_ai_prompt": lambda: build_ai_prompt("安全", REGULATION_DB["安全"]),
+    }
+    out = {}
+    for label, fn in cases.items():
+        t0 = time.perf_counter()
+        for _ in range(n): fn()
+        out[label] = (time.perf_counter() - t0) / n * 1e6
+    return out
+
+STARTUP_PROBE = """import sys, time
+t = time.perf_counter()
+import {module}
+print(time.perf_counter() - t, "openai" in sys.modules)"""
+
+def bench_startup(repeat=3):
+    """冷启动导入耗时 (毫秒，取最小值)；main 需要 flet，未安装时跳过"""
+    out = {}
+    for module in ("engine", "main"):
+        runs = []
+        for _ in range(repeat):
+            p = subprocess.run([sys.executable, "-c", STARTUP_PROBE.format(module=module)], capture_output=True, text=True,
+                               cwd=os.path.dirname(os.path.abspath(__file__)))
+            if p.returncode: break
+            secs, openai_loaded = p.stdout.split()
+            runs.append(float(secs) * 1000)
+        if runs: out[module] = {"import_ms": min(runs), "openai_loaded": openai_loaded == "True"}
+    return out
+
+def best_of(runs):
+    """重复运行取最好的一次：吞吐取最大、P95 取最小，其余字段取吞吐最好的那次；降低共享 runner 上的抖动"""
+    best = dict(max(runs, key=lambda r: r["images_per_min"]))
+    best["p95"] = min(r["p95"] for r in runs)
+    best["repeat"] = len(runs)
+    return best
+
+def compare(results, baseline, tolerance, startup=None):
+    """与基线比较：吞吐下降或 P95 上升超过容差即视为回归，返回问题描述列表"""
+    base = {(r["scenario"], r["size"]): r for r in baseline.get("results", [])}
+    problems = []
+    for r in results:
+        b = base.get((r["scenario"], r["size"]))
+        if not b: continue
+        if r["images_per_min"] < b["images_per_min"] * (1 - tolerance):
+            problems.append(f"{r['scenario']} {r['size']}: 吞吐 {r['images_per_min']:.1f} < 基线 {b['images_per_min']:.1f} 张/分钟")
+        if r["p95"] > b["p95"] * (1 + tolerance):
+            problems.append(f"{r['scenario']} {r['size']}: P95 {r['p95']:.2f}s > 基线 {b['p95']:.2f}s")
+    for module, s in (startup or {}).items():
+        b = baseline.get("startup", {}).get(module)
+        if b and s["import_ms"] > b["import_ms"] * (1 + tolerance):
+            problems.append(f"import {module}: {s['import_ms']:.0f}ms > 基线 {b['import_ms']:.0f}ms")
+    return problems
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="使用本地模拟服务测量分析流水线吞吐 (不消耗 API 额度)")
+    ap.add_argument("--scenario", default=",".join(SCENARIOS), help=f"逗号分隔的场景 (可选 {', '.join(SCENARIOS)})")
+    ap.add_argument("--images", type=int, default=12, help="每组图片数量 (默认 12)")
+    ap.add_argument("--sizes", default=DEFAULT_SIZES, help=f"逗号分隔的图片尺寸 (默认 {DEFAULT_SIZES})")
+    ap.add_argument("-j", "--workers", type=int, default=3, help="同时分析的图片数 (默认 3)")
+    ap.add_argument("--latency", type=float, help="覆盖模拟服务延迟中位数 (秒)")
+    ap.add_argument("--seed", type=int, default=0, help="随机种子 (默认 0)")
+    ap.add_argument("--quick", action="store_true", help="CI 快速模式：6 张 1280x960，延迟缩短为 1/4")
+    ap.add_argument("--json", help="结果写入 JSON 文件")
+    ap.add_argument("--baseline", help="与基线 JSON 比较，出现回归时返回 1")
+    ap.add_argument("--tolerance", type=float, default=0.25, help="回归判定容差 (默认 0.25)")
+    ap.add_argument("--repeat", type=int, default=1, help="每个场景重复次数，取最好的一次 (默认 1)")
+    args = ap.parse_args(argv)
+
+    names = [n.strip() for n in args.scenario.split(",") if n.strip()]
+    unknown = [n for n in names if n not in SCENARIOS]
+    if unknown: ap.error(f"未知场景：{', '.join(unknown)}")
+    count, sizes, scale = args.images, args.sizes, 1.0
+    if args.quick: count, sizes, scale = 6, "1280x960", 0.25
+    try: sizes = [tuple(int(v) for v in s.lower().split("x")) for s in sizes.split(",")]
+    except ValueError: ap.error("--sizes 格式应为 宽x高，如 1280x960")
+
+    warm_client()   # 客户端库按需导入，先导入以免计入首个场景
+    results = []
+    with tempfile.TemporaryDirectory(prefix="bench_img_") as folder:
+        for w, h in sizes:
+            images = make_images(folder, count, (w, h), args.seed)
+            for name in names:
+                sc = json.loads(json.dumps(SCENARIOS[name]))
+                sc["server"]["latency"] = (args.latency or sc["server"]["latency"]) * scale
+                r = best_of([run_scenario(name, sc, images, args.workers, args.seed, f"-{i}" if i else "") for i in range(max(1, args.repeat))])
+                r["size"] = f"{w}x{h}"
+                results.append(r)
+                print(f"{name:<11}{r['size']:>10}{r['images']:>5}{r['images_per_min']:>9.1f} 张/分{r['p50']:>7.2f}s{r['p95']:>7.2f}s"
+                      f"{r['calls']:>6} 次{r['retries']:>4} 重试{r['parse_fail']:>3} 解析失败{r['failed']:>3} 失败"
+                      f"  上传 {fmt_bytes(r['payload_bytes']):>8}  内存峰值 {fmt_bytes(r['mem_peak'])}", file=sys.stderr)
+
+    parsers = bench_parsers()
+    print("解析函数：" + "，".join(f"{k} {v:.1f}µs" for k, v in parsers.items()), file=sys.stderr)
+    startup = bench_startup()
+    print("冷启动导入：" + "，".join(f"{k} {v['import_ms']:.0f}ms" + ("（含 openai）" if v["openai_loaded"] else "") for k, v in startup.items()), file=sys.stderr)
+
+    report = {"created": time.strftime("%Y-%m-%d %H:%M:%S"), "workers": args.workers, "seed": args.seed, "quick": args.quick,
+              "results": results, "parsers_us": parsers, "startup": startup}
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            problems = compare(results, json.load(f), args.tolerance, startup)
+        for p in problems: print(f"回归：{p}", file=sys.stderr)
+        if problems: return 1
+    lazy_broken = [m for m, v in startup.items() if v["openai_loaded"]]
+    for m in lazy_broken: print(f"回归：import {m} 时导入了 openai (应在首次建立客户端时才导入)", file=sys.stderr)
+    # 注入了多图截断的场景必须出现解析失败 (并拆分重试)，否则拆分路径没有被覆盖
+    uncovered = [r for r in results if SCENARIOS[r["scenario"]]["server"].get("batch_faults") and not r["parse_fail"]]
+    for r in uncovered: print(f"回归：{r['scenario']} {r['size']} 注入的多图截断未被识别为格式错误", file=sys.stderr)
+    return 1 if lazy_broken or uncovered or any(r["failed"] for r in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
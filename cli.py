@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+建设工程质量安全检查助手 - 命令行批处理
+对目录或通配符匹配的现场照片批量分析，结果逐张追加写入 JSONL (可选 CSV)。
+再次运行同一输出文件时跳过已完成的图片，可随时中断后续跑。
+
+用法：
+    python cli.py photos/ -o results.jsonl --csv results.csv -j 4
+    python cli.py "site/**/*.jpg" -o results.jsonl --mode combined --metrics calls.json
+    python cli.py photos/ -o results.jsonl --report report.html
+API Key 取自 --api-key、环境变量 INSPECTOR_API_KEY 或 app_config.json。
+"""
+
+import argparse, csv, glob, json, os, sys, threading
+from datetime import datetime
+
+from engine import ConfigManager, InspectionEngine, build_run, new_task, METRICS, CONFIG_FILE, MAX_WORKERS, OUTPUT_FORMATS, PIPELINE_MODES, PROVIDER_PRESETS
+from export import CSV_FIELDS, EXPORTERS, JsonlTasks, export_report
+
+IMAGE_EXTS = (".jpg", ".jpeg", ".png", ".webp", ".bmp", ".gif", ".heic", ".heif")
+
+
+def collect_images(inputs):
+    """展开目录 (递归) 与通配符，按出现顺序去重"""
+    seen, out = set(), []
+    for item in inputs:
+        if os.path.isdir(item):
+            paths = (os.path.join(d, f) for d, _, files in sorted(os.walk(item)) for f in sorted(files))
+        else:
+            paths = sorted(glob.glob(item, recursive=True))
+        for p in paths:
+            ap = os.path.abspath(p)
+            if ap.lower().endswith(IMAGE_EXTS) and ap not in seen:
+                seen.add(ap)
+                out.append(ap)
+    return out
+
+
+def load_done(jsonl_path):
+    """读取已有输出中状态为 done 的图片路径；失败的图片会在续跑时重试"""
+    done = set()
+    if os.path.exists(jsonl_path):
+        with open(jsonl_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try: rec = json.loads(line)
+                except ValueError: continue  # 上次中断留下的半行
+                if rec.get("status") == "done": done.add(rec.get("path"))
+    return done
+
+
+class ResultWriter:
+    """线程安全地逐条追加 JSONL / CSV，每条写完即 flush，中断后已写内容完整"""
+    def __init__(self, jsonl_path, csv_path=None):
+        self._lock = threading.Lock()
+        self.jsonl = open(jsonl_path, "a+", encoding="utf-8")
+        if self.jsonl.tell() > 0:
+            self.jsonl.seek(self.jsonl.tell() - 1)
+            if self.jsonl.read(1) != "\n": self.jsonl.write("\n")  # 补齐被中断的半行
+        self.csv_file = self.csv = None
+        if csv_path:
+            is_new = not os.path.exists(csv_path) or os.path.getsize(csv_path) == 0
+            self.csv_file = open(csv_path, "a", encoding="utf-8-sig" if is_new else "utf-8", newline="")
+            self.csv = csv.DictWriter(self.csv_file, fieldnames=CSV_FIELDS, extrasaction="ignore")
+            if is_new: self.csv.writeheader()
+
+    def write(self, task):
+        issues = (task.get('data') or []) if task['status'] == 'done' else []
+        record = {"path": task['path'], "name": task['name'], "status": task['status'], "roles": task.get('roles', []), "scene": task.get('scene'),
+                  "issues": issues, "error": task.get('error'), "metrics": task.get('metrics'),
+                  "analyzed_at": datetime.now().isoformat(timespec="seconds")}
+        with self._lock:
+            self.jsonl.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self.jsonl.flush()
+            if self.csv:
+                for item in issues: self.csv.writerow(dict(item, path=task['path'], name=task['name']))
+                self.csv_file.flush()
+
+    def close(self):
+        self.jsonl.close()
+        if self.csv_file: self.csv_file.close()
+
+
+def write_report(args):
+    if not args.report or not os.path.exists(args.output): return 0
+    try:
+        n = export_report(args.report, JsonlTasks(args.output))
+    except (OSError, ValueError) as e:
+        print(f"报告导出失败：{e}", file=sys.stderr)
+        return 1
+    print(f"报告：{n} 个问题 → {args.report}", file=sys.stderr)
+    return 0
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="批量分析施工现场照片，结果写入 JSONL/CSV (可断点续跑)")
+    ap.add_argument("inputs", nargs="+", help="图片目录或通配符 (支持 **)")
+    ap.add_argument("-o", "--output", default="results.jsonl", help="JSONL 输出文件 (默认 results.jsonl)")
+    ap.add_argument("--csv", help="同时按问题逐行写入 CSV")
+    ap.add_argument("-j", "--workers", type=int, help=f"同时分析的图片数 (默认取配置或 {MAX_WORKERS})")
+    ap.add_argument("--mode", choices=list(PIPELINE_MODES), help="分析模式")
+    ap.add_argument("--batch", type=int, help="分级模式下同一专家一次调用最多检查的图片数 (需 -j 不小于该值才能凑满)")
+    ap.add_argument("--format", choices=list(OUTPUT_FORMATS), help="输出格式 (structured = 结构化，省 token)")
+    ap.add_argument("--provider", choices=list(PROVIDER_PRESETS), help="模型厂商")
+    ap.add_argument("--multi-provider", action="store_true", help="当前厂商异常时自动切换到其余已配置 Key 的厂商")
+    ap.add_argument("--hedge", action="store_true", help="请求超过厂商 P95 时同时向备用厂商重发，取先返回者")
+    ap.add_argument("--api-key", default=os.environ.get("INSPECTOR_API_KEY"), help="API Key")
+    ap.add_argument("--report", help="结束时由 JSONL 生成报告，按扩展名选择格式 (.html / .docx / .csv)")
+    ap.add_argument("--metrics", help="结束时导出每次调用的耗时/Token/重试统计 (JSON)")
+    ap.add_argument("--config", default=CONFIG_FILE, help="配置文件 (默认 app_config.json)")
+    args = ap.parse_args(argv)
+    if args.report and os.path.splitext(args.report)[1].lstrip(".").lower() not in EXPORTERS:
+        ap.error(f"--report 仅支持 {' / '.join('.' + k for k in EXPORTERS)}")
+
+    config = ConfigManager.load(args.config)
+    if args.provider: config["current_provider"] = args.provider
+    if args.api_key:
+        config["api_key"] = args.api_key
+        config.setdefault("api_keys", {})[config.get("current_provider", "阿里百炼 (Qwen2.5-VL)")] = args.api_key
+    if args.multi_provider: config["multi_provider"] = True
+    if args.hedge: config["hedge_requests"] = True
+    if args.mode: config["pipeline_mode"] = args.mode
+    if args.format: config["output_format"] = args.format
+    if args.batch: config["batch_images"] = max(1, args.batch)
+    config["streaming"] = False  # 命令行不需要边收边显示
+    run = build_run(config)
+    if not run["api_key"]:
+        ap.error("未配置 API Key：使用 --api-key 或环境变量 INSPECTOR_API_KEY")
+
+    images = collect_images(args.inputs)
+    done = load_done(args.output)
+    todo = [p for p in images if p not in done]
+    print(f"共 {len(images)} 张，已完成 {len(images) - len(todo)} 张，本次分析 {len(todo)} 张", file=sys.stderr)
+    if not todo: return write_report(args)
+
+    writer = ResultWriter(args.output, args.csv)
+    lock, finished = threading.Lock(), threading.Event()
+    counts = {"done": 0, "error": 0, "issues": 0}
+
+    def on_done(task):
+        writer.write(task)
+        with lock:
+            counts[task['status']] = counts.get(task['status'], 0) + 1
+            counts["issues"] += len(task.get('data') or [])
+            n = counts["done"] + counts["error"]
+        msg = f"{len(task.get('data') or [])} 个问题" if task['status'] == 'done' else f"失败：{task.get('error', '')[:60]}"
+        print(f"[{n}/{len(todo)}] {task['name']} {msg}", file=sys.stderr)
+        task['data'] = None  # 已落盘，释放内存
+        if n >= len(todo): finished.set()
+
+    engine = InspectionEngine(args.workers or config.get("max_workers", MAX_WORKERS), on_done=on_done)
+    for path in todo: engine.submit(new_task(path), run)
+    try:
+        while not finished.wait(0.5): pass
+    except KeyboardInterrupt:
+        engine.cancel_pending()
+        print("已中断，重新运行相同命令即可从断点继续", file=sys.stderr)
+        return 130
+    finally:
+        writer.close()
+        if args.metrics: METRICS.export(args.metrics)
+    print(f"完成：成功 {counts['done']} 张，失败 {counts['error']} 张，共 {counts['issues']} 个问题 → {args.output}", file=sys.stderr)
+    return write_report(args) or (1 if counts["error"] else 0)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
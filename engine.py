@@ -0,0 +1,1817 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+建设工程质量安全检查助手 - 分析引擎
+分诊/专家流水线、图片预处理、缓存、限流与重试，与界面无关，
+供 Flet 界面 (main.py) 与命令行批处理 (cli.py) 共用。
+"""
+
+import os, io, json, base64, functools, hashlib, itertools, math, time, re, random, sqlite3, threading, types
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # 未打包 Pillow 时退化为原图 Base64
+    Image = None
+
+# ==================== 全局配置 ====================
+CONFIG_FILE = "app_config.json"
+
+THUMB_EDGE = 150                       # 主页 50×50 缩略图 (按 3x 像素密度)
+PREVIEW_EDGE = 720                     # 详情页 240px 预览图
+IMAGE_CACHE_BYTES = 48 * 1024 * 1024   # 缩略图/预览图缓存字节预算
+UPLOAD_MAX_EDGE = 1600                 # 上传给专家的图片最长边
+UPLOAD_QUALITY = 85                    # 上传 JPEG 压缩质量
+ROUTER_MAX_EDGE = 512                  # 分诊只需判断场景，使用小图
+MAX_WORKERS = 3                        # 同时分析的图片数
+RETRY_MAX = 4                          # 429/5xx/超时 最大重试次数
+RETRY_BASE, RETRY_CAP = 1.0, 30.0      # 指数退避基数与上限 (秒)
+IMAGE_TOKENS = 1300                    # 单张图片的 token 估算 (用于 TPM 限流)
+EXPERT_WORKERS = 12                    # 专家调用共享线程池大小 (所有图片共用)
+HEDGE_MIN_DELAY = 3.0                  # 对冲请求的最短等待 (秒)：主厂商超过 max(该值, 其 P95) 未返回才向备用厂商重发
+HEDGE_MIN_SAMPLES = 8                  # 厂商累计这么多次成功调用后才计算 P95 并启用对冲
+FAILOVER_ERRORS = 3                    # 连续失败达到该次数后熔断该厂商，流量切到备用厂商
+FAILOVER_COOLDOWN = 60.0               # 熔断时长 (秒)，到期后放行试探请求
+BATCH_IMAGES = 1                       # 分级模式下同一专家合并为一次调用的最多图片数 (1 = 不合并)
+BATCH_MAX_TOKENS = 16000               # 多图调用的估算 token 上限 (图片 + 输出)
+BATCH_MAX_OUTPUT = 4096                # 多图调用的输出 token 上限
+BATCH_WINDOW = 0.4                     # 批次首个请求等待同专家请求加入的时间 (秒)
+HTTP_POOL_SIZE = 16                    # 每个厂商客户端的 keep-alive 连接数上限
+HTTP_TIMEOUT = 90.0                    # 单次请求读取超时 (秒)
+HTTP_CONNECT_TIMEOUT = 10.0            # 建连超时 (秒)
+RESULT_CACHE_DIR = "result_cache"      # 分诊/专家结果磁盘缓存目录
+RESULT_CACHE_BYTES = 32 * 1024 * 1024  # 结果缓存容量上限
+DEDUP_THRESHOLD = 6                    # 近似重复照片的 dHash 汉明距离阈值 (64 位，0 = 关闭)
+SESSION_DB = "session.db"              # 任务/角色结果/问题的会话库 (SQLite WAL)
+HISTORY_DB = "history.db"              # 历史检查记录库 (清空会话后仍保留，支持全文检索)
+CLAUSE_CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "regulations.jsonl")  # 规范条文库 (每行一条)
+CLAUSE_TOP_K = 6                       # 每位专家最多注入的条文数
+CLAUSE_TOKEN_BUDGET = 360              # 每位专家注入条文的 token 上限 (0 = 不注入)
+COMBINED_CLAUSE_BUDGET = 900           # 合并模式注入条文的 token 上限
+PROMPT_VERSION = "5.1.0"               # 修改 ROUTER_PROMPT / build_ai_prompt 后必须递增，使旧缓存失效
+
+PROVIDER_PRESETS = {
+    "阿里百炼 (Qwen-VL-Max)": {"base_url": "https://dashscope.aliyuncs.com/compatible-mode/v1", "model": "qwen-vl-max", "rpm": 60, "tpm": 100000, "response_format": "json_object"},
+    "阿里百炼 (Qwen2.5-VL)": {"base_url": "https://dashscope.aliyuncs.com/compatible-mode/v1", "model": "qwen2.5-vl-72b", "rpm": 60, "tpm": 100000, "response_format": "json_object"},
+    "硅基流动 (Qwen2-VL)": {"base_url": "https://api.siliconflow.cn/v1", "model": "Qwen/Qwen2-VL-72B-Instruct", "rpm": 30, "tpm": 50000},
+}
+# response_format：厂商支持的结构化输出 ("json_schema" / "json_object")，缺省或被拒绝时改用紧凑行格式
+
+RISK_LEVELS = ["严重安全隐患", "一般安全隐患", "严重质量缺陷", "一般质量缺陷"]  # 按优先级从高到低
+
+PIPELINE_MODES = {
+    "staged": "分级（分诊 + 专家）",
+    "combined": "合并（单次调用）",
+}
+
+OUTPUT_FORMATS = {
+    "free": "自由 JSON（兼容）",
+    "structured": "结构化（省 token）",
+}
+
+# 结构化输出下每位专家的问题条数与输出 token 上限；token 上限随条数给出，
+# 按 JSON 对象格式估算 (中文描述 + 规范 + 整改约 200 token/条)，紧凑格式更省，留足余量避免截断
+ISSUE_OUTPUT_TOKENS = 200
+
+def output_limit(max_issues, overhead=150):
+    return {"max_issues": max_issues, "max_tokens": overhead + ISSUE_OUTPUT_TOKENS * max_issues}
+
+ROLE_OUTPUT_LIMITS = {
+    "安全": output_limit(8),
+    "结构": output_limit(6),
+}
+DEFAULT_OUTPUT_LIMIT = output_limit(5)
+COMBINED_OUTPUT_LIMIT = output_limit(15, overhead=250)
+
+DEFAULT_PROMPTS = {
+    "V4.6 安全质量双聚焦": "聚焦安全隐患 + 质量问题",
+    "安全隐患专项": "仅识别安全隐患",
+    "质量问题专项": "仅识别质量问题",
+}
+
+REGULATION_DB = {
+    "安全": {
+        "role_desc": "注册安全工程师 | 30 年经验",
+        "critical_hazards": ["高处作业不系安全带", "安全帽未系下颌带", "临边洞口防护缺失", "使用挖掘机吊装"],
+        "checklist": ["【一眼识别】安全帽：未系下颌带立即报告", "【一眼识别】安全带：2m 以上无安全带立即报告", "【一眼识别】临边防护：无 1.2m 护栏立即报告"],
+        "must_report_if": ["发现高处作业无安全带", "发现临边洞口无防护", "发现使用挖掘机吊物"],
+        "anti_hallucination": "管理人员在安全通道内检查可短时摘帽；地面作业不强制系安全带。"
+    },
+    "机械": {
+        "role_desc": "起重机械专家 | 30 年经验",
+        "critical_hazards": ["【致命】使用挖掘机吊装", "塔吊限制器失效或被短接", "钢丝绳断丝超过 10%", "施工升降机防坠安全器失效"],
+        "checklist": ["【一眼识别】吊装设备：挖掘机、装载机吊物立即报告", "【一眼识别】限位器：查看是否有线头短接", "【一眼识别】钢丝绳：断丝断股立即报告"],
+        "must_report_if": ["发现使用挖掘机、装载机吊物", "发现限位器短接或失效", "发现钢丝绳断丝断股"],
+        "anti_hallucination": "停工状态吊钩无荷载正常；设备表面轻微锈迹不是缺陷。"
+    },
+    "电气": {
+        "role_desc": "注册电气工程师 | 30 年经验",
+        "critical_hazards": ["临时用电未采用 TN-S 系统", "配电箱未做重复接地", "一闸多机", "电缆直接拖地或浸水"],
+        "checklist": ["【一眼识别】电线颜色：黄绿双色只能是 PE 线", "【一眼识别】配电箱门：必须有跨接软铜线", "【一眼识别】插座接线：左零右火上接地"],
+        "must_report_if": ["发现电线绝缘层破损", "发现漏电保护器失效", "发现电缆接头裸露"],
+        "anti_hallucination": "施工中临时接线待整理正常；备用回路不是故障。"
+    },
+    "管道": {
+        "role_desc": "管道工艺专家 | 30 年经验",
+        "critical_hazards": ["压力管道使用排水管", "阀门无标识或标识错误", "法兰垫片使用错误"],
+        "checklist": ["【一眼识别】管道颜色：红色消防、绿色给水、蓝色排水、黄色燃气", "【一眼识别】法兰螺栓：必须露出 2-3 扣"],
+        "must_report_if": ["发现管道有凹陷、裂纹", "发现阀门铭牌缺失", "发现不同材质管道直接焊接"],
+        "anti_hallucination": "临时封堵盲板不是缺阀门；试压用临时支撑不是支架不足。"
+    },
+    "结构": {
+        "role_desc": "结构总工程师 | 30 年经验",
+        "critical_hazards": ["模板支撑立杆悬空或无垫板", "高大模板未设置扫地杆剪刀撑", "混凝土浇筑后出现贯穿裂缝"],
+        "checklist": ["【一眼识别】立杆底部：悬空、无垫板立即报告", "【一眼识别】混凝土裂缝：宽度超 0.3mm 立即报告"],
+        "must_report_if": ["发现立杆悬空无垫板", "发现混凝土裂缝宽度超过 0.3mm"],
+        "anti_hallucination": "未抹面不是不平整；温度裂缝（发丝状）不是结构裂缝。"
+    },
+}
+
+ROUTER_PROMPT = """你是工程建设总监。识别图片施工内容，选派 2-5 个专家：
+1. 安全 2. 机械 3. 电气 4. 结构 5. 管道
+规则：必须包含"安全"；看到机械必须选"机械"；看到管道相关选"管道"。
+scene 用一句话 (30 字以内) 概括施工内容、设备与作业部位。
+输出 JSON 对象，如：{"scene": "塔吊吊运钢筋，楼层临边作业", "roles": ["机械","安全"]}"""
+
+
+# ==================== 规范条文库 (按需加载 + BM25 检索) ====================
+def tokenize(text):
+    """中文按字二元组切分，字母数字串 (规范号、TN-S、30mA 等) 整体保留"""
+    toks = []
+    for run in re.findall(r'[\u4e00-\u9fff]+|[a-z0-9][a-z0-9.\-/]*', text.lower()):
+        if run[0] >= '\u4e00': toks += [run[i:i + 2] for i in range(len(run) - 1)] or [run]
+        else: toks.append(run)
+    return toks
+
+def format_clause(c):
+    return f"{c['code']}《{c['title']}》第 {c['clause']} 条：{c['text']}"
+
+class ClauseIndex:
+    """规范条文库：首次检索时才读取语料并建立倒排索引，按 BM25 取与专家职责/现场场景最相关的条文。
+    语料每行一个 JSON：{"code", "title", "clause", "text", "roles"}，roles 为空表示适用于所有专家"""
+    K1, B = 1.5, 0.75
+
+    def __init__(self, path=CLAUSE_CORPUS):
+        self.path = path
+        self._lock = threading.Lock()
+        self.clauses = None
+
+    def _build(self):
+        clauses = []
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    try: c = json.loads(line)
+                    except ValueError: continue
+                    if c.get("code") and c.get("text"): clauses.append(c)
+        except OSError: pass
+        postings, lengths = {}, []
+        for i, c in enumerate(clauses):
+            tf = Counter(tokenize(f"{c.get('title', '')} {c['text']}"))
+            lengths.append(sum(tf.values()))
+            for t, n in tf.items(): postings.setdefault(t, []).append((i, n))
+        n = len(clauses)
+        self.idf = {t: math.log(1 + (n - len(p) + 0.5) / (len(p) + 0.5)) for t, p in postings.items()}
+        self.postings, self.lengths = postings, lengths
+        self.avgdl = sum(lengths) / n if n else 1.0
+        self.clauses = clauses
+
+    def _ensure(self):
+        if self.clauses is None:
+            with self._lock:
+                if self.clauses is None: self._build()
+        return self.clauses
+
+    def __len__(self):
+        return len(self._ensure())
+
+    def search(self, query, role=None, k=CLAUSE_TOP_K, budget=CLAUSE_TOKEN_BUDGET):
+        """返回按相关度排序的条文，总长度 (按 1 字 1 token 估算) 不超过 budget"""
+        clauses = self._ensure()
+        if not clauses or budget <= 0: return []
+        scores = Counter()
+        for t in set(tokenize(query)):
+            for i, tf in self.postings.get(t, ()):
+                roles = clauses[i].get("roles")
+                if role and roles and role not in roles: continue
+                scores[i] += self.idf[t] * tf * (self.K1 + 1) / (tf + self.K1 * (1 - self.B + self.B * self.lengths[i] / self.avgdl))
+        picked, used = [], 0
+        for i, _ in scores.most_common():
+            cost = len(format_clause(clauses[i]))
+            if used + cost > budget: continue
+            picked.append(clauses[i])
+            used += cost
+            if len(picked) >= k: break
+        return picked
+
+    def reload(self, path=None):
+        with self._lock:
+            self.path = path or self.path
+            self.clauses = None
+        role_clauses.cache_clear()
+
+CLAUSES = ClauseIndex()
+
+@functools.lru_cache(maxsize=256)
+def role_clauses(role, scene="", budget=CLAUSE_TOKEN_BUDGET):
+    """某专家在给定场景下应参考的条文：以职责 (重大隐患/检查清单) 加场景描述为查询"""
+    kb = REGULATION_DB.get(role, {})
+    query = " ".join([role, scene, *kb.get("critical_hazards", []), *kb.get("checklist", []), *kb.get("must_report_if", [])])
+    return tuple(CLAUSES.search(query, role, budget=budget))
+
+def clause_section(clauses):
+    if not clauses: return ""
+    return "## 相关规范条文\n" + "\n".join(f"- {format_clause(c)}" for c in clauses) + \
+           "\nregulation 优先引用上述条文 (规范号 + 条文号)；条文未覆盖时只写规范名称，不要编造条文号。\n"
+
+
+# ==================== 配置管理器 (完全保留) ====================
+class ConfigManager:
+    @staticmethod
+    def load(path=CONFIG_FILE):
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+            except: pass
+        return {
+            "api_key": "",
+            "current_provider": "阿里百炼 (Qwen2.5-VL)",
+            "last_prompt": "V4.6 安全质量双聚焦"
+        }
+
+    @staticmethod
+    def save(config):
+        try:
+            with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
+                json.dump(config, f, indent=2, ensure_ascii=False)
+        except: pass
+
+# ==================== 辅助方法 ====================
+def get_b64(path):
+    """将本地图片转为 Base64，适配手机端引擎渲染"""
+    try:
+        with open(path, "rb") as f:
+            return base64.b64encode(f.read()).decode("utf-8")
+    except: return ""
+
+def detect_mime(head):
+    """按文件头识别真实图片格式，避免 PNG/HEIC 被标成 JPEG"""
+    if head[:3] == b"\xff\xd8\xff": return "image/jpeg"
+    if head[:8] == b"\x89PNG\r\n\x1a\n": return "image/png"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP": return "image/webp"
+    if head[:6] in (b"GIF87a", b"GIF89a"): return "image/gif"
+    if head[:2] == b"BM": return "image/bmp"
+    if head[4:8] == b"ftyp" and head[8:12] in (b"heic", b"heix", b"hevc", b"heim", b"heis", b"mif1", b"msf1"): return "image/heic"
+    return "image/jpeg"
+
+def fmt_bytes(n):
+    if n >= 1024 * 1024: return f"{n / 1024 / 1024:.1f}MB"
+    return f"{n / 1024:.0f}KB"
+
+def _load_scaled(src, max_edge):
+    """解码并缩放到最长边 max_edge；JPEG 直接按缩小比例解码，避免解码整张大图"""
+    img = Image.open(src)
+    img.draft("RGB", (max_edge, max_edge))
+    img = ImageOps.exif_transpose(img).convert("RGB")
+    img.thumbnail((max_edge, max_edge))
+    return img
+
+def _jpeg_bytes(img, quality):
+    buf = io.BytesIO()
+    img.save(buf, "JPEG", quality=quality, optimize=True)
+    return buf.getvalue()
+
+def encode_image(path, max_edge, quality=80):
+    """读取图片并按最长边缩放后重新编码为 JPEG Base64"""
+    if Image is None: return get_b64(path)
+    try:
+        return base64.b64encode(_jpeg_bytes(_load_scaled(path, max_edge), quality)).decode("utf-8")
+    except Exception:
+        return get_b64(path)
+
+def prepare_upload(path, max_edge=UPLOAD_MAX_EDGE, quality=UPLOAD_QUALITY, router_edge=ROUTER_MAX_EDGE):
+    """上传预处理：一次解码生成专家用图和分诊用小图，返回 data URL 与字节统计"""
+    with open(path, "rb") as f: raw = f.read()
+    mime = detect_mime(raw[:16])
+    full = small = None
+    if Image is not None:
+        try:
+            img = _load_scaled(io.BytesIO(raw), max_edge)
+            full = _jpeg_bytes(img, quality)
+            img.thumbnail((router_edge, router_edge))
+            small = _jpeg_bytes(img, quality)
+        except Exception: pass  # 无法解码 (如缺少 HEIC 插件) 时按原图上传
+    if full is None:
+        full = small = raw
+    else:
+        if mime == "image/jpeg" and len(raw) <= len(full): full = raw  # 原图已足够小则直接上传
+        mime = "image/jpeg"
+    b64 = lambda b: base64.b64encode(b).decode("utf-8")
+    return {"mime": mime, "orig_bytes": len(raw), "sent_bytes": len(full), "router_bytes": len(small),
+            "url": f"data:{mime};base64,{b64(full)}", "router_url": f"data:{mime};base64,{b64(small)}"}
+
+def file_digest(path):
+    """图片内容 SHA-256，用作结果缓存键 (同一张图换目录也能命中)"""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""): h.update(chunk)
+    return h.hexdigest()
+
+class ResultCache:
+    """分诊与专家结果的磁盘缓存：键 = 内容哈希 + 角色 + 模型 + 输出设置 + 提示词版本，
+    超出容量时按最近访问时间淘汰。输出设置 (variant) 区分会改变结果的选项，如结构化截断条数、条文预算"""
+    ROUTER = "__router__"
+    COMBINED = "__combined__"
+
+    def __init__(self, root=RESULT_CACHE_DIR, budget=RESULT_CACHE_BYTES):
+        self.root = root
+        self.budget = budget
+        self.size = None        # 首次写入时扫描目录得到
+        self._lock = threading.Lock()
+
+    def _file(self, digest, role, model, variant=""):
+        key = hashlib.sha1(f"{digest}|{role}|{model}|{variant}|{PROMPT_VERSION}".encode("utf-8")).hexdigest()
+        return os.path.join(self.root, key[:2], key + ".json")
+
+    def get(self, digest, role, model, variant=""):
+        fp = self._file(digest, role, model, variant)
+        try:
+            with open(fp, "r", encoding="utf-8") as f: value = json.load(f)
+            os.utime(fp)  # 刷新访问时间，供 LRU 淘汰
+            return value
+        except Exception:
+            return None
+
+    def put(self, digest, role, model, value, variant=""):
+        fp = self._file(digest, role, model, variant)
+        try:
+            os.makedirs(os.path.dirname(fp), exist_ok=True)
+            tmp = f"{fp}.{threading.get_ident()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f: json.dump(value, f, ensure_ascii=False)
+            os.replace(tmp, fp)
+            with self._lock:
+                if self.size is None: self.size = sum(sz for _, sz, _ in self._entries())
+                else: self.size += os.path.getsize(fp)
+                if self.size > self.budget: self._evict()
+        except Exception: pass
+
+    def _entries(self):
+        for dirpath, _, files in os.walk(self.root):
+            for name in files:
+                fp = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(fp)
+                    yield fp, st.st_size, st.st_mtime
+                except OSError: pass
+
+    def _evict(self):
+        entries = sorted(self._entries(), key=lambda e: e[2])
+        self.size = sum(e[1] for e in entries)
+        for fp, sz, _ in entries:
+            if self.size <= self.budget * 0.8: break
+            try:
+                os.remove(fp)
+                self.size -= sz
+            except OSError: pass
+
+RESULT_CACHE = ResultCache()
+
+class ImageCache:
+    """按 路径 + mtime 缓存缩略图/预览图 Base64，超出字节预算时按 LRU 淘汰"""
+    def __init__(self, budget=IMAGE_CACHE_BYTES):
+        self.budget = budget
+        self.size = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path, max_edge):
+        try: key = (path, os.path.getmtime(path), max_edge)
+        except OSError: return ""
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                return self._items[key]
+        b64 = encode_image(path, max_edge)
+        if not b64: return ""
+        with self._lock:
+            if key not in self._items:
+                self._items[key] = b64
+                self.size += len(b64)
+            while self.size > self.budget and len(self._items) > 1:
+                _, old = self._items.popitem(last=False)
+                self.size -= len(old)
+        return b64
+
+    def thumb(self, path): return self.get(path, THUMB_EDGE)
+
+    def preview(self, path): return self.get(path, PREVIEW_EDGE)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.size = 0
+
+IMAGE_CACHE = ImageCache()
+
+# ==================== 近似重复检测 ====================
+def dhash(path, size=8):
+    """差值哈希：缩成 (size+1)×size 灰度图，逐行比较相邻像素明暗，返回 size² 位整数；
+    连拍/重拍的同一场景距离很小，不同场景通常相差 20 位以上"""
+    if Image is None: return None
+    try:
+        img = _load_scaled(path, size * 8).convert("L").resize((size + 1, size), Image.BILINEAR)
+    except Exception: return None
+    px, bits = list(img.getdata()), 0
+    for y in range(size):
+        row = px[y * (size + 1):(y + 1) * (size + 1)]
+        for x in range(size): bits = (bits << 1) | (row[x] > row[x + 1])
+    return bits
+
+class HashIndex:
+    """BK 树：按汉明距离检索近似哈希，查询只进入满足三角不等式的分支"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock: self._root = None   # 节点: [哈希, [key...], {距离: 子节点}]
+
+    def add(self, h, key):
+        with self._lock:
+            if self._root is None:
+                self._root = [h, [key], {}]
+                return
+            node = self._root
+            while True:
+                d = bin(node[0] ^ h).count("1")
+                if d == 0: return node[1].append(key)
+                if d not in node[2]:
+                    node[2][d] = [h, [key], {}]
+                    return
+                node = node[2][d]
+
+    def search(self, h, radius):
+        """返回 [(距离, key)]，按距离升序"""
+        out = []
+        with self._lock:
+            stack = [self._root] if self._root else []
+            while stack:
+                node = stack.pop()
+                d = bin(node[0] ^ h).count("1")
+                if d <= radius: out += [(d, key) for key in node[1]]
+                stack += [child for dist, child in node[2].items() if d - radius <= dist <= d + radius]
+        return sorted(out, key=lambda x: x[0])
+
+# ==================== 调度、限流与重试 ====================
+class TokenBucket:
+    """令牌桶：容量为每分钟配额，按秒匀速补充"""
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.tokens = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def acquire(self, n=1):
+        n = min(n, self.capacity)
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= n:
+                    self.tokens -= n
+                    return
+                wait = (n - self.tokens) / self.rate
+            time.sleep(min(wait, 5.0))
+
+    def debit(self, n):
+        """按实际用量补扣 (可为负，即返还)"""
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens - n)
+
+class RateLimiter:
+    """单个厂商的请求数/分钟 + token 数/分钟 双令牌桶"""
+    def __init__(self, rpm, tpm):
+        self.rpm, self.tpm = rpm, tpm
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+
+    def acquire(self, est_tokens):
+        self.requests.acquire(1)
+        self.tokens.acquire(est_tokens)
+
+    def settle(self, est_tokens, used_tokens):
+        if used_tokens: self.tokens.debit(used_tokens - est_tokens)
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def get_limiter(provider, rpm, tpm):
+    with _limiters_lock:
+        lim = _limiters.get(provider)
+        if lim is None or (lim.rpm, lim.tpm) != (rpm, tpm):
+            lim = _limiters[provider] = RateLimiter(rpm, tpm)
+        return lim
+
+def estimate_tokens(messages, max_out=800):
+    """粗略估算一次调用的 token：中文约 1 字 1 token，图片按固定值计"""
+    n = max_out
+    for m in messages:
+        parts = m["content"] if isinstance(m["content"], list) else [{"type": "text", "text": m["content"]}]
+        for part in parts:
+            n += IMAGE_TOKENS if part.get("type") == "image_url" else len(part.get("text", ""))
+    return n
+
+def is_retryable(exc):
+    status = getattr(exc, "status_code", None)
+    if status is not None: return status == 429 or status >= 500
+    return type(exc).__name__ in ("APITimeoutError", "APIConnectionError") or isinstance(exc, (TimeoutError, ConnectionError))
+
+def retry_delay(exc, attempt):
+    """优先遵循 Retry-After，否则使用 full-jitter 指数退避"""
+    try:
+        ra = float(exc.response.headers.get("retry-after"))
+        if ra >= 0: return min(ra, RETRY_CAP)
+    except Exception: pass
+    return random.uniform(0, min(RETRY_CAP, RETRY_BASE * 2 ** attempt))
+
+def call_with_retry(fn, limiter=None, est_tokens=0, retries=RETRY_MAX, on_retry=None):
+    """限流后发起调用，遇到 429/5xx/超时按退避重试"""
+    for attempt in range(retries + 1):
+        if limiter: limiter.acquire(est_tokens)
+        try:
+            resp = fn()
+        except Exception as e:
+            if attempt >= retries or not is_retryable(e): raise
+            delay = retry_delay(e, attempt)
+            if on_retry: on_retry(attempt + 1, delay, e)
+            time.sleep(delay)
+            continue
+        if limiter: limiter.settle(est_tokens, getattr(getattr(resp, "usage", None), "total_tokens", 0))
+        return resp
+
+class ProviderHealth:
+    """各厂商近期的调用耗时与成败：P95 作为对冲阈值；连续失败的厂商熔断一段时间，
+    期间排到备用厂商之后，到期后放行试探请求，再失败则重新熔断"""
+    def __init__(self, window=50):
+        self.window = window
+        self._lat = {}          # provider -> deque[耗时]
+        self._results = {}      # provider -> deque[成功与否]
+        self._fails = Counter() # provider -> 连续失败次数
+        self._open_until = {}   # provider -> 熔断到期时间
+        self._lock = threading.Lock()
+
+    def record(self, provider, ok, latency=None):
+        with self._lock:
+            self._results.setdefault(provider, deque(maxlen=self.window)).append(ok)
+            if ok:
+                self._lat.setdefault(provider, deque(maxlen=self.window)).append(latency)
+                self._fails[provider] = 0
+                self._open_until.pop(provider, None)
+            else:
+                self._fails[provider] += 1
+                if self._fails[provider] >= FAILOVER_ERRORS: self._open_until[provider] = time.monotonic() + FAILOVER_COOLDOWN
+
+    def available(self, provider):
+        with self._lock: return time.monotonic() >= self._open_until.get(provider, 0)
+
+    def p95(self, provider):
+        with self._lock: lat = sorted(self._lat.get(provider, ()))
+        if len(lat) < HEDGE_MIN_SAMPLES: return None
+        return lat[math.ceil(0.95 * len(lat)) - 1]
+
+    def order(self, backends):
+        """可用的厂商保持原优先级在前，熔断中的排在最后 (全部熔断时仍按原顺序尝试)"""
+        return sorted(backends, key=lambda b: not self.available(b["provider"]))
+
+    def snapshot(self):
+        with self._lock: providers = list(self._results)
+        out = {}
+        for p in providers:
+            with self._lock: results = list(self._results[p])
+            out[p] = {"calls": len(results), "error_rate": results.count(False) / len(results), "p95": self.p95(p), "open": not self.available(p)}
+        return out
+
+HEALTH = ProviderHealth()
+
+class AnalysisScheduler:
+    """固定上限的工作线程池，排队中的任务可取消"""
+    def __init__(self, workers=MAX_WORKERS):
+        self.workers = workers
+        self._pending = deque()
+        self._running = 0
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args):
+        with self._lock:
+            self._pending.append((fn, args))
+            if self._running < self.workers:
+                self._running += 1
+                threading.Thread(target=self._work, daemon=True).start()
+
+    def _work(self):
+        while True:
+            with self._lock:
+                if not self._pending:
+                    self._running -= 1
+                    return
+                fn, args = self._pending.popleft()
+            try: fn(*args)
+            except Exception: pass
+
+    def cancel_pending(self):
+        """取消所有尚未开始的任务，返回其参数列表"""
+        with self._lock:
+            items = list(self._pending)
+            self._pending.clear()
+        return [args for _, args in items]
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+EXPERT_POOL = ThreadPoolExecutor(max_workers=EXPERT_WORKERS, thread_name_prefix="expert")
+# 多厂商对冲：主请求与备用请求在此并发，调用线程等待先返回者
+HEDGE_POOL = ThreadPoolExecutor(max_workers=EXPERT_WORKERS * 2, thread_name_prefix="hedge")
+
+class ExpertBatcher:
+    """跨图片合并同一专家的请求：首个到达者为 leader，等待 window 秒收集同键请求，
+    凑满图片数或 token 上限则提前截止；leader 线程发起一次多图调用，其余成员阻塞等待各自的结果"""
+    def __init__(self, window=BATCH_WINDOW):
+        self.window = window
+        self._open = {}         # key -> 正在收集成员的批次
+        self._lock = threading.Lock()
+
+    def join(self, key, member, max_images, max_tokens, run_batch):
+        """member 需含 tokens (估算)；run_batch(members) 按成员顺序返回结果列表，本函数返回其中属于 member 的一项"""
+        with self._lock:
+            batch = self._open.get(key)
+            if batch is not None and batch["tokens"] + member["tokens"] > max_tokens:
+                self._close(key, batch)
+                batch = None
+            leader = batch is None
+            if leader: batch = self._open[key] = {"members": [], "tokens": 0, "closed": threading.Event(), "done": threading.Event()}
+            idx = len(batch["members"])
+            batch["members"].append(member)
+            batch["tokens"] += member["tokens"]
+            if len(batch["members"]) >= max_images: self._close(key, batch)
+        if leader:
+            batch["closed"].wait(self.window)
+            with self._lock: self._close(key, batch)
+            try: batch["results"] = run_batch(batch["members"])
+            except Exception as e: batch["error"] = e
+            finally: batch["done"].set()
+        else:
+            batch["done"].wait()
+        if "error" in batch: raise batch["error"]
+        return batch["results"][idx]
+
+    def _close(self, key, batch):
+        if self._open.get(key) is batch: del self._open[key]
+        batch["closed"].set()
+
+BATCHER = ExpertBatcher()
+
+# ==================== 客户端连接池 ====================
+class ClientRegistry:
+    """按 (厂商, base_url, api_key) 共享 OpenAI 客户端，复用 keep-alive 连接；
+    设置变更后旧客户端在最后一个使用者归还后关闭"""
+    def __init__(self):
+        self._clients = {}      # key -> [client, opts, 使用计数]
+        self._retired = {}      # id(client) -> [client, 使用计数]
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _build(base_url, api_key, pool_size, timeout):
+        import httpx
+        from openai import OpenAI, DefaultHttpxClient
+        http = DefaultHttpxClient(
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size, keepalive_expiry=60),
+            timeout=httpx.Timeout(timeout, connect=HTTP_CONNECT_TIMEOUT))
+        # 重试由 call_with_retry 统一处理，关闭 SDK 自带重试避免叠加
+        return OpenAI(api_key=api_key, base_url=base_url, http_client=http, max_retries=0)
+
+    def acquire(self, provider, base_url, api_key, pool_size=HTTP_POOL_SIZE, timeout=HTTP_TIMEOUT):
+        key, opts = (provider, base_url, api_key), (pool_size, timeout)
+        with self._lock:
+            entry = self._clients.get(key)
+            if entry and entry[1] != opts:
+                self._retire(key)
+                entry = None
+            if entry is None:
+                entry = self._clients[key] = [self._build(base_url, api_key, pool_size, timeout), opts, 0]
+            entry[2] += 1
+            return entry[0]
+
+    def release(self, client):
+        with self._lock:
+            for entry in self._clients.values():
+                if entry[0] is client:
+                    entry[2] -= 1
+                    return
+            old = self._retired.get(id(client))
+            if old:
+                old[1] -= 1
+                if old[1] <= 0:
+                    del self._retired[id(client)]
+                    client.close()
+
+    def _retire(self, key):
+        client, _, users = self._clients.pop(key)
+        if users > 0: self._retired[id(client)] = [client, users]
+        else: client.close()
+
+    def reset(self, keep=()):
+        """关闭 (或在空闲后关闭) 除 keep 中 (厂商, base_url, api_key) 以外的所有客户端，用于切换厂商或 Key 后"""
+        with self._lock:
+            for key in [k for k in self._clients if k not in keep]:
+                self._retire(key)
+
+CLIENTS = ClientRegistry()
+
+def warm_client():
+    """openai (连带 httpx、pydantic) 导入耗时约占冷启动一半，推迟到首次建立客户端；
+    界面可在首帧之后调用本函数在后台预先导入"""
+    import importlib
+    importlib.import_module("openai")
+
+def parse_roles(text):
+    try:
+        m = re.search(r'\[.*?\]', text, re.DOTALL)
+        if m: return json.loads(m.group())
+    except: pass
+    return []
+
+def parse_router(text):
+    """解析分诊输出，返回 {"roles", "scene"}；兼容只输出数组的旧格式"""
+    try:
+        m = re.search(r'\{.*\}', text, re.DOTALL)
+        obj = json.loads(m.group()) if m else {}
+        if isinstance(obj, dict) and isinstance(obj.get("roles"), list):
+            return {"roles": [r for r in obj["roles"] if isinstance(r, str)], "scene": str(obj.get("scene", ""))[:60]}
+    except: pass
+    return {"roles": parse_roles(text), "scene": ""}
+
+LEVEL_CODES = "1=严重安全隐患 2=一般安全隐患 3=严重质量缺陷 4=一般质量缺陷"
+
+def output_spec(fmt, max_issues, role=None, images=1):
+    """输出格式说明。fmt: "json" 数组 (原格式) / "object" 配合 response_format 的 JSON 对象 / "compact" 紧凑行格式；
+    role 为 None 时为合并模式 (需给出专家与 category)；images > 1 时每个问题须标注图号"""
+    cap = f"{'每张图片' if images > 1 else ''}最多 {max_issues} 条，按严重程度排序。" if max_issues else ""
+    if fmt == "compact":
+        head = "第一行：专家:安全,机械（选派的专家，逗号分隔）\n其后每个问题一行：专家|等级|问题描述|规范条文号|整改措施|置信度" if role is None else \
+               f"每个问题一行：图号|等级|问题描述|规范条文号|整改措施|置信度\n- 图号：1-{images}" if images > 1 else "每个问题一行：等级|问题描述|规范条文号|整改措施|置信度"
+        return f"""## 输出格式（紧凑行格式，只输出以下内容，不要 JSON、编号或说明）
+{head}
+- 等级：{LEVEL_CODES}
+- 置信度：0.0-1.0
+{cap}没有问题时{'问题部分' if role is None else ''}只输出：无"""
+    fields = f"""- risk_level: "严重安全隐患"/"一般安全隐患"/"严重质量缺陷"/"一般质量缺陷"
+- issue: {'【专家】' if role is None else f'【{role}】'}+ 具体描述
+- regulation: 规范条文号
+- correction: 整改措施
+- confidence: 0.0-1.0"""
+    if role is None: fields = '- category: 发现问题的专家，如 "安全"\n' + fields
+    if images > 1: fields = f"- image: 问题所在图片的序号 (1-{images})\n" + fields
+    if fmt == "object":
+        shape = '{"roles": ["安全", ...], "issues": [...]}' if role is None else '{"issues": [...]}'
+        return f"## 输出格式（JSON 对象，不要任何说明文字）\n{shape}\nissues 每项：\n{fields}" + (f"\n{cap}" if cap else "")
+    return f"## 输出格式（JSON 数组）\n{fields}"
+
+def build_ai_prompt(role, kb, fmt="json", max_issues=None, clauses=(), scene="", images=1):
+    batch = f"本次共 {images} 张现场图片，按出现顺序编号 1-{images}，请逐张检查。" if images > 1 else ""
+    return f"""你是【{role}】（{kb.get('role_desc', '')}）。{batch}{f"现场：{scene}" if scene else ""}
+## 重大隐患清单
+{chr(10).join(f'- {h}' for h in kb.get('critical_hazards', []))}
+⚠️ 发现上述情形必须报告为"严重安全隐患"！
+## 检查清单
+{chr(10).join(kb.get('checklist', []))}
+## 误判警示
+{kb.get('anti_hallucination', '')}
+{clause_section(clauses)}{output_spec(fmt, max_issues, role, images)}"""
+
+def build_combined_prompt(roles=None, fmt="json", max_issues=None, clause_budget=0):
+    """合并模式系统提示词：分诊规则 + 各专家知识合并为一次调用；
+    调用前尚无场景描述，条文按各专家职责检索，预算在专家间均分"""
+    blocks, clauses = [], {}
+    if clause_budget:
+        share = clause_budget // len(roles or REGULATION_DB)
+        for role in roles or REGULATION_DB:
+            for c in role_clauses(role, budget=share): clauses.setdefault((c["code"], c["clause"]), c)
+    for role in roles or REGULATION_DB:
+        kb = REGULATION_DB[role]
+        blocks.append(f"""### 【{role}】（{kb.get('role_desc', '')}）
+- 重大隐患：{'；'.join(kb.get('critical_hazards', []))}
+- 检查清单：{'；'.join(kb.get('checklist', []))}
+- 误判警示：{kb.get('anti_hallucination', '')}""")
+    return f"""你是工程建设总监，带领专家组一次性完成检查。
+## 第一步：分诊
+识别图片施工内容，从 {'/'.join(roles or REGULATION_DB)} 中选派 2-5 个专家。
+规则：必须包含"安全"；看到机械必须选"机械"；看到管道相关选"管道"。
+## 第二步：选派的专家逐一检查
+{chr(10).join(blocks)}
+⚠️ 发现重大隐患清单中的情形必须报告为"严重安全隐患"！
+{clause_section(list(clauses.values()))}{output_spec("object" if fmt == "json" else fmt, max_issues)}"""
+
+def parse_combined(text):
+    """解析合并模式输出，返回 (roles, issues)；issues 保留 category 归属"""
+    roles, issues = [], []
+    try:
+        clean = text.replace("```json", "").replace("```", "").strip()
+        s, e = clean.find('{'), clean.rfind('}') + 1
+        obj = json.loads(clean[s:e])
+        roles = [r for r in obj.get("roles", []) if r in REGULATION_DB]
+        for item in obj.get("issues", []):
+            if isinstance(item, dict):
+                if item.get("category") not in REGULATION_DB: item["category"] = "安全"
+                issues.append(item)
+    except: pass
+    if roles and "安全" not in roles: roles.append("安全")
+    return roles, issues
+
+def record_mode_stats(stats, m):
+    """按分析模式累计耗时与 token，仅统计实际联网的任务"""
+    if not m["calls"]: return
+    s = stats.setdefault(m["mode"], {"tasks": 0, "latency": 0.0, "calls": 0, "prompt_tokens": 0, "completion_tokens": 0})
+    s["tasks"] += 1
+    for k in ("latency", "calls", "prompt_tokens", "completion_tokens"): s[k] += m[k]
+
+def describe_mode_stats(stats):
+    lines = []
+    for mode, label in PIPELINE_MODES.items():
+        s = stats.get(mode)
+        if not s or not s["tasks"]: continue
+        n = s["tasks"]
+        lines.append(f"{label}：{n} 张，平均 {s['latency'] / n:.1f}s/张，{s['calls'] / n:.1f} 次调用，"
+                     f"{(s['prompt_tokens'] + s['completion_tokens']) / n / 1000:.1f}k tokens/张")
+    return "\n".join(lines) or "暂无统计"
+
+def issues_parsed_ok(text, issues, finish_reason=None):
+    """结果可缓存：输出完整 (未因长度截断、JSON 已闭合且没有丢弃损坏的条目)，
+    且解析出问题或模型明确返回了空数组；抢救出的局部结果只展示不缓存"""
+    if finish_reason == "length": return False
+    parser = IssueStreamParser()
+    parser.feed(text or "")
+    if not parser.closed or parser.dropped: return False
+    return bool(issues) or re.search(r'\[\s*\]', text or "") is not None
+
+class IssueStreamParser:
+    """增量解析 JSON：数组中的对象一旦闭合即产出。
+    用于流式输出边收边显示，也用于从截断/局部损坏的输出中抢救已完整的条目"""
+    def __init__(self):
+        self.buf = ""
+        self.pos = 0
+        self.stack = []         # [(括号, 起始位置)]
+        self.in_str = False
+        self.esc = False
+        self.closed = False     # 最外层括号已闭合 (输出完整)
+        self.dropped = 0        # 因损坏丢弃的条目数
+
+    def feed(self, chunk):
+        self.buf += chunk
+        out = []
+        for i in range(self.pos, len(self.buf)):
+            ch = self.buf[i]
+            if self.in_str:
+                if self.esc: self.esc = False
+                elif ch == "\\": self.esc = True
+                elif ch == '"': self.in_str = False
+            elif ch == '"':
+                self.in_str = bool(self.stack)  # 括号外的说明文字不跟踪引号
+            elif ch in "[{":
+                if not self.stack: self.closed = False
+                self.stack.append((ch, i))
+            elif ch in "]}" and self.stack:
+                _, start = self.stack.pop()
+                if not self.stack: self.closed = True
+                elif ch == "}" and self.stack[-1][0] == "[":
+                    try:
+                        item = json.loads(self.buf[start:i + 1])
+                        if isinstance(item, dict): out.append(item)
+                    except ValueError: self.dropped += 1  # 单条损坏只丢弃该条
+        self.pos = len(self.buf)
+        return out
+
+NO_RESPONSE_FORMAT = set()     # 运行中拒绝过 response_format 的厂商，之后直接用紧凑格式
+
+def issue_schema(combined=False, batched=False):
+    item = {"risk_level": {"type": "string", "enum": RISK_LEVELS}, "issue": {"type": "string"}, "regulation": {"type": "string"},
+            "correction": {"type": "string"}, "confidence": {"type": "number"}}
+    if combined: item = {"category": {"type": "string", "enum": list(REGULATION_DB)}, **item}
+    if batched: item = {"image": {"type": "integer"}, **item}
+    props = {"issues": {"type": "array", "items": {"type": "object", "properties": item, "required": list(item), "additionalProperties": False}}}
+    if combined: props = {"roles": {"type": "array", "items": {"type": "string", "enum": list(REGULATION_DB)}}, **props}
+    return {"type": "object", "properties": props, "required": list(props), "additionalProperties": False}
+
+def response_format_for(kind, combined=False, batched=False):
+    """厂商支持 json_schema 时约束到问题结构，否则仅要求合法 JSON 对象"""
+    if kind == "json_schema":
+        return {"type": "json_schema", "json_schema": {"name": "inspection_issues", "strict": True, "schema": issue_schema(combined, batched)}}
+    return {"type": "json_object"}
+
+def parse_compact_line(line, role=None):
+    """解析紧凑格式的一行：[专家|]等级|问题描述|规范条文号|整改措施|置信度；无法识别返回 None"""
+    parts = [p.strip() for p in re.sub(r'^\s*(?:[-*•]|\d+[.、)])\s*', '', line).split("|")]
+    category = role
+    if role is None:
+        if len(parts) < 6: return None
+        category, parts = parts[0], parts[1:]
+        if category not in REGULATION_DB: category = "安全"
+    if len(parts) < 5 or parts[0] not in ("1", "2", "3", "4"): return None
+    issue = "|".join(parts[1:-3])   # 描述中偶尔出现的 | 并回描述
+    if not issue.startswith("【"): issue = f"【{category}】{issue}"
+    try: confidence = max(0.0, min(1.0, float(parts[-1])))
+    except ValueError: confidence = 0.0
+    return {"category": category, "risk_level": RISK_LEVELS[int(parts[0]) - 1], "issue": issue,
+            "regulation": parts[-3], "correction": parts[-2], "confidence": confidence}
+
+class CompactStreamParser:
+    """紧凑行格式的增量解析：每收到完整一行即产出一条；合并模式下首行的专家列表存入 roles"""
+    def __init__(self, role=None):
+        self.role = role
+        self.roles = []
+        self.buf = ""
+
+    def _line(self, line):
+        m = re.match(r'\s*专家\s*[:：]\s*(.+)', line)
+        if m:
+            self.roles = [r for r in re.split(r'[,，、\s]+', m.group(1)) if r in REGULATION_DB]
+            return None
+        return parse_compact_line(line, self.role)
+
+    def feed(self, chunk, final=False):
+        self.buf += chunk
+        *lines, self.buf = self.buf.split("\n")
+        if final: lines, self.buf = lines + [self.buf], ""
+        return [item for item in map(self._line, lines) if item]
+
+def parse_compact(text, role=None):
+    """解析紧凑行格式，返回 (roles, issues)；role 为 None 时为合并模式"""
+    parser = CompactStreamParser(role)
+    issues = parser.feed(text or "", final=True)
+    roles = parser.roles
+    if role is None and roles and "安全" not in roles: roles.append("安全")
+    return roles, issues
+
+def compact_parsed_ok(text, issues, finish_reason=None):
+    """紧凑格式结果可缓存：未因长度截断，且解析出问题或模型明确回答“无”"""
+    if finish_reason == "length": return False
+    return bool(issues) or re.search(r'(?m)^\s*无\s*$', text or "") is not None
+
+def parse_issues(text, role):
+    issues = []
+    try:
+        clean = text.replace("```json", "").replace("```", "").strip()
+        s, e = clean.find('['), clean.rfind(']') + 1
+        if s == -1 or not e: raise ValueError("未找到完整 JSON 数组")
+        for item in json.loads(clean[s:e]):
+            if isinstance(item, dict):
+                item["category"] = role
+                issues.append(item)
+    except:
+        # 整体解析失败 (截断或个别条目损坏)：保留所有已完整的条目
+        issues = IssueStreamParser().feed(text or "")
+        for item in issues: item["category"] = role
+    return issues
+
+def parse_batch(text, role, n, fmt):
+    """解析多图专家输出，返回 (按图片分组的问题, 格式是否完好)。
+    与单图不同，这里不抢救局部结果：JSON 不完整、图号缺失或越界都判为格式错误，由调用方拆分重试"""
+    groups = [[] for _ in range(n)]
+    if fmt == "compact":
+        for line in (text or "").splitlines():
+            m = re.match(r'\s*(?:[-*•]\s*)?图?\s*(\d+)\s*\|(.*)', line)
+            item = m and parse_compact_line(m.group(2), role)
+            if not item: continue
+            idx = int(m.group(1)) - 1
+            if not 0 <= idx < n: return groups, False
+            groups[idx].append(item)
+        return groups, compact_parsed_ok(text, [i for g in groups for i in g])
+    try:
+        clean = (text or "").replace("```json", "").replace("```", "").strip()
+        start = min((i for i in (clean.find('['), clean.find('{')) if i >= 0), default=-1)
+        obj = json.JSONDecoder().raw_decode(clean, start)[0] if start >= 0 else None
+        items = obj.get("issues") if isinstance(obj, dict) else obj
+        if not isinstance(items, list): return groups, False
+        for item in items:
+            if not isinstance(item, dict): continue
+            idx = int(item.pop("image")) - 1
+            if not 0 <= idx < n: return groups, False
+            item["category"] = role
+            groups[idx].append(item)
+    except (ValueError, KeyError, TypeError):
+        return groups, False
+    return groups, True
+
+
+# ==================== 调用埋点 ====================
+def payload_bytes(messages):
+    """请求体中文本与图片 data URL 的字节数 (近似实际上传量)"""
+    n = 0
+    for m in messages:
+        parts = m["content"] if isinstance(m["content"], list) else [{"type": "text", "text": m["content"]}]
+        for part in parts:
+            n += len(part["image_url"]["url"]) if part.get("type") == "image_url" else len(part.get("text", "").encode("utf-8"))
+    return n
+
+class CallRecorder:
+    """记录每次模型调用：上传字节、首字节时间、耗时、token、重试次数、解析是否成功；
+    按任务/角色/厂商聚合，可导出为 JSON"""
+    def __init__(self, max_calls=20000):
+        self.calls = deque(maxlen=max_calls)
+        self._lock = threading.Lock()
+
+    def record(self, rec):
+        rec.setdefault("ts", time.time())
+        with self._lock: self.calls.append(rec)
+
+    def clear(self):
+        with self._lock: self.calls.clear()
+
+    @staticmethod
+    def _pct(values, q):
+        if not values: return 0.0
+        values = sorted(values)
+        return values[max(0, math.ceil(q * len(values)) - 1)]  # nearest-rank
+
+    def aggregate(self, by):
+        """by 为 "task" / "role" / "provider"，返回 {键: 汇总指标}；
+        按任务汇总时以 task_id 为键 (不同目录下的同名照片不合并)，name 为显示名；
+        多图调用 (rec["batch"]) 按成员均摊：调用数、token、上传字节等累加量各计 1/n，耗时各成员都计"""
+        with self._lock: calls = list(self.calls)
+        groups = {}
+        for c in calls:
+            if by == "task":
+                members = c.get("batch") or [{"task_id": c.get("task_id", ""), "task": c.get("task", "")}]
+                for m in members: groups.setdefault(m["task_id"], []).append((dict(c, task=m["task"]), 1 / len(members)))
+            else: groups.setdefault(c.get(by, ""), []).append((c, 1))
+        out = {}
+        for key, cs in groups.items():
+            ok = [(c, w) for c, w in cs if c.get("ok")]
+            lat, ttfb = [c["latency"] for c, _ in ok], [c["ttfb"] for c, _ in ok if c.get("ttfb") is not None]
+            total = lambda items, f: sum(f(c) * w for c, w in items)
+            out[key] = {"name": cs[0][0].get(by, "") or str(key),
+                "calls": total(cs, lambda c: 1), "errors": total(cs, lambda c: not c.get("ok")), "retries": total(cs, lambda c: c.get("retries", 0)),
+                "parse_fail": total(ok, lambda c: c.get("parse_ok") is False),
+                "hedged": total(cs, lambda c: bool(c.get("hedged"))), "failover": total(cs, lambda c: c.get("failover", 0)),
+                "latency_avg": sum(lat) / len(lat) if lat else 0.0, "latency_p95": self._pct(lat, 0.95),
+                "ttfb_avg": sum(ttfb) / len(ttfb) if ttfb else 0.0,
+                "wait_avg": sum(c.get("total", 0) - c.get("latency", 0) for c, _ in ok) / len(ok) if ok else 0.0,
+                "upload_bytes": total(cs, lambda c: c.get("upload_bytes", 0)),
+                "prompt_tokens": total(ok, lambda c: c.get("prompt_tokens", 0)),
+                "completion_tokens": total(ok, lambda c: c.get("completion_tokens", 0)),
+            }
+        return out
+
+    def export(self, path):
+        with self._lock: calls = list(self.calls)
+        data = {"exported_at": time.strftime("%Y-%m-%d %H:%M:%S"), "by_provider": self.aggregate("provider"),
+                "by_role": self.aggregate("role"), "by_task": self.aggregate("task"), "calls": calls}
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=2, ensure_ascii=False)
+        return path
+
+METRICS = CallRecorder()
+
+# ==================== 会话存储 ====================
+class SqliteStore:
+    """SQLite (WAL) 存储基类：单连接跨线程共享，写操作经 _write 在一个事务中提交"""
+    SCHEMA = ""
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")  # WAL 下仍可防止数据库损坏，仅可能丢失最后一次提交
+        self.db.executescript(self.SCHEMA)
+
+    def _write(self, *statements):
+        """在一个事务中执行若干 (sql, 参数) 语句"""
+        with self._lock:
+            self.db.execute("BEGIN")
+            try:
+                for sql, args in statements:
+                    if args and isinstance(args[0], (list, tuple)): self.db.executemany(sql, args)
+                    else: self.db.execute(sql, args)
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+
+class SessionStore(SqliteStore):
+    """任务、每个角色调用的结果与问题 (含人工修改) 随分析进度增量写入 SQLite (WAL)，
+    进程被杀或重启后恢复会话；中断的任务重新提交时只补做未完成的角色调用"""
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS tasks (id TEXT PRIMARY KEY, path TEXT, name TEXT, status TEXT, digest TEXT, meta TEXT);
+        CREATE TABLE IF NOT EXISTS stages (task_id TEXT, stage TEXT, digest TEXT, result TEXT, PRIMARY KEY (task_id, stage));
+        CREATE TABLE IF NOT EXISTS issues (task_id TEXT, pos INTEGER, item TEXT, PRIMARY KEY (task_id, pos));
+    """
+    META_KEYS = ("error", "roles", "metrics", "bytes_saved", "cache_hits", "phash", "dup_of", "dup_dist", "scene")
+
+    def __init__(self, path=SESSION_DB):
+        super().__init__(path)
+
+    def _task_row(self, task):
+        meta = json.dumps({k: task[k] for k in self.META_KEYS if k in task}, ensure_ascii=False)
+        return ("INSERT INTO tasks (id, path, name, status, digest, meta) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET status=excluded.status, digest=excluded.digest, meta=excluded.meta",
+                (task['id'], task['path'], task['name'], task['status'], task.get('digest'), meta))
+
+    def _issue_rows(self, task):
+        rows = [(task['id'], i, json.dumps(item, ensure_ascii=False)) for i, item in enumerate(task.get('data') or [])]
+        return [("DELETE FROM issues WHERE task_id=?", (task['id'],))] + ([("INSERT INTO issues VALUES (?, ?, ?)", rows)] if rows else [])
+
+    def save_task(self, task):
+        """保存任务状态；完成时一并写入问题并丢弃已不需要的角色中间结果"""
+        statements = [self._task_row(task)]
+        if task['status'] == 'done':
+            statements += self._issue_rows(task) + [("DELETE FROM stages WHERE task_id=?", (task['id'],))]
+        self._write(*statements)
+
+    def save_issues(self, task):
+        """人工编辑/删除问题后覆盖该任务的问题列表"""
+        self._write(*self._issue_rows(task))
+
+    def put_stage(self, task, stage, result):
+        self._write(("INSERT OR REPLACE INTO stages VALUES (?, ?, ?, ?)",
+                     (task['id'], stage, task.get('digest'), json.dumps(result, ensure_ascii=False))))
+
+    def stages(self, task):
+        """该任务已完成的分诊/专家结果；图片内容变化后作废"""
+        with self._lock:
+            rows = self.db.execute("SELECT stage, result FROM stages WHERE task_id=? AND digest=?", (task['id'], task.get('digest'))).fetchall()
+        return {stage: json.loads(result) for stage, result in rows}
+
+    def load(self):
+        """按加入顺序恢复任务；中断时仍在分析/排队的任务恢复为 waiting 并标记 interrupted"""
+        with self._lock:
+            rows = self.db.execute("SELECT id, path, name, status, digest, meta FROM tasks ORDER BY rowid").fetchall()
+            issues = {}
+            for task_id, item in self.db.execute("SELECT task_id, item FROM issues ORDER BY task_id, pos"):
+                issues.setdefault(task_id, []).append(json.loads(item))
+        tasks = []
+        for task_id, path, name, status, digest, meta in rows:
+            task = {"id": task_id, "path": path, "name": name, "status": status, "digest": digest, "data": None, **json.loads(meta or "{}")}
+            if status == 'done': task['data'] = issues.get(task_id, [])
+            elif status == 'analyzing': task['status'], task['interrupted'] = 'waiting', True
+            if task['status'] != 'done' and not os.path.exists(path):
+                task['status'], task['error'] = 'error', "原图已不存在"
+                task.pop('interrupted', None)
+            tasks.append(task)
+        return tasks
+
+    def remove_task(self, task):
+        self._write(*[(f"DELETE FROM {table} WHERE {col}=?", (task['id'],)) for table, col in (("tasks", "id"), ("stages", "task_id"), ("issues", "task_id"))])
+
+    def clear(self):
+        self._write(("DELETE FROM tasks", ()), ("DELETE FROM stages", ()), ("DELETE FROM issues", ()))
+
+class HistoryArchive(SqliteStore):
+    """历史检查记录：每张完成分析的照片 (含缩略图) 与其问题长期保存，清空会话不受影响。
+    中文全文检索：问题文本按字二元组 (与条文库同一切分) 写入 FTS5，检索词转为二元组短语，
+    因此两个字的词 (如“临边”) 也能命中；另存单字列供“梁”“柱”这类单字检索。
+    问题 id 按首次分析顺序分配、修改时沿用，按 id 倒序即按时间倒序，可直接沿 FTS 的 rowid 取前 N 条。
+    SQLite 未编译 FTS5 时退化为 LIKE"""
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS photos (id INTEGER PRIMARY KEY, task_id TEXT UNIQUE, path TEXT, name TEXT, digest TEXT, scene TEXT,
+                                           analyzed_at REAL, thumb BLOB);
+        CREATE TABLE IF NOT EXISTS issues (id INTEGER PRIMARY KEY, photo_id INTEGER, risk_level TEXT, category TEXT, issue TEXT,
+                                           regulation TEXT, correction TEXT, confidence REAL, created REAL);
+        CREATE INDEX IF NOT EXISTS issues_photo ON issues (photo_id);
+        CREATE INDEX IF NOT EXISTS issues_created ON issues (created);
+    """
+    FIELDS = ("risk_level", "category", "issue", "regulation", "correction", "confidence")
+
+    def __init__(self, path=HISTORY_DB):
+        super().__init__(path)
+        try:
+            self.db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS issues_fts USING fts5(terms, chars, tokenize='unicode61')")
+            self.fts = True
+        except sqlite3.OperationalError:
+            self.fts = False
+
+    @staticmethod
+    def _terms(item):
+        """(二元组, 单字)：单字列只收汉字并去重"""
+        text = " ".join(str(item.get(k) or "") for k in ("category", "issue", "regulation", "correction"))
+        return " ".join(tokenize(text)), " ".join(dict.fromkeys(re.findall(r'[\u4e00-\u9fff]', text)))
+
+    def record(self, task, thumb_b64=None):
+        """写入 (或在人工修改后覆盖) 一张已完成照片的问题；首次分析时间保持不变"""
+        if task['status'] != 'done' or task.get('dup_of'): return
+        now = time.time()
+        thumb = base64.b64decode(thumb_b64) if thumb_b64 else None
+        with self._lock:
+            self.db.execute("BEGIN")
+            try:
+                self.db.execute("INSERT INTO photos (task_id, path, name, digest, scene, analyzed_at, thumb) VALUES (?, ?, ?, ?, ?, ?, ?) "
+                                "ON CONFLICT(task_id) DO UPDATE SET digest=excluded.digest, scene=excluded.scene, thumb=coalesce(excluded.thumb, thumb)",
+                                (task['id'], task['path'], task['name'], task.get('digest'), task.get('scene'), now, thumb))
+                photo_id, created = self.db.execute("SELECT id, analyzed_at FROM photos WHERE task_id=?", (task['id'],)).fetchone()
+                old = [r[0] for r in self.db.execute("SELECT id FROM issues WHERE photo_id=? ORDER BY id", (photo_id,))]
+                if self.fts: self.db.executemany("DELETE FROM issues_fts WHERE rowid=?", [(i,) for i in old])
+                self.db.execute("DELETE FROM issues WHERE photo_id=?", (photo_id,))
+                for pos, item in enumerate(task.get('data') or []):
+                    cur = self.db.execute(f"INSERT INTO issues (id, photo_id, {', '.join(self.FIELDS)}, created) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                          (old[pos] if pos < len(old) else None, photo_id, *(item.get(k) for k in self.FIELDS), created))
+                    if self.fts: self.db.execute("INSERT INTO issues_fts (rowid, terms, chars) VALUES (?, ?, ?)", (cur.lastrowid, *self._terms(item)))
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def _match(self, query):
+        """检索词 (空格分隔，须全部命中) 转为 FTS5 表达式；无 FTS5 时返回 LIKE 条件"""
+        phrases, where, args = [], [], []
+        for term in query.split():
+            if not self.fts:
+                where.append("(i.issue LIKE ? OR i.regulation LIKE ? OR i.correction LIKE ?)")
+                args += [f"%{term}%"] * 3
+                continue
+            toks = tokenize(term)
+            if len(toks) == 1 and len(toks[0]) == 1 and toks[0] >= '\u4e00': phrases.append(f'chars : "{toks[0]}"')
+            elif toks: phrases.append('terms : "' + " ".join(toks) + '"')
+        return " AND ".join(phrases), where, args
+
+    def search(self, query="", level=None, category=None, since=None, limit=50, offset=0):
+        """按检索词/风险等级/类别/起始时间查询，按时间倒序；返回 (总数, [问题 dict (含 photo_id/name/path/analyzed_at)...])"""
+        match, where, args = self._match(query)
+        for cond, value in (("i.risk_level=?", level), ("i.category=?", category), ("i.created>=?", since)):
+            if value is not None: where.append(cond); args.append(value)
+        # 有检索词时以 FTS 为驱动表并按其 rowid 排序，取前 N 条不必物化全部命中；无其他条件时总数直接在 FTS 上数
+        source, order = ("issues_fts f JOIN issues i ON i.id = f.rowid", "f.rowid") if match else ("issues i", "i.id")
+        count_from = "issues_fts" if match and not where else source
+        if match: where, args = ["issues_fts MATCH ?"] + where, [match] + args
+        sql_where = f"WHERE {' AND '.join(where)}" if where else ""
+        with self._lock:
+            total = self.db.execute(f"SELECT count(*) FROM {count_from} {sql_where}", args).fetchone()[0]
+            rows = self.db.execute(f"SELECT i.{', i.'.join(self.FIELDS)}, i.id, p.id, p.name, p.path, p.analyzed_at FROM {source} "
+                                   f"JOIN photos p ON p.id = i.photo_id {sql_where} ORDER BY {order} DESC LIMIT ? OFFSET ?",
+                                   args + [limit, offset]).fetchall()
+        keys = self.FIELDS + ("id", "photo_id", "name", "path", "analyzed_at")
+        return total, [dict(zip(keys, r)) for r in rows]
+
+    def thumb(self, photo_id):
+        with self._lock:
+            row = self.db.execute("SELECT thumb FROM photos WHERE id=?", (photo_id,)).fetchone()
+        return base64.b64encode(row[0]).decode() if row and row[0] else ""
+
+    def __len__(self):
+        with self._lock:
+            return self.db.execute("SELECT count(*) FROM issues").fetchone()[0]
+
+    def clear(self):
+        self._write(("DELETE FROM photos", ()), ("DELETE FROM issues", ()), *([("DELETE FROM issues_fts", ())] if self.fts else []))
+
+# ==================== 问题索引 ====================
+class IssueIndex:
+    """已完成任务的问题索引：每条问题分配稳定 id，按风险等级分桶 (桶内保持加入顺序)，
+    等级/类别计数随增删改增量维护；汇总页按页读取，删除只触及所属任务"""
+    def __init__(self):
+        self._seq = itertools.count(1)
+        self._lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}      # iid -> [task, item, level, category]
+            self._iids = {}         # id(item) -> iid
+            self._buckets = {lvl: OrderedDict() for lvl in RISK_LEVELS}
+            self._by_task = {}      # task id -> [iid]
+            self._counts = Counter()  # (level, category) -> n
+
+    @staticmethod
+    def _key(item):
+        lvl = item.get("risk_level")
+        return (lvl if lvl in RISK_LEVELS else RISK_LEVELS[-1]), item.get("category", "")
+
+    def _add(self, task, item):
+        iid = next(self._seq)
+        level, cat = self._key(item)
+        self._entries[iid] = [task, item, level, cat]
+        self._iids[id(item)] = iid
+        self._buckets[level][iid] = None
+        self._by_task.setdefault(task['id'], []).append(iid)
+        self._counts[(level, cat)] += 1
+
+    def _drop(self, iid):
+        task, item, level, cat = self._entries.pop(iid)
+        del self._iids[id(item)]
+        del self._buckets[level][iid]
+        self._counts[(level, cat)] -= 1
+        return task, item
+
+    def set_task(self, task):
+        """任务完成 (或重新分析) 后同步其全部问题"""
+        with self._lock:
+            self.remove_task(task)
+            if task['status'] == 'done':
+                for item in task.get('data') or []: self._add(task, item)
+
+    def remove_task(self, task):
+        with self._lock:
+            for iid in self._by_task.pop(task['id'], []):
+                if iid in self._entries: self._drop(iid)
+
+    def update(self, item):
+        """问题被编辑后调整其等级/类别归属，保持原 id；返回所属任务"""
+        with self._lock:
+            iid = self._iids.get(id(item))
+            if iid is None: return None
+            entry = self._entries[iid]
+            level, cat = self._key(item)
+            if (level, cat) == (entry[2], entry[3]): return entry[0]
+            self._counts[(entry[2], entry[3])] -= 1
+            self._counts[(level, cat)] += 1
+            if level != entry[2]:
+                del self._buckets[entry[2]][iid]
+                self._buckets[level][iid] = None
+            entry[2], entry[3] = level, cat
+            return entry[0]
+
+    def delete(self, item):
+        """删除问题：同时从所属任务的 data 中移除；返回所属任务"""
+        with self._lock:
+            iid = self._iids.get(id(item))
+            if iid is None: return None
+            task, _ = self._drop(iid)
+            task['data'] = [x for x in task['data'] if x is not item]
+            return task
+
+    def count(self, level=None, category=None):
+        with self._lock:
+            return sum(n for (lvl, cat), n in self._counts.items()
+                       if (level is None or lvl == level) and (category is None or cat == category))
+
+    def categories(self):
+        with self._lock:
+            cats = Counter()
+            for (_, cat), n in self._counts.items(): cats[cat] += n
+            return {c: n for c, n in cats.items() if n > 0}
+
+    def query(self, level=None, category=None, offset=0, limit=None):
+        """按风险优先级返回 [(iid, task, item)]，支持等级/类别过滤与分页"""
+        out = []
+        with self._lock:
+            for lvl in RISK_LEVELS:
+                if level is not None and lvl != level: continue
+                for iid in self._buckets[lvl]:
+                    task, item, _, cat = self._entries[iid]
+                    if category is not None and cat != category: continue
+                    if offset > 0:
+                        offset -= 1
+                        continue
+                    out.append((iid, task, item))
+                    if limit is not None and len(out) >= limit: return out
+        return out
+
+    def __len__(self):
+        return len(self._entries)
+
+# ==================== 分析引擎 ====================
+def provider_key(config, name):
+    """各厂商分别保存的 API Key；旧配置只有 api_key 时归当前厂商"""
+    keys = config.get("api_keys", {})
+    if name in keys: return keys[name]
+    return config.get("api_key", "") if name == config.get("current_provider", "阿里百炼 (Qwen2.5-VL)") else ""
+
+def build_backend(config, name):
+    p_conf = PROVIDER_PRESETS.get(name, {})
+    limits = config.get("rate_limits", {}).get(name, {})
+    return {"provider": name, "api_key": provider_key(config, name), "base_url": p_conf.get("base_url"), "model": p_conf.get("model"),
+            "response_format": p_conf.get("response_format"),
+            "limiter": get_limiter(name, limits.get("rpm", p_conf.get("rpm", 60)), limits.get("tpm", p_conf.get("tpm", 100000)))}
+
+def build_run(config, prompt_name=None):
+    """根据配置生成一次分析批次的运行参数 (厂商、模型、上传、限流等)。
+    开启多厂商时 backends 为 [当前厂商, 其余已配置 Key 的厂商...]，用于故障转移与对冲"""
+    p_name = config.get("current_provider", "阿里百炼 (Qwen2.5-VL)")
+    primary = build_backend(config, p_name)
+    backends = [primary]
+    if config.get("multi_provider"):
+        backends += [build_backend(config, n) for n in PROVIDER_PRESETS if n != p_name and provider_key(config, n)]
+    formats = {b["response_format"] for b in backends}   # 结构化输出取所有厂商都支持的格式
+    return {
+        "provider": p_name, "api_key": primary["api_key"], "base_url": primary["base_url"], "model": primary["model"],
+        "backends": backends if len(backends) > 1 else None, "hedge": config.get("hedge_requests", False),
+        "http": (config.get("http_pool_size", HTTP_POOL_SIZE), config.get("http_timeout", HTTP_TIMEOUT)),
+        "prompt_text": config.get("prompts", DEFAULT_PROMPTS).get(prompt_name or config.get("last_prompt", ""), ""),
+        "upload": (config.get("upload_max_edge", UPLOAD_MAX_EDGE), config.get("upload_quality", UPLOAD_QUALITY), config.get("router_max_edge", ROUTER_MAX_EDGE)),
+        "speculative": config.get("speculative_safety", True),
+        "mode": config.get("pipeline_mode", "staged"),
+        "structured": config.get("output_format", "free") == "structured",
+        "response_format": None if None in formats else "json_schema" if formats == {"json_schema"} else "json_object",
+        "streaming": config.get("streaming", True),
+        "clause_budget": config.get("clause_budget", CLAUSE_TOKEN_BUDGET),
+        "batch_images": config.get("batch_images", BATCH_IMAGES),
+        "batch_tokens": config.get("batch_tokens", BATCH_MAX_TOKENS),
+        "limiter": primary["limiter"],
+    }
+
+def new_task(path, name=None):
+    name = name or os.path.basename(path)
+    return {"id": f"{time.time()}_{name}", "path": path, "name": name, "status": "waiting", "data": None}
+
+class InspectionEngine:
+    """与界面无关的分诊/专家流水线。任务为 dict，进度通过回调通知：
+    on_progress(task) 进度文字变化；on_issue(task, item) 流式条目到达；on_done(task) 任务结束 (done/error)。
+    提供 store (SessionStore) 时任务状态与每个角色的结果随进度落盘，重新提交中断的任务时跳过已完成的角色"""
+    def __init__(self, workers=MAX_WORKERS, on_progress=None, on_issue=None, on_done=None, recorder=METRICS, store=None):
+        self.scheduler = AnalysisScheduler(workers)
+        self.recorder = recorder
+        self.store = store
+        self.on_progress = on_progress or (lambda task: None)
+        self.on_issue = on_issue or (lambda task, item: None)
+        self.on_done = on_done or (lambda task: None)
+
+    @property
+    def pending(self):
+        return self.scheduler.pending
+
+    def submit(self, task, run):
+        task['status'] = 'analyzing'
+        task['progress_msg'] = "⏳ 排队中..."
+        if self.store: self.store.save_task(task)
+        self.scheduler.submit(self._run, task, run)
+
+    def cancel_pending(self):
+        """取消排队中的任务并恢复为 waiting，返回被取消的任务"""
+        cancelled = [task for task, _ in self.scheduler.cancel_pending()]
+        for task in cancelled:
+            task['status'] = 'waiting'
+            task.pop('progress_msg', None)
+            if self.store: self.store.save_task(task)
+        return cancelled
+
+    def _run(self, task, run):
+        try:
+            self.analyze(task, run)
+            if self.store: self.store.save_task(task)
+        finally: self.on_done(task)
+
+    def _progress(self, task, msg):
+        task['progress_msg'] = msg
+        self.on_progress(task)
+
+    def analyze(self, task, run):
+        """同步分析一张图片，结果写回 task (status/data/roles/metrics/error)"""
+        backends = run.get("backends") or [{k: run.get(k) for k in ("provider", "base_url", "api_key", "model", "response_format", "limiter")}]
+        clients, lock = {}, threading.Lock()
+        hedges = []     # 对冲调用的 future；落败者可能在任务结束后仍在使用连接
+        try:
+            model = run["model"]    # 结果缓存按主厂商模型区分
+            digest = task['digest'] = file_digest(task['path'])
+            resumed = self.store.stages(task) if self.store else {}   # 上次中断前已完成的分诊/专家结果
+            orig_bytes = os.path.getsize(task['path'])
+            stats = {"bytes": 0, "hits": 0, "calls": 0, "prompt_tokens": 0, "completion_tokens": 0}
+            up_box = []
+            t0 = time.monotonic()
+
+            def client_for(b):
+                with lock:
+                    if b["provider"] not in clients:
+                        clients[b["provider"]] = CLIENTS.acquire(b["provider"], b["base_url"], b["api_key"], *run["http"])
+                    return clients[b["provider"]]
+
+            def upload(key):
+                """仅在需要联网时才做上传预处理，全部命中缓存则不读图"""
+                with lock:
+                    if not up_box: up_box.append(prepare_upload(task['path'], *run["upload"]))
+                    stats["bytes"] += up_box[0]["router_bytes" if key == "router_url" else "sent_bytes"]
+                    return up_box[0][key]
+
+            def bump(**kw):
+                with lock:
+                    for k, v in kw.items(): stats[k] += v or 0
+
+            def say(msg):
+                self._progress(task, msg)
+
+            def live_issue(item, category=None, retract=False):
+                """流式产出的条目即时加入 task['data']；重试前撤回本次已产出的条目"""
+                with lock:
+                    if retract:
+                        task['data'] = [x for x in task['data'] if x is not item]
+                    else:
+                        if category: item["category"] = category
+                        elif item.get("category") not in REGULATION_DB: item["category"] = "安全"
+                        task['data'].append(item)
+                    task['progress_msg'] = f"📡 已收到 {len(task['data'])} 个问题..."
+                self.on_issue(task, item)
+
+            def stream_completion(b, category, rec, fmt, **kw):
+                """流式调用：返回 (全文, usage, 已解析条目, finish_reason)"""
+                parser = CompactStreamParser(category or None) if fmt == "compact" else IssueStreamParser()
+                items, parts, usage, finish_reason = [], [], None, None
+                try:
+                    for chunk in client_for(b).chat.completions.create(model=b["model"], stream=True, stream_options={"include_usage": True}, **kw):
+                        if getattr(chunk, "usage", None): usage = chunk.usage
+                        if chunk.choices: finish_reason = getattr(chunk.choices[0], "finish_reason", None) or finish_reason
+                        delta = chunk.choices[0].delta.content if chunk.choices else None
+                        if not delta: continue
+                        if not parts: rec["ttfb"] = time.monotonic() - rec["_start"]
+                        parts.append(delta)
+                        for item in parser.feed(delta):
+                            items.append(item)
+                            live_issue(item, category)
+                    if fmt == "compact":
+                        for item in parser.feed("", final=True):
+                            items.append(item)
+                            live_issue(item, category)
+                except Exception:
+                    for item in items: live_issue(item, retract=True)
+                    raise
+                return types.SimpleNamespace(text="".join(parts), usage=usage, items=items, finish_reason=finish_reason)
+
+            def chat(label, role, max_out, stream_category=None, fmt="json", members=None, **kw):
+                """发起一次调用并生成埋点记录 rec；stream_category 非 None 时走流式 (""=由模型给出 category)。
+                members 为多图调用的各成员 (含 bump/progress)，进度发给每个成员，调用次数与 token 按成员均摊。
+                成功时返回 (resp, rec)，调用方补充 parse_ok 后调用 finish(rec)"""
+                audience = members or [{"bump": bump, "progress": say}]
+                def notify(msg):
+                    for m in audience: m["progress"](msg)
+                rec = {"task": task['name'], "task_id": task['id'], "role": role, "provider": run["provider"], "model": model,
+                       "stream": stream_category is not None, "format": fmt, "upload_bytes": payload_bytes(kw["messages"]),
+                       "retries": 0, "ok": False, "parse_ok": None, "ttfb": None, "hedged": False, "failover": 0}
+                est = estimate_tokens(kw["messages"], max_out)
+                def on_retry(n, delay, err):
+                    rec["retries"] = n
+                    notify(f"⚠️ {label}重试 {n}/{RETRY_MAX}（{delay:.0f}s 后）")
+                def call_on(b):
+                    """在指定厂商上调用一次 (经该厂商的限流)，并记录其耗时/成败"""
+                    b["limiter"].acquire(est)
+                    t = time.monotonic()
+                    try:
+                        if stream_category is None: resp = client_for(b).chat.completions.create(model=b["model"], **kw)
+                        else: resp = stream_completion(b, stream_category, rec, fmt, **kw)
+                    except Exception as e:
+                        if is_retryable(e): HEALTH.record(b["provider"], False)
+                        e.failed_provider = b["provider"]
+                        raise
+                    HEALTH.record(b["provider"], True, time.monotonic() - t)
+                    b["limiter"].settle(est, getattr(getattr(resp, "usage", None), "total_tokens", 0))
+                    return resp
+                def won(b, resp):
+                    rec["provider"], rec["model"] = b["provider"], b["model"]
+                    return resp
+                def failover(order):
+                    """可重试的错误立即换下一个厂商，全部失败才交给 call_with_retry 退避"""
+                    for i, b in enumerate(order):
+                        try: return won(b, call_on(b))
+                        except Exception as e:
+                            if i == len(order) - 1 or not is_retryable(e): raise
+                            rec["failover"] += 1
+                            notify(f"🔀 {b['provider']} 异常，切换到 {order[i + 1]['provider']}")
+                def hedged(order):
+                    """主厂商超过其 P95 仍未返回时向备用厂商发出相同请求，取先成功者 (另一个在后台完成后丢弃)"""
+                    primary, backup = order[0], order[1]
+                    p95 = HEALTH.p95(primary["provider"])
+                    futures = {HEDGE_POOL.submit(call_on, primary): primary}
+                    hedges.extend(futures)
+                    done, _ = wait(futures, timeout=max(run.get("hedge_min_delay", HEDGE_MIN_DELAY), p95) if p95 else None)
+                    if not done:
+                        rec["hedged"] = True
+                        notify(f"⏱ {primary['provider']} 响应慢，同时请求 {backup['provider']}")
+                        f = HEDGE_POOL.submit(call_on, backup)
+                        futures[f] = backup
+                        hedges.append(f)
+                    pending, error = set(futures), None
+                    while pending:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for f in done:
+                            if f.exception() is None: return won(futures[f], f.result())
+                            error = f.exception()
+                        if not pending and len(futures) == 1 and is_retryable(error):  # 未触发对冲即失败：故障转移
+                            rec["failover"] += 1
+                            f = HEDGE_POOL.submit(call_on, backup)
+                            futures[f], pending = backup, {f}
+                            hedges.append(f)
+                    raise error
+                def attempt():
+                    rec["_start"] = time.monotonic()  # 只计最后一次尝试；限流等待与重试计入 total
+                    order = HEALTH.order(backends)
+                    # 流式输出已边收边显示，不做对冲，只做故障转移
+                    if run.get("hedge") and stream_category is None and len(order) > 1: return hedged(order)
+                    return failover(order)
+                t_call = time.monotonic()
+                try:
+                    resp = call_with_retry(attempt, None, est, on_retry=on_retry)
+                except Exception as e:
+                    now = time.monotonic()
+                    rec.update(latency=now - rec.get("_start", t_call), total=now - t_call, error=str(e)[:200])
+                    rec["provider"] = getattr(e, "failed_provider", rec["provider"])
+                    finish(rec)
+                    raise
+                now = time.monotonic()
+                usage = getattr(resp, "usage", None)
+                rec.update(ok=True, latency=now - rec["_start"], total=now - t_call,
+                           prompt_tokens=getattr(usage, "prompt_tokens", 0) or 0, completion_tokens=getattr(usage, "completion_tokens", 0) or 0)
+                if rec["ttfb"] is None: rec["ttfb"] = rec["latency"]  # 非流式：整段生成完才返回首字节
+                share = 1 / len(audience)
+                for m in audience: m["bump"](calls=share, prompt_tokens=rec["prompt_tokens"] * share, completion_tokens=rec["completion_tokens"] * share)
+                return resp, rec
+
+            def finish(rec, parse_ok=None):
+                if parse_ok is not None: rec["parse_ok"] = parse_ok
+                rec.pop("_start", None)
+                self.recorder.record(rec)
+
+            structured = run.get("structured", False)
+
+            def role_limit(role):
+                return ROLE_OUTPUT_LIMITS.get(role, DEFAULT_OUTPUT_LIMIT) if structured else None
+
+            def variant(limit, budget):
+                """缓存键中的输出设置：结构化结果按条数截断，条文预算影响提示词"""
+                return f"{'structured' if structured else 'free'}:{limit['max_issues'] if limit else ''}:{budget}"
+
+            def ask(label, role, limit, stream_category, build, members=None):
+                """按输出格式发起调用，返回 (格式, resp, rec)。结构化模式优先 response_format，
+                厂商不支持或以 400 拒绝时改用紧凑行格式 (并记住该厂商)"""
+                fmt = "json"
+                if structured:
+                    supported = run.get("response_format") and not any(b["provider"] in NO_RESPONSE_FORMAT for b in backends)
+                    fmt = "object" if supported else "compact"
+                while True:
+                    try: return (fmt, *chat(label, role, limit, stream_category, fmt, members, **build(fmt)))
+                    except Exception as e:
+                        if fmt != "object" or getattr(e, "status_code", None) != 400: raise
+                        NO_RESPONSE_FORMAT.add(getattr(e, "failed_provider", run["provider"]))
+                        fmt = "compact"
+
+            def save_stage(stage, result):
+                if self.store: self.store.put_stage(task, stage, result)
+                return result
+
+            def expert_call(role, members):
+                """一次专家调用检查 members 中的全部图片 (多图时按图号归属)，按成员顺序返回 [(问题, 可缓存)...]"""
+                n = len(members)
+                kb = REGULATION_DB.get(role, REGULATION_DB["安全"])
+                limit = role_limit(role)
+                scene = members[0]["scene"] if n == 1 else "；".join(f"图{i} {m['scene']}" for i, m in enumerate(members, 1) if m["scene"])
+                clauses = role_clauses(role, scene, clause_budget) if clause_budget else ()
+                max_tokens = min(limit["max_tokens"] * n, BATCH_MAX_OUTPUT) if limit else 4096
+                def build(fmt):
+                    content = []
+                    for i, m in enumerate(members, 1):
+                        if n > 1: content.append({"type": "text", "text": f"图{i}"})
+                        content.append({"type": "image_url", "image_url": {"url": m["url"]}})
+                    ask_text = "请逐张分析图片，找出所有问题并标注图号。" if n > 1 else "请分析图片，找出所有问题。"
+                    content.append({"type": "text", "text": ask_text + ("按紧凑行格式输出。" if fmt == "compact" else "输出 JSON 对象。" if fmt == "object" else "输出 JSON 数组。")})
+                    kw = {"temperature": 0.3, "max_tokens": max_tokens,
+                          "messages": [{"role": "system", "content": build_ai_prompt(role, kb, fmt, limit and limit["max_issues"], clauses, scene, n)},
+                                       {"role": "user", "content": content}]}
+                    if fmt == "object": kw["response_format"] = response_format_for(run["response_format"], batched=n > 1)
+                    return kw
+                stream = streaming and n == 1 and members[0]["task"] is task   # 多图或代其他图片调用时不流式展示
+                label = f"{role}专家" + (f"×{n}" if n > 1 else "")
+                fmt, resp, rec = ask(label, role, (limit["max_tokens"] if limit else 800) * n, role if stream else None, build, members)
+                if n > 1:
+                    rec["images"] = n
+                    rec["batch"] = [{"task_id": m["task"]['id'], "task": m["task"]['name']} for m in members]
+                    groups, parsed = parse_batch(resp.choices[0].message.content, role, n, fmt)
+                    if resp.choices[0].finish_reason == "length": parsed = False   # 输出被截断，靠后的图片结果不全
+                else:
+                    if stream: text, issues, finish_reason = resp.text, resp.items, resp.finish_reason
+                    else:
+                        text, finish_reason = resp.choices[0].message.content, resp.choices[0].finish_reason
+                        issues = parse_compact(text, role)[1] if fmt == "compact" else parse_issues(text, role)
+                    parsed = (compact_parsed_ok if fmt == "compact" else issues_parsed_ok)(text, issues, finish_reason)
+                    groups = [issues]
+                finish(rec, parsed)
+                if limit: groups = [g[:limit["max_issues"]] for g in groups]
+                return [(g, parsed) for g in groups]
+
+            def run_batch(role, members):
+                """多图调用输出格式错误 (图号缺失/越界、JSON 不完整、被截断) 时对半拆分重试，直到单张"""
+                results = expert_call(role, members)
+                if len(members) == 1 or results[0][1]: return results
+                half = len(members) // 2
+                for m in members: m["progress"](f"✂️ {role}专家多图输出异常，拆分为 {half}+{len(members) - half} 张重试")
+                return run_batch(role, members[:half]) + run_batch(role, members[half:])
+
+            def run_expert(role, scene=""):
+                if role in resumed: return resumed[role]
+                key = variant(role_limit(role), clause_budget)
+                cached = RESULT_CACHE.get(digest, role, model, key)
+                if cached is not None:
+                    bump(hits=1)
+                    return save_stage(role, cached)
+                member = {"task": task, "url": upload("url"), "scene": scene, "bump": bump, "progress": say}
+                if batch_images > 1:
+                    say(f"📦 {role}专家等待与其他图片合并调用...")
+                    limit = role_limit(role)
+                    member["tokens"] = IMAGE_TOKENS + (limit["max_tokens"] if limit else 800)
+                    batch_key = (run["provider"], run["base_url"], model, role, structured, run.get("response_format"), clause_budget)
+                    issues, parsed = BATCHER.join(batch_key, member, batch_images, run.get("batch_tokens", BATCH_MAX_TOKENS), lambda members: run_batch(role, members))
+                else:
+                    issues, parsed = expert_call(role, [member])[0]
+                if not parsed: return issues     # 截断/损坏时抢救的局部结果只展示，不缓存也不存入会话，下次重新调用
+                RESULT_CACHE.put(digest, role, model, issues, key)
+                return save_stage(role, issues)
+
+            def run_staged():
+                """分级模式：分诊 + 各专家并行，每位专家一次调用"""
+                # 投机模式："安全"专家必然入选，与分诊并行发出 (此时尚无场景描述，按职责检索条文)
+                futures = {"安全": EXPERT_POOL.submit(run_expert, "安全")} if run.get("speculative", True) else {}
+                try: return staged_experts(futures)
+                except BaseException:
+                    # 分诊或任一专家失败：取消未开始的调用并等待进行中的结束，
+                    # 避免其在任务已判失败、连接已释放后仍写入 task['data'] 与缓存
+                    for f in futures.values(): f.cancel()
+                    wait(futures.values())
+                    raise
+
+            def staged_experts(futures):
+                """分诊后补发其余专家并等待全部完成"""
+                self._progress(task, "🔍 智能分诊中...")
+
+                routed = resumed.get(ResultCache.ROUTER) or RESULT_CACHE.get(digest, ResultCache.ROUTER, model)
+                if routed is None:
+                    rr, rec = chat("分诊", "分诊", 100, temperature=0.1,
+                        messages=[{"role": "system", "content": ROUTER_PROMPT},
+                                  {"role": "user", "content": [
+                                      {"type": "image_url", "image_url": {"url": upload("router_url")}},
+                                      {"type": "text", "text": "请分析施工内容并选派专家"}]}])
+                    routed = parse_router(rr.choices[0].message.content)
+                    finish(rec, bool(routed["roles"]))
+                    if routed["roles"]: RESULT_CACHE.put(digest, ResultCache.ROUTER, model, routed)
+                elif ResultCache.ROUTER not in resumed: bump(hits=1)
+                if isinstance(routed, list): routed = {"roles": routed, "scene": ""}  # 旧版会话只保存了专家列表
+                roles = [r for r in routed["roles"] if r in REGULATION_DB] or ["安全"]
+                # 分诊解析失败时的兜底 ["安全"] 不落盘，续跑时重新分诊
+                if ResultCache.ROUTER not in resumed and routed["roles"]: save_stage(ResultCache.ROUTER, {"roles": roles, "scene": routed["scene"]})
+                if "安全" not in roles: roles.append("安全")
+                task['scene'] = routed["scene"]
+
+                for role in roles:
+                    if role not in futures: futures[role] = EXPERT_POOL.submit(run_expert, role, routed["scene"])
+                self._progress(task, f"🔬 {len(roles)} 位专家并行分析中...")
+                for idx, f in enumerate(as_completed([futures[r] for r in roles]), 1):
+                    f.result()
+                    self._progress(task, f"🔬 专家分析 ({idx}/{len(roles)})")
+                return roles, [i for role in roles for i in futures[role].result()]
+
+            def run_combined():
+                """合并模式：分诊与全部专家在同一次调用中完成"""
+                limit = COMBINED_OUTPUT_LIMIT if structured else None
+                combined_variant = variant(limit, clause_budget and COMBINED_CLAUSE_BUDGET)
+                result = resumed.get(ResultCache.COMBINED)
+                if result is None:
+                    result = RESULT_CACHE.get(digest, ResultCache.COMBINED, model, combined_variant)
+                    if result is not None:
+                        bump(hits=1)
+                        save_stage(ResultCache.COMBINED, result)
+                if result is not None: return result["roles"], result["issues"]
+                self._progress(task, "🧠 合并分析中（分诊 + 全部专家）...")
+                def build(fmt):
+                    kw = {"temperature": 0.2, "max_tokens": limit["max_tokens"] if limit else 4096,
+                          "messages": [{"role": "system", "content": build_combined_prompt(fmt=fmt, max_issues=limit and limit["max_issues"], clause_budget=clause_budget and COMBINED_CLAUSE_BUDGET)},
+                                       {"role": "user", "content": [
+                                           {"type": "image_url", "image_url": {"url": upload("url")}},
+                                           {"type": "text", "text": "请先分诊选派专家，再由各专家找出所有问题。" + ("按紧凑行格式输出。" if fmt == "compact" else "输出 JSON 对象。")}]}]}
+                    if fmt == "object": kw["response_format"] = response_format_for(run["response_format"], combined=True)
+                    return kw
+                fmt, resp, rec = ask("合并分析", "合并", limit["max_tokens"] if limit else 1500, "" if streaming else None, build)
+                text, finish_reason = (resp.text, resp.finish_reason) if streaming else (resp.choices[0].message.content, resp.choices[0].finish_reason)
+                roles, issues = parse_compact(text) if fmt == "compact" else parse_combined(text)
+                if streaming and len(resp.items) > len(issues): issues = resp.items  # 截断时整体解析失败，保留已流式解析的条目
+                if limit: issues = issues[:limit["max_issues"]]
+                parsed = bool(roles) and finish_reason != "length"
+                finish(rec, parsed)
+                if parsed:
+                    RESULT_CACHE.put(digest, ResultCache.COMBINED, model, {"roles": roles, "issues": issues}, combined_variant)
+                    save_stage(ResultCache.COMBINED, {"roles": roles, "issues": issues})
+                return roles or ["安全"], issues
+
+            mode = run.get("mode", "staged")
+            streaming = run.get("streaming", False)
+            clause_budget = run.get("clause_budget", CLAUSE_TOKEN_BUDGET)
+            batch_images = run.get("batch_images", BATCH_IMAGES) if mode == "staged" else 1
+            task['data'] = []
+            roles, all_issues = run_combined() if mode == "combined" else run_staged()
+
+            # 相对于每次调用都上传原图，本任务节省的上传字节数
+            task['bytes_saved'] = orig_bytes * (1 + len(roles)) - stats["bytes"]
+            task['cache_hits'] = stats["hits"]
+            task['metrics'] = {"mode": mode, "latency": time.monotonic() - t0, "calls": stats["calls"],
+                               "prompt_tokens": stats["prompt_tokens"], "completion_tokens": stats["completion_tokens"]}
+            task['roles'] = roles
+            task['status'] = 'done'
+            task['data'] = all_issues
+        except Exception as e:
+            task['status'] = 'error'
+            task['error'] = str(e)
+        finally:
+            def release():
+                for client in clients.values(): CLIENTS.release(client)
+            losers = [f for f in hedges if not f.done()]
+            if losers: threading.Thread(target=lambda: wait(losers) or release(), daemon=True).start()
+            else: release()
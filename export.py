@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+建设工程质量安全检查助手 - 报告导出
+把分析结果边遍历边写入文件 (HTML / DOCX / CSV)，内存占用与批量大小无关：
+每张图片只在写到它的小节时才取缩略图 (经 IMAGE_CACHE 缓存)，问题逐条写出。
+tasks 可以是任务列表，也可以是可重复遍历的 JsonlTasks (cli.py 的输出)。
+
+用法：
+    python export.py results.jsonl -o report.html
+    python export.py results.jsonl -o report.docx
+    python export.py results.jsonl -o issues.csv
+"""
+
+import argparse, base64, csv, io, json, os, sys, zipfile
+from collections import Counter
+from datetime import datetime
+from html import escape as html_escape
+from xml.sax.saxutils import escape as xml_escape
+
+from engine import IMAGE_CACHE, RISK_LEVELS, THUMB_EDGE
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+EXPORT_FORMATS = {
+    "html": "HTML 报告（含图片）",
+    "docx": "Word 报告（含图片）",
+    "csv": "CSV 表格",
+}
+CSV_FIELDS = ["path", "name", "category", "risk_level", "issue", "regulation", "correction", "confidence"]
+REPORT_CSV_FIELDS = CSV_FIELDS + ["shared_from"]    # 近似照片共享的问题注明代表照片，统计时可据此去重
+LEVEL_COLORS = {"严重安全隐患": "#DC2626", "一般安全隐患": "#F59E0B", "严重质量缺陷": "#7C3AED", "一般质量缺陷": "#2563EB"}
+PROGRESS_EVERY = 20     # 每写完多少张图片回调一次进度
+
+
+class JsonlTasks:
+    """按需逐行读取 cli.py 输出的 JSONL，可重复遍历；同一图片有多条记录时 (失败后重跑) 取最后一条"""
+    def __init__(self, path):
+        self.path = path
+
+    def __iter__(self):
+        last = {}
+        with open(self.path, "rb") as f:
+            offset = 0
+            for line in f:
+                try: last[json.loads(line)["path"]] = offset
+                except (ValueError, KeyError): pass
+                offset += len(line)
+            for offset in sorted(last.values()):
+                f.seek(offset)
+                r = json.loads(f.readline())
+                yield {"id": r["path"], "path": r["path"], "name": r.get("name") or os.path.basename(r["path"]), "status": r.get("status"),
+                       "roles": r.get("roles") or [], "scene": r.get("scene"), "error": r.get("error"), "data": r.get("issues") or []}
+
+
+def level_of(item):
+    lvl = item.get("risk_level")
+    return lvl if lvl in RISK_LEVELS else RISK_LEVELS[-1]
+
+def grouped(items):
+    """单张图片的问题按 风险等级 → 类别 分组，返回 [(等级, [(类别, [问题...])...])...]"""
+    groups = {}
+    for item in items:
+        groups.setdefault(level_of(item), {}).setdefault(item.get("category", ""), []).append(item)
+    return [(lvl, list(groups[lvl].items())) for lvl in RISK_LEVELS if lvl in groups]
+
+def summarize(tasks):
+    """第一遍遍历：(等级, 类别) 计数与近似照片代表名称，只保留计数不保留问题。
+    有近似分组时再取各代表照片的问题，供组内照片的小节列出 (只引用，不计入总数)"""
+    counts, names, reps, images, failed = Counter(), {}, set(), 0, 0
+    for task in tasks:
+        images += 1
+        names[task['id']] = task['name']
+        if task['status'] == 'error': failed += 1
+        if task.get('dup_of'): reps.add(task['dup_of'])
+        for item in task.get('data') or []: counts[(level_of(item), item.get("category", ""))] += 1
+    shared = {t['id']: t.get('data') or [] for t in tasks if t['id'] in reps} if reps else {}
+    return {"counts": counts, "names": names, "shared": shared, "images": images, "failed": failed, "issues": sum(counts.values())}
+
+def task_issues(task, stats):
+    """本节列出的问题：近似照片列出代表照片的问题"""
+    if task.get('dup_of'): return stats["shared"].get(task['dup_of'], [])
+    return task.get('data') or []
+
+def issue_count(task, stats):
+    n = len(task_issues(task, stats))
+    return f"共享 {n} 个问题" if task.get('dup_of') else f"{n} 个问题"
+
+def task_note(task, names):
+    if task.get('dup_of'): return f"与 {names.get(task['dup_of'], '另一张照片')} 近似，共享其结果 (问题计入该照片)"
+    if task['status'] == 'error': return f"分析失败：{task.get('error') or ''}"
+    if task['status'] != 'done': return "尚未分析"
+    return "；".join(filter(None, [task.get('scene'), "" if task.get('data') else "未发现问题"]))
+
+def thumb_bytes(path, edge):
+    b64 = IMAGE_CACHE.get(path, edge)
+    return base64.b64decode(b64) if b64 else b""
+
+def _progress(on_progress, n, total, force=False):
+    if on_progress and (force or n % PROGRESS_EVERY == 0): on_progress(n, total)
+
+
+# ==================== CSV ====================
+def export_csv(path, tasks, on_progress=None):
+    """每个问题一行，utf-8-sig 便于 Excel 直接打开；近似照片也列出共享的问题 (shared_from 为代表照片)。
+    返回问题数 (共享的不重复计)"""
+    n = total = 0
+    stats = summarize(tasks)
+    with open(path, "w", encoding="utf-8-sig", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=REPORT_CSV_FIELDS, extrasaction="ignore")
+        writer.writeheader()
+        for total, task in enumerate(tasks, 1):
+            shared_from = stats["names"].get(task['dup_of'], "") if task.get('dup_of') else ""
+            for item in task_issues(task, stats):
+                writer.writerow(dict(item, path=task['path'], name=task['name'], shared_from=shared_from))
+                n += not shared_from
+            _progress(on_progress, total, stats["images"])
+    _progress(on_progress, total, total, force=True)
+    return n
+
+
+# ==================== HTML ====================
+HTML_HEAD = """<!DOCTYPE html>
+<html lang="zh-CN"><head><meta charset="utf-8"><meta name="viewport" content="width=device-width, initial-scale=1">
+<title>{title}</title>
+<style>
+body{{font-family:-apple-system,"PingFang SC","Microsoft YaHei",sans-serif;margin:0 auto;max-width:960px;padding:16px;color:#1F2937;background:#F8FAFC}}
+h1{{font-size:22px}} h2{{font-size:17px;margin:0}} h3{{font-size:14px;margin:12px 0 6px}}
+table{{border-collapse:collapse;margin:8px 0}} td,th{{border:1px solid #E2E8F0;padding:4px 10px;font-size:13px}}
+.img{{background:#fff;border:1px solid #E2E8F0;border-radius:10px;padding:12px;margin:14px 0;page-break-inside:avoid}}
+.head{{display:flex;gap:12px;align-items:center}} .head img{{border-radius:6px;max-width:{edge}px}}
+.note{{color:#64748B;font-size:13px}} .cat{{color:#64748B;font-size:12px;margin:6px 0 2px}}
+.item{{border-left:4px solid;padding:4px 10px;margin:6px 0;font-size:14px}} .meta{{color:#475569;font-size:12px}}
+</style></head><body>
+"""
+
+def export_html(path, tasks, title="质量安全检查报告", image_edge=THUMB_EDGE, on_progress=None):
+    """单文件 HTML：总览 (等级×类别计数) + 每张图片一节 (内嵌缩略图，问题按等级、类别分组)；返回问题数"""
+    stats = summarize(tasks)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(HTML_HEAD.format(title=html_escape(title), edge=image_edge))
+        f.write(f"<h1>🏗️ {html_escape(title)}</h1><p class='note'>导出时间：{datetime.now():%Y-%m-%d %H:%M}　"
+                f"图片 {stats['images']} 张　问题 {stats['issues']} 个" + (f"　失败 {stats['failed']} 张" if stats['failed'] else "") + "</p>")
+        if stats["counts"]:
+            f.write("<table><tr><th>风险等级</th><th>类别</th><th>数量</th></tr>")
+            for (lvl, cat), n in sorted(stats["counts"].items(), key=lambda kv: (RISK_LEVELS.index(kv[0][0]), kv[0][1])):
+                f.write(f"<tr><td style='color:{LEVEL_COLORS[lvl]}'>{lvl}</td><td>{html_escape(cat)}</td><td>{n}</td></tr>")
+            f.write("</table>")
+        for i, task in enumerate(tasks, 1):
+            b64 = IMAGE_CACHE.get(task['path'], image_edge)
+            img = f"<img src='data:image/jpeg;base64,{b64}' alt=''>" if b64 else ""
+            note = task_note(task, stats["names"])
+            f.write(f"<div class='img'><div class='head'>{img}<div><h2>{i}. {html_escape(task['name'])}</h2>"
+                    f"<div class='note'>{issue_count(task, stats)}" + (f" · {html_escape(note)}" if note else "") + "</div></div></div>")
+            for lvl, cats in grouped(task_issues(task, stats)):
+                f.write(f"<h3 style='color:{LEVEL_COLORS[lvl]}'>{lvl}</h3>")
+                for cat, items in cats:
+                    if cat: f.write(f"<div class='cat'>{html_escape(cat)}</div>")
+                    for item in items:
+                        f.write(f"<div class='item' style='border-color:{LEVEL_COLORS[lvl]}'>{html_escape(item.get('issue', ''))}"
+                                f"<div class='meta'>📋 {html_escape(item.get('regulation', ''))}<br>✅ {html_escape(item.get('correction', ''))}</div></div>")
+            f.write("</div>\n")
+            _progress(on_progress, i, stats["images"])
+        f.write("</body></html>\n")
+    _progress(on_progress, stats["images"], stats["images"], force=True)
+    return stats["issues"]
+
+
+# ==================== DOCX ====================
+# 最小 WordprocessingML 包：媒体逐张写入 zip，document.xml 以流方式写入，不在内存中拼接整篇文档
+DOCX_CONTENT_TYPES = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types"><Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/><Default Extension="xml" ContentType="application/xml"/><Default Extension="jpeg" ContentType="image/jpeg"/><Override PartName="/word/document.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/></Types>"""
+DOCX_RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships"><Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="word/document.xml"/></Relationships>"""
+DOCX_NS = ('xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main" '
+           'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships" '
+           'xmlns:wp="http://schemas.openxmlformats.org/drawingml/2006/wordprocessingDrawing" '
+           'xmlns:a="http://schemas.openxmlformats.org/drawingml/2006/main" '
+           'xmlns:pic="http://schemas.openxmlformats.org/drawingml/2006/picture"')
+EMU_PER_PX = 9525       # 96 dpi
+
+def _run(text, bold=False, size=None, color=None):
+    props = ("<w:b/>" if bold else "") + (f'<w:color w:val="{color.lstrip("#")}"/>' if color else "") + (f'<w:sz w:val="{size * 2}"/>' if size else "")
+    return f'<w:r>{f"<w:rPr>{props}</w:rPr>" if props else ""}<w:t xml:space="preserve">{xml_escape(text)}</w:t></w:r>'
+
+def _para(*runs):
+    return f"<w:p>{''.join(runs)}</w:p>"
+
+def _picture(rid, n, width, height):
+    cx, cy = width * EMU_PER_PX, height * EMU_PER_PX
+    return (f'<w:p><w:r><w:drawing><wp:inline><wp:extent cx="{cx}" cy="{cy}"/><wp:docPr id="{n}" name="图片{n}"/>'
+            f'<a:graphic><a:graphicData uri="http://schemas.openxmlformats.org/drawingml/2006/picture"><pic:pic>'
+            f'<pic:nvPicPr><pic:cNvPr id="{n}" name="图片{n}"/><pic:cNvPicPr/></pic:nvPicPr>'
+            f'<pic:blipFill><a:blip r:embed="{rid}"/><a:stretch><a:fillRect/></a:stretch></pic:blipFill>'
+            f'<pic:spPr><a:xfrm><a:off x="0" y="0"/><a:ext cx="{cx}" cy="{cy}"/></a:xfrm><a:prstGeom prst="rect"><a:avLst/></a:prstGeom></pic:spPr>'
+            f'</pic:pic></a:graphicData></a:graphic></wp:inline></w:drawing></w:r></w:p>')
+
+def _image_size(data, edge):
+    if Image is None: return edge, edge
+    try:
+        with Image.open(io.BytesIO(data)) as img: return img.size
+    except Exception: return edge, edge
+
+def export_docx(path, tasks, title="质量安全检查报告", image_edge=THUMB_EDGE, on_progress=None):
+    """Word 报告，结构与 HTML 相同；返回问题数"""
+    stats = summarize(tasks)
+    pictures = []           # 第 i 张图片 -> (rId, 宽, 高) 或 None
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as z:
+        z.writestr("[Content_Types].xml", DOCX_CONTENT_TYPES)
+        z.writestr("_rels/.rels", DOCX_RELS)
+        # 第二遍：图片逐张写入 word/media (已是 JPEG，不再压缩)
+        for i, task in enumerate(tasks, 1):
+            data = thumb_bytes(task['path'], image_edge)
+            if not data:
+                pictures.append(None)
+                continue
+            z.writestr(zipfile.ZipInfo(f"word/media/image{i}.jpeg", date_time=datetime.now().timetuple()[:6]), data, compress_type=zipfile.ZIP_STORED)
+            pictures.append((f"rImg{i}", *_image_size(data, image_edge)))
+        with z.open("word/_rels/document.xml.rels", "w") as rels:
+            rels.write(b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">')
+            for i, pic in enumerate(pictures, 1):
+                if pic: rels.write(f'<Relationship Id="{pic[0]}" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/image" Target="media/image{i}.jpeg"/>'.encode())
+            rels.write(b"</Relationships>")
+        # 第三遍：正文流式写入
+        with z.open("word/document.xml", "w") as raw, io.TextIOWrapper(raw, encoding="utf-8") as doc:
+            doc.write(f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n<w:document {DOCX_NS}><w:body>')
+            doc.write(_para(_run(title, bold=True, size=18)))
+            doc.write(_para(_run(f"导出时间：{datetime.now():%Y-%m-%d %H:%M}　图片 {stats['images']} 张　问题 {stats['issues']} 个"
+                                 + (f"　失败 {stats['failed']} 张" if stats['failed'] else ""), color="#64748B")))
+            for (lvl, cat), n in sorted(stats["counts"].items(), key=lambda kv: (RISK_LEVELS.index(kv[0][0]), kv[0][1])):
+                doc.write(_para(_run(f"{lvl}", bold=True, color=LEVEL_COLORS[lvl]), _run(f"　{cat}：{n} 个")))
+            for i, task in enumerate(tasks, 1):
+                doc.write(_para(_run(f"{i}. {task['name']}", bold=True, size=13)))
+                pic = pictures[i - 1] if i <= len(pictures) else None
+                if pic: doc.write(_picture(pic[0], i, pic[1], pic[2]))
+                note = task_note(task, stats["names"])
+                doc.write(_para(_run(issue_count(task, stats) + (f" · {note}" if note else ""), color="#64748B")))
+                for lvl, cats in grouped(task_issues(task, stats)):
+                    doc.write(_para(_run(lvl, bold=True, color=LEVEL_COLORS[lvl])))
+                    for cat, items in cats:
+                        for item in items:
+                            doc.write(_para(_run(f"【{cat}】" if cat else ""), _run(item.get("issue", ""))))
+                            doc.write(_para(_run(f"📋 依据：{item.get('regulation', '')}　✅ 整改：{item.get('correction', '')}", size=9, color="#475569")))
+                _progress(on_progress, i, stats["images"])
+            doc.write('<w:sectPr><w:pgSz w:w="11906" w:h="16838"/><w:pgMar w:top="1134" w:right="1134" w:bottom="1134" w:left="1134"/></w:sectPr></w:body></w:document>')
+    _progress(on_progress, stats["images"], stats["images"], force=True)
+    return stats["issues"]
+
+
+EXPORTERS = {"html": export_html, "docx": export_docx, "csv": export_csv}
+
+def export_report(path, tasks, fmt=None, on_progress=None):
+    """按扩展名 (或 fmt) 选择导出格式；返回问题数"""
+    fmt = fmt or os.path.splitext(path)[1].lstrip(".").lower()
+    if fmt not in EXPORTERS: raise ValueError(f"不支持的导出格式：{fmt}")
+    return EXPORTERS[fmt](path, tasks, on_progress=on_progress)
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="把 cli.py 输出的 JSONL 导出为 HTML / DOCX / CSV 报告")
+    ap.add_argument("input", help="cli.py 输出的 JSONL 文件")
+    ap.add_argument("-o", "--output", required=True, help="输出文件，按扩展名选择格式 (.html / .docx / .csv)")
+    args = ap.parse_args(argv)
+    try:
+        n = export_report(args.output, JsonlTasks(args.input), on_progress=lambda i, total: print(f"\r已写入 {i} 张", end="", file=sys.stderr))
+    except ValueError as e:
+        ap.error(str(e))
+    print(f"\n共 {n} 个问题 → {args.output}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -6,16 +6,30 @@
 完全保留原业务逻辑、提示词和 UI 风格。
 """
 
-import os, json, base64, time, re, threading
+import time
+T_LAUNCH = time.perf_counter()  # 启动计时起点 (导入前)
+
+import os, threading
 from datetime import datetime
-from typing import Dict, List
 
 import flet as ft
-from openai import OpenAI
 
-# ==================== 全局配置 (完全保留) ====================
-CONFIG_FILE = "app_config.json"
+from engine import (
+    ConfigManager, InspectionEngine, IssueIndex, SessionStore, HistoryArchive, HashIndex, dhash, RISK_LEVELS, build_run, provider_key, new_task, record_mode_stats, describe_mode_stats, fmt_bytes,
+    IMAGE_CACHE, CLIENTS, METRICS, HEALTH, PROVIDER_PRESETS, PIPELINE_MODES, OUTPUT_FORMATS, DEFAULT_PROMPTS, MAX_WORKERS,
+    UPLOAD_MAX_EDGE, UPLOAD_QUALITY, HTTP_POOL_SIZE, HTTP_TIMEOUT, DEDUP_THRESHOLD, BATCH_IMAGES, warm_client,
+)
+from export import EXPORT_FORMATS, export_report
+
+STARTUP = {"import": time.perf_counter() - T_LAUNCH}    # 启动各阶段耗时 (秒)，见诊断面板
+
+# ==================== 界面配置 (完全保留) ====================
 MAX_IMAGES = 20
+UI_FRAME_INTERVAL = 0.1   # 后台线程触发的界面刷新最多每 100ms 一次
+SUMMARY_PAGE_SIZE = 30    # 汇总页每次加载的问题数
+HISTORY_SEARCH_INTERVAL = 0.3   # 历史检索框输入时最多每 300ms 查询一次
+EXPORT_DIR = "exports"
+THUMB_PLACEHOLDER = "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAIAAACQd1PeAAAADElEQVR4nGN4+vw1AAVsArjSAflTAAAAAElFTkSuQmCC"   # 1×1 灰色 PNG，缩略图解码完成前占位
 
 DS = {
     "primary": "#1A56DB",
@@ -42,133 +56,35 @@ RISK_STYLE = {
     "一般质量缺陷": {"bg": "#E1EFFE", "border": "#1A56DB", "icon": "🔵", "priority": 3},
 }
 
-PROVIDER_PRESETS = {
-    "阿里百炼 (Qwen-VL-Max)": {"base_url": "https://dashscope.aliyuncs.com/compatible-mode/v1", "model": "qwen-vl-max"},
-    "阿里百炼 (Qwen2.5-VL)": {"base_url": "https://dashscope.aliyuncs.com/compatible-mode/v1", "model": "qwen2.5-vl-72b"},
-    "硅基流动 (Qwen2-VL)": {"base_url": "https://api.siliconflow.cn/v1", "model": "Qwen/Qwen2-VL-72B-Instruct"},
-}
-
-DEFAULT_PROMPTS = {
-    "V4.6 安全质量双聚焦": "聚焦安全隐患 + 质量问题",
-    "安全隐患专项": "仅识别安全隐患",
-    "质量问题专项": "仅识别质量问题",
-}
-
-REGULATION_DB = {
-    "安全": {
-        "role_desc": "注册安全工程师 | 30 年经验",
-        "critical_hazards": ["高处作业不系安全带", "安全帽未系下颌带", "临边洞口防护缺失", "使用挖掘机吊装"],
-        "checklist": ["【一眼识别】安全帽：未系下颌带立即报告", "【一眼识别】安全带：2m 以上无安全带立即报告", "【一眼识别】临边防护：无 1.2m 护栏立即报告"],
-        "must_report_if": ["发现高处作业无安全带", "发现临边洞口无防护", "发现使用挖掘机吊物"],
-        "norms": "### JGJ 59-2011《建筑施工安全检查标准》\n**第 3.2.5 条** 进入施工现场必须正确佩戴安全帽，系好下颌带。\n**第 5.1.1 条** 高处作业 (2m 及以上) 必须系安全带，安全带必须高挂低用。\n### JGJ 33-2012\n**第 4.1.14 条** 严禁使用挖掘机、装载机进行吊装作业。",
-        "anti_hallucination": "管理人员在安全通道内检查可短时摘帽；地面作业不强制系安全带。"
-    },
-    "机械": {
-        "role_desc": "起重机械专家 | 30 年经验",
-        "critical_hazards": ["【致命】使用挖掘机吊装", "塔吊限制器失效或被短接", "钢丝绳断丝超过 10%", "施工升降机防坠安全器失效"],
-        "checklist": ["【一眼识别】吊装设备：挖掘机、装载机吊物立即报告", "【一眼识别】限位器：查看是否有线头短接", "【一眼识别】钢丝绳：断丝断股立即报告"],
-        "must_report_if": ["发现使用挖掘机、装载机吊物", "发现限位器短接或失效", "发现钢丝绳断丝断股"],
-        "norms": "### GB 5144-2006《塔式起重机安全规程》\n**第 6.1.1 条** 塔吊必须装设力矩限制器、起重量限制器、高度限位器。\n### JGJ 33-2012《建筑机械使用安全技术规程》\n**第 4.1.14 条** 严禁使用挖掘机、装载机、推土机等非起重机械进行吊装作业。",
-        "anti_hallucination": "停工状态吊钩无荷载正常；设备表面轻微锈迹不是缺陷。"
-    },
-    "电气": {
-        "role_desc": "注册电气工程师 | 30 年经验",
-        "critical_hazards": ["临时用电未采用 TN-S 系统", "配电箱未做重复接地", "一闸多机", "电缆直接拖地或浸水"],
-        "checklist": ["【一眼识别】电线颜色：黄绿双色只能是 PE 线", "【一眼识别】配电箱门：必须有跨接软铜线", "【一眼识别】插座接线：左零右火上接地"],
-        "must_report_if": ["发现电线绝缘层破损", "发现漏电保护器失效", "发现电缆接头裸露"],
-        "norms": "### JGJ 46-2005《施工现场临时用电安全技术规范》\n**第 5.1.1 条** 临时用电工程必须采用 TN-S 接零保护系统，实行三级配电两级保护。\n**第 8.1.3 条** 每台用电设备必须有各自专用的开关箱，严禁一闸多机。",
-        "anti_hallucination": "施工中临时接线待整理正常；备用回路不是故障。"
-    },
-    "管道": {
-        "role_desc": "管道工艺专家 | 30 年经验",
-        "critical_hazards": ["压力管道使用排水管", "阀门无标识或标识错误", "法兰垫片使用错误"],
-        "checklist": ["【一眼识别】管道颜色：红色消防、绿色给水、蓝色排水、黄色燃气", "【一眼识别】法兰螺栓：必须露出 2-3 扣"],
-        "must_report_if": ["发现管道有凹陷、裂纹", "发现阀门铭牌缺失", "发现不同材质管道直接焊接"],
-        "norms": "### GB 50242-2002《建筑给水排水及采暖工程施工质量验收规范》\n**第 3.3.13 条** 法兰连接螺栓紧固后露出螺母 2-3 扣。\n**第 3.3.15 条** 阀门安装前必须做强度和严密性试验，安装方向正确。",
-        "anti_hallucination": "临时封堵盲板不是缺阀门；试压用临时支撑不是支架不足。"
-    },
-    "结构": {
-        "role_desc": "结构总工程师 | 30 年经验",
-        "critical_hazards": ["模板支撑立杆悬空或无垫板", "高大模板未设置扫地杆剪刀撑", "混凝土浇筑后出现贯穿裂缝"],
-        "checklist": ["【一眼识别】立杆底部：悬空、无垫板立即报告", "【一眼识别】混凝土裂缝：宽度超 0.3mm 立即报告"],
-        "must_report_if": ["发现立杆悬空无垫板", "发现混凝土裂缝宽度超过 0.3mm"],
-        "norms": "### JGJ 162-2008《建筑施工模板安全技术规范》\n**第 6.1.2 条** 模板支架立杆底部必须设置垫板，严禁悬空，垫板厚度不小于 50mm。\n### GB 50204-2015《混凝土结构工程施工质量验收规范》",
-        "anti_hallucination": "未抹面不是不平整；温度裂缝（发丝状）不是结构裂缝。"
-    },
-}
-
-ROUTER_PROMPT = """你是工程建设总监。识别图片施工内容，选派 2-5 个专家：
-1. 安全 2. 机械 3. 电气 4. 结构 5. 管道
-规则：必须包含"安全"；看到机械必须选"机械"；看到管道相关选"管道"。
-输出 JSON 数组，如：["机械","安全","管道"]"""
-
-
-# ==================== 配置管理器 (完全保留) ====================
-class ConfigManager:
-    @staticmethod
-    def load():
-        if os.path.exists(CONFIG_FILE):
-            try:
-                with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-            except: pass
-        return {
-            "api_key": "",
-            "current_provider": "阿里百炼 (Qwen2.5-VL)",
-            "last_prompt": "V4.6 安全质量双聚焦"
-        }
-
-    @staticmethod
-    def save(config):
-        try:
-            with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
-                json.dump(config, f, indent=2, ensure_ascii=False)
-        except: pass
-
-# ==================== 辅助方法 ====================
-def get_b64(path):
-    """将本地图片转为 Base64，适配手机端引擎渲染"""
-    try:
-        with open(path, "rb") as f:
-            return base64.b64encode(f.read()).decode("utf-8")
-    except: return ""
-
-def parse_roles(text):
-    try:
-        m = re.search(r'\[.*?\]', text, re.DOTALL)
-        if m: return json.loads(m.group())
-    except: pass
-    return []
-
-def build_ai_prompt(role, kb):
-    return f"""你是【{role}】（{kb.get('role_desc', '')}）。
-## 重大隐患清单
-{chr(10).join(f'- {h}' for h in kb.get('critical_hazards', []))}
-⚠️ 发现上述情形必须报告为"严重安全隐患"！
-## 检查清单
-{chr(10).join(kb.get('checklist', []))}
-## 误判警示
-{kb.get('anti_hallucination', '')}
-## 输出格式（JSON 数组）
-- risk_level: "严重安全隐患"/"一般安全隐患"/"严重质量缺陷"/"一般质量缺陷"
-- issue: 【{role}】+ 具体描述
-- regulation: 规范条文号
-- correction: 整改措施
-- confidence: 0.0-1.0"""
-
-def parse_issues(text, role):
-    issues = []
-    try:
-        clean = text.replace("```json", "").replace("```", "").strip()
-        s, e = clean.find('['), clean.rfind(']') + 1
-        if s != -1 and e:
-            for item in json.loads(clean[s:e]):
-                if isinstance(item, dict):
-                    item["category"] = role
-                    issues.append(item)
-    except: pass
-    return issues
-
+# ==================== 界面刷新合并 ====================
+class UpdateCoalescer:
+    """合并后台线程的刷新请求：空闲时立即刷新，繁忙时按固定帧间隔批量刷新，
+    flush(keys) 收到自上次刷新以来所有被标记的任务 id"""
+    def __init__(self, flush, interval=UI_FRAME_INTERVAL):
+        self.flush = flush
+        self.interval = interval
+        self._dirty = set()
+        self._scheduled = False
+        self._last = 0.0
+        self._lock = threading.Lock()
+
+    def request(self, key=None):
+        with self._lock:
+            if key is not None: self._dirty.add(key)
+            if self._scheduled: return
+            self._scheduled = True
+            delay = max(0.0, self._last + self.interval - time.monotonic())
+        timer = threading.Timer(delay, self._run)
+        timer.daemon = True
+        timer.start()
+
+    def _run(self):
+        with self._lock:
+            keys, self._dirty = self._dirty, set()
+            self._scheduled = False
+            self._last = time.monotonic()
+        try: self.flush(keys)
+        except Exception: pass
 
 # ==================== 主程序 (Flet) ====================
 def main(page: ft.Page):
@@ -179,21 +95,44 @@ def main(page: ft.Page):
     page.window.width = 390
     page.window.height = 844
 
-    config = ConfigManager.load()
-    tasks = []
+    # 配置在后台读取，不阻塞首帧；用户操作首次用到配置时才等待
+    config, config_ready = {}, threading.Event()
+    def load_config():
+        t = time.perf_counter()
+        config.update(ConfigManager.load())
+        STARTUP["config"] = time.perf_counter() - t
+        config_ready.set()
+    threading.Thread(target=load_config, daemon=True).start()
+
+    t = time.perf_counter()
+    store = SessionStore()
+    tasks = store.load()    # 恢复上次会话 (含中断的任务)
+    STARTUP["session"] = time.perf_counter() - t
+    history_db, history_lock = [], threading.Lock()
+
+    def archive():
+        """历史检查记录 (清空队列不影响)；首次写入或进入历史页时才打开，不占首帧"""
+        with history_lock:
+            if not history_db: history_db.append(HistoryArchive())
+            return history_db[0]
+    task_rows = {}          # task id -> 主页行控件，状态变化时只更新对应行
+    issue_index = IssueIndex()
+    summary_state = {"level": None, "category": None, "shown": 0}
+    history_state = {"query": "", "typed": "", "level": None, "since": None, "shown": 0, "total": 0}
+    batch = {"active": False, "lock": threading.Lock()}
     current_tab = 0
 
     # UI 全局组件
     home_list = ft.ListView(expand=True, spacing=10, padding=12)
     summary_list = ft.ListView(expand=True, spacing=10, padding=12)
     detail_list = ft.ListView(expand=True, spacing=10, padding=12)
+    history_list = ft.ListView(expand=True, spacing=10, padding=12)
 
     count_text = ft.Text("0/20", color=ft.colors.WHITE, size=13, weight=ft.FontWeight.BOLD)
     status_text = ft.Text("就绪", size=12, color=DS["text_secondary"])
     progress_bar = ft.ProgressBar(value=0, color=DS["primary"], bgcolor=DS["border"], height=4, visible=False)
 
-    safe_prompt = config.get("last_prompt", "V4.6 安全质量双聚焦")
-    if safe_prompt not in DEFAULT_PROMPTS: safe_prompt = list(DEFAULT_PROMPTS.keys())[0]
+    safe_prompt = list(DEFAULT_PROMPTS.keys())[0]     # 配置读取后改为上次选择的场景
     prompt_dropdown = ft.Dropdown(
         options=[ft.dropdown.Option(k) for k in DEFAULT_PROMPTS.keys()],
         value=safe_prompt, text_size=13, height=45, expand=True,
@@ -213,112 +152,167 @@ def main(page: ft.Page):
         page.set_clipboard(text)
         show_toast("已复制到剪贴板")
 
-    # ---------------- 核心工作线程 ----------------
-    def analyze_task_thread(task, api_key, base_url, model, prompt_text):
-        try:
-            client = OpenAI(api_key=api_key, base_url=base_url)
-            b64 = get_b64(task['path'])
-
-            task['progress_msg'] = "🔍 智能分诊中..."
-            page.update()
-
-            rr = client.chat.completions.create(
-                model=model, temperature=0.1,
-                messages=[{"role": "system", "content": ROUTER_PROMPT},
-                          {"role": "user", "content": [
-                              {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{b64}"}},
-                              {"type": "text", "text": "请分析施工内容并选派专家"}]}])
-
-            roles = parse_roles(rr.choices[0].message.content)
-            if not roles: roles = ["安全"]
-            if "安全" not in roles: roles.append("安全")
+    # ---------------- 界面刷新 (后台线程只标记，按帧合并刷新) ----------------
+    def flush_ui(ids):
+        for tid in ids:
+            if tid in task_rows: update_task_row(task_rows[tid])
+        done_count = len([t for t in tasks if t['status'] in ('done', 'error')])
+        if tasks: progress_bar.value = done_count / len(tasks)
+        start_btn.text = "⏹ 取消排队" if engine.pending else "▶ 开始分析"
+        v_detail = views.get("detail")
+        cur = getattr(v_detail, "current_task", None)
+        if cur is not None and v_detail.visible and cur['id'] in ids:
+            render_detail(cur)
+        page.update()
 
-            all_issues = []
-            for idx, role in enumerate(roles):
-                task['progress_msg'] = f"🔬 {role}专家分析 ({idx+1}/{len(roles)})"
-                page.update()
+    ui = UpdateCoalescer(flush_ui)
+
+    # ---------------- 分析引擎回调 (工作线程中调用) ----------------
+    def on_task_done(task):
+        if not any(t is task for t in tasks): return store.remove_task(task)  # 分析途中已被清空
+        if task.get('metrics'): record_mode_stats(config.setdefault("mode_stats", {}), task['metrics'])
+        issue_index.set_task(task)
+        if task['status'] == 'done':
+            share_results(task)
+            archive().record(task, IMAGE_CACHE.thumb(task['path']))
+        ui.request(task['id'])
+        check_all_done()
 
-                kb = REGULATION_DB.get(role, REGULATION_DB["安全"])
-                resp = client.chat.completions.create(
-                    model=model, temperature=0.3, max_tokens=4096,
-                    messages=[{"role": "system", "content": build_ai_prompt(role, kb)},
-                              {"role": "user", "content": [
-                                  {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{b64}"}},
-                                  {"type": "text", "text": "请分析图片，找出所有问题。输出 JSON 数组。"}]}])
-                
-                all_issues.extend(parse_issues(resp.choices[0].message.content, role))
-
-            task['status'] = 'done'
-            task['data'] = all_issues
-        except Exception as e:
-            task['status'] = 'error'
-            task['error'] = str(e)
-            
+    engine = InspectionEngine(MAX_WORKERS, on_progress=lambda task: ui.request(task['id']),
+                              on_issue=lambda task, item: ui.request(task['id']), on_done=on_task_done, store=store)
+
+    # ---------------- 近似重复照片 (连拍/重拍只分析一张代表照片) ----------------
+    dup_index = HashIndex()     # 代表照片的感知哈希
+
+    def find_task(tid):
+        return next((t for t in tasks if t['id'] == tid), None)
+
+    def group_duplicate(task):
+        """导入时计算感知哈希；与已有代表照片足够近似则归入其组，否则成为新的代表"""
+        threshold = config.get("dedup_threshold", DEDUP_THRESHOLD)
+        h = task['phash'] = dhash(task['path'])
+        if h is None: return False
+        for dist, tid in dup_index.search(h, threshold) if threshold else []:
+            rep = find_task(tid)
+            if rep is None: continue
+            task['dup_of'], task['dup_dist'] = tid, dist
+            if rep['status'] == 'done': share_results(rep)
+            return True
+        dup_index.add(h, task['id'])
+        return False
+
+    hashing = {"lock": threading.Lock(), "threads": []}
+
+    def hash_new(added):
+        """新添加的照片在后台计算感知哈希并归组，不阻塞选图；按添加顺序串行，先到的成为代表"""
+        dups = 0
+        with hashing["lock"]:
+            for task in added:
+                if not any(t is task for t in tasks): continue    # 已被清空
+                if group_duplicate(task):
+                    dups += 1
+                    ui.request(task['id'])
+                store.save_task(task)
+        if dups: show_toast(f"其中 {dups} 张与已有照片近似，将共享结果")
+
+    def wait_hashing():
+        """开始分析前等待归组完成，避免近似照片被重复分析"""
+        while hashing["threads"]: hashing["threads"].pop().join()
+
+    def share_results(rep):
+        """代表照片完成后组内照片直接共享其结果；问题只计入代表照片，汇总不重复统计"""
+        for t in tasks:
+            if t.get('dup_of') == rep['id'] and t['status'] != 'done':
+                t['status'], t['data'] = 'done', []
+                store.save_task(t)
+                ui.request(t['id'])
+
+    def detach_duplicate(task):
+        """移出分组单独分析，并成为新的代表照片"""
+        task.pop('dup_of', None)
+        task.pop('dup_dist', None)
+        task['status'], task['data'] = 'waiting', None
+        if task.get('phash') is not None: dup_index.add(task['phash'], task['id'])
+        store.save_task(task)
+        show_toast("已移出近似分组，将单独分析")
+
+    def persist_issues(task):
+        """人工编辑/删除后立即落盘"""
+        if task is None: return
+        store.save_issues(task)
+        archive().record(task)
+
+    def cancel_queued():
+        for task in engine.cancel_pending(): ui.request(task['id'])
+        show_toast("已取消排队中的任务")
         check_all_done()
 
     def check_all_done():
-        analyzing_count = len([t for t in tasks if t['status'] == 'analyzing'])
-        done_count = len([t for t in tasks if t['status'] in ('done', 'error')])
-        total = len(tasks)
-        
-        if total > 0: progress_bar.value = done_count / total
-            
-        if analyzing_count == 0:
-            progress_bar.visible = False
-            total_issues = sum(len(t.get('data') or []) for t in tasks if t['status'] == 'done')
-            status_text.value = f"分析完成，共 {total_issues} 个问题"
-            show_toast(f"分析完成！发现 {total_issues} 个问题")
-            
-        render_home()
-        if detail_view.visible and hasattr(detail_view, "current_task"):
-            render_detail(detail_view.current_task)
-        page.update()
+        """所有任务结束后汇总一次；多个工作线程同时结束时只提示一次"""
+        with batch["lock"]:
+            if not batch["active"] or any(t['status'] == 'analyzing' for t in tasks): return
+            batch["active"] = False
+        progress_bar.visible = False
+        total_issues = sum(len(t.get('data') or []) for t in tasks if t['status'] == 'done')
+        saved = sum(t.get('bytes_saved', 0) for t in tasks if t['status'] == 'done')
+        status_text.value = f"分析完成，共 {total_issues} 个问题" + (f"，节省上传 {fmt_bytes(saved)}" if saved > 0 else "")
+        ConfigManager.save(config)  # 持久化各模式耗时/token 统计
+        show_toast(f"分析完成！发现 {total_issues} 个问题")
 
     def start_analysis(e):
+        if engine.pending: return cancel_queued()
+        config_ready.wait()
         config["last_prompt"] = prompt_dropdown.value
         ConfigManager.save(config)
         
-        api_key = config.get("api_key", "")
-        p_name = config.get("current_provider", "阿里百炼 (Qwen2.5-VL)")
-        p_conf = PROVIDER_PRESETS.get(p_name, {})
-        
-        if not api_key:
+        if not config.get("api_key", ""):
             show_toast("请先在⚙设置中配置 API Key", False)
             open_settings()
             return
             
-        waiting = [t for t in tasks if t['status'] in ('waiting', 'error')]
+        wait_hashing()
+        waiting = [t for t in tasks if t['status'] in ('waiting', 'error') and not t.get('dup_of')]
         if not waiting:
             show_toast("没有待分析的图片", False)
             return
+        submit_batch(waiting)
 
+    def submit_batch(waiting):
         progress_bar.visible = True
         status_text.value = f"正在分析 {len(waiting)} 张..."
-        prompt_text = config.get("prompts", DEFAULT_PROMPTS).get(prompt_dropdown.value, "")
-        page.update()
+        run = build_run(config, prompt_dropdown.value)
+        engine.scheduler.workers = config.get("max_workers", MAX_WORKERS)
         
+        batch["active"] = True
         for t in waiting:
-            t['status'] = 'analyzing'
-            threading.Thread(target=analyze_task_thread, args=(t, api_key, p_conf.get("base_url"), p_conf.get("model"), prompt_text)).start()
+            engine.submit(t, run)
             
-        render_home()
+        start_btn.text = "⏹ 取消排队" if engine.pending else "▶ 开始分析"
+        for t in waiting: update_task_row(task_rows[t['id']])
+        page.update()
 
     # ---------------- 选图逻辑 ----------------
     def on_files_selected(e: ft.FilePickerResultEvent):
+        config_ready.wait()
         if e.files:
             allowed = MAX_IMAGES - len(tasks)
             if allowed <= 0:
                 show_toast(f"最多支持 {MAX_IMAGES} 张", False)
                 return
-            added = 0
+            added = []
             for f in e.files[:allowed]:
                 if any(t['path'] == f.path for t in tasks): continue
-                tasks.append({"id": f"{time.time()}_{f.name}", "path": f.path, "name": f.name, "status": "waiting", "data": None})
-                added += 1
+                task = new_task(f.path, f.name)
+                tasks.append(task)
+                store.save_task(task)
+                added.append(task)
             if added:
                 count_text.value = f"{len(tasks)}/20"
-                show_toast(f"已添加 {added} 张图片")
+                show_toast(f"已添加 {len(added)} 张图片")
                 render_home()
+                th = threading.Thread(target=hash_new, args=(added,), daemon=True)
+                hashing["threads"].append(th)
+                th.start()
         page.navigation_bar.selected_index = current_tab
         page.update()
 
@@ -402,101 +396,343 @@ def main(page: ft.Page):
         page.open(dialog)
 
     def open_settings():
-        key_inp = ft.TextField(value=config.get("api_key",""), password=True, can_reveal_password=True, text_size=14)
-        prov_drop = ft.Dropdown(options=[ft.dropdown.Option(k) for k in PROVIDER_PRESETS.keys()], value=config.get("current_provider"), text_size=14)
+        config_ready.wait()
+        keys = {name: provider_key(config, name) for name in PROVIDER_PRESETS}   # 各厂商分别保存 Key
+        key_inp = ft.TextField(value=keys.get(config.get("current_provider"), ""), password=True, can_reveal_password=True, text_size=14)
+        def switch_provider(e):
+            keys[switch_provider.shown] = key_inp.value
+            switch_provider.shown = prov_drop.value
+            key_inp.value = keys.get(prov_drop.value, "")
+            page.update()
+        switch_provider.shown = config.get("current_provider")
+        prov_drop = ft.Dropdown(options=[ft.dropdown.Option(k) for k in PROVIDER_PRESETS.keys()], value=config.get("current_provider"), text_size=14, on_change=switch_provider)
+        multi_sw = ft.Switch(label="多厂商自动切换（其余已填 Key 的厂商作为备用）", value=config.get("multi_provider", False))
+        hedge_sw = ft.Switch(label="慢请求对冲（超过 P95 时同时请求备用厂商）", value=config.get("hedge_requests", False))
+        edge_drop = ft.Dropdown(options=[ft.dropdown.Option(str(v)) for v in (1024, 1280, 1600, 2048)], value=str(config.get("upload_max_edge", UPLOAD_MAX_EDGE)), text_size=14, expand=True)
+        qual_drop = ft.Dropdown(options=[ft.dropdown.Option(str(v)) for v in (70, 80, 85, 90)], value=str(config.get("upload_quality", UPLOAD_QUALITY)), text_size=14, expand=True)
+        p_limits = config.get("rate_limits", {}).get(config.get("current_provider"), {})
+        p_preset = PROVIDER_PRESETS.get(config.get("current_provider"), {})
+        workers_drop = ft.Dropdown(options=[ft.dropdown.Option(str(v)) for v in (1, 2, 3, 4, 6, 8)], value=str(config.get("max_workers", MAX_WORKERS)), text_size=14, expand=True)
+        rpm_inp = ft.TextField(value=str(p_limits.get("rpm", p_preset.get("rpm", 60))), label="RPM", keyboard_type=ft.KeyboardType.NUMBER, text_size=14, expand=True)
+        tpm_inp = ft.TextField(value=str(p_limits.get("tpm", p_preset.get("tpm", 100000))), label="TPM", keyboard_type=ft.KeyboardType.NUMBER, text_size=14, expand=True)
+        mode_drop = ft.Dropdown(options=[ft.dropdown.Option(k, v) for k, v in PIPELINE_MODES.items()], value=config.get("pipeline_mode", "staged"), text_size=14)
+        batch_drop = ft.Dropdown(options=[ft.dropdown.Option(str(v), label) for v, label in ((1, "关闭"), (2, "最多 2 张"), (4, "最多 4 张"), (6, "最多 6 张"))], value=str(config.get("batch_images", BATCH_IMAGES)), label="多图合并（分级模式下同一专家一次检查多张）", text_size=14)
+        format_drop = ft.Dropdown(options=[ft.dropdown.Option(k, v) for k, v in OUTPUT_FORMATS.items()], value=config.get("output_format", "free"), text_size=14)
+        stream_sw = ft.Switch(label="流式输出（边生成边显示）", value=config.get("streaming", True))
+        spec_sw = ft.Switch(label="分诊时并行启动安全专家", value=config.get("speculative_safety", True))
+        pool_inp = ft.TextField(value=str(config.get("http_pool_size", HTTP_POOL_SIZE)), label="连接数", keyboard_type=ft.KeyboardType.NUMBER, text_size=14, expand=True)
+        dedup_drop = ft.Dropdown(options=[ft.dropdown.Option(str(v), label) for v, label in ((0, "关闭"), (4, "严格（几乎相同）"), (6, "标准"), (10, "宽松（同一角度）"))], value=str(config.get("dedup_threshold", DEDUP_THRESHOLD)), text_size=14)
+        timeout_inp = ft.TextField(value=str(int(config.get("http_timeout", HTTP_TIMEOUT))), label="超时(秒)", keyboard_type=ft.KeyboardType.NUMBER, text_size=14, expand=True)
         
         dialog = ft.AlertDialog(title=ft.Text("⚙ 设置"))
         def save(e):
+            keys[prov_drop.value] = key_inp.value
+            config["api_keys"] = {k: v for k, v in keys.items() if v}
             config["api_key"] = key_inp.value
             config["current_provider"] = prov_drop.value
+            config["multi_provider"], config["hedge_requests"] = multi_sw.value, hedge_sw.value
+            config["upload_max_edge"] = int(edge_drop.value)
+            config["upload_quality"] = int(qual_drop.value)
+            config["max_workers"] = int(workers_drop.value)
+            config["speculative_safety"] = spec_sw.value
+            config["pipeline_mode"] = mode_drop.value
+            config["batch_images"] = int(batch_drop.value)
+            config["streaming"] = stream_sw.value
+            config["output_format"] = format_drop.value
+            config["dedup_threshold"] = int(dedup_drop.value)
+            try: config.setdefault("rate_limits", {})[prov_drop.value] = {"rpm": max(1, int(rpm_inp.value)), "tpm": max(1000, int(tpm_inp.value))}
+            except ValueError: pass
+            try: config["http_pool_size"], config["http_timeout"] = max(1, int(pool_inp.value)), max(5.0, float(timeout_inp.value))
+            except ValueError: pass
             ConfigManager.save(config)
+            run = build_run(config)
+            CLIENTS.reset(keep={(b["provider"], b["base_url"], b["api_key"]) for b in run["backends"] or [run]})
             page.close(dialog)
             page.navigation_bar.selected_index = current_tab
             show_toast("设置已保存 ✓")
 
-        dialog.content = ft.Column([ft.Text("🔑 API KEY", size=12, weight="bold", color=DS["text_hint"]), key_inp, ft.Text("🤖 模型厂商", size=12, weight="bold", color=DS["text_hint"]), prov_drop], tight=True)
-        dialog.actions = [ft.TextButton("取消", on_click=lambda e: page.close(dialog) or setattr(page.navigation_bar, 'selected_index', current_tab) or page.update()), ft.ElevatedButton("保存", on_click=save, bgcolor=DS["primary"], color="white")]
+        dialog.content = ft.Column([ft.Text("🤖 模型厂商", size=12, weight="bold", color=DS["text_hint"]), prov_drop, ft.Text("🔑 API KEY（按厂商分别保存）", size=12, weight="bold", color=DS["text_hint"]), key_inp, multi_sw, hedge_sw, ft.Text("🧩 分析模式", size=12, weight="bold", color=DS["text_hint"]), mode_drop, batch_drop, ft.Text(describe_mode_stats(config.get("mode_stats", {})), size=11, color=DS["text_secondary"]), ft.Text("🧾 输出格式", size=12, weight="bold", color=DS["text_hint"]), format_drop, stream_sw, ft.Text("🖼 上传尺寸 / 质量", size=12, weight="bold", color=DS["text_hint"]), ft.Row([edge_drop, qual_drop]), ft.Text("🔗 近似照片合并分析", size=12, weight="bold", color=DS["text_hint"]), dedup_drop, ft.Text("🚦 并发数 / 限流", size=12, weight="bold", color=DS["text_hint"]), ft.Row([workers_drop, rpm_inp, tpm_inp]), spec_sw, ft.Text("🌐 连接池", size=12, weight="bold", color=DS["text_hint"]), ft.Row([pool_inp, timeout_inp])], scroll=ft.ScrollMode.AUTO, tight=True)
+        dialog.actions = [ft.TextButton("📈 诊断", on_click=lambda e: page.close(dialog) or open_diagnostics()), ft.TextButton("取消", on_click=lambda e: page.close(dialog) or setattr(page.navigation_bar, 'selected_index', current_tab) or page.update()), ft.ElevatedButton("保存", on_click=save, bgcolor=DS["primary"], color="white")]
+        page.open(dialog)
+
+    def open_diagnostics():
+        dialog = ft.AlertDialog(title=ft.Text("📈 调用诊断"))
+        def table(by):
+            rows = [ft.Row([ft.Text(h, size=11, weight="bold", color=DS["text_hint"], width=w) for h, w in (("", 70), ("调用", 36), ("耗时", 70), ("首字", 44), ("Token", 80), ("上传", 60), ("异常", 60))])]
+            for key, m in sorted(METRICS.aggregate(by).items(), key=lambda kv: -kv[1]["calls"]):
+                cells = (m["name"], f"{m['calls']:.3g}", f"{m['latency_avg']:.1f}/{m['latency_p95']:.1f}s", f"{m['ttfb_avg']:.1f}s",
+                         f"{m['prompt_tokens']:.0f}+{m['completion_tokens']:.0f}", fmt_bytes(m["upload_bytes"]), f"{m['errors']:.3g}/{m['retries']:.3g}/{m['parse_fail']:.3g}")
+                rows.append(ft.Row([ft.Text(c, size=11, width=w) for c, w in zip(cells, (70, 36, 70, 44, 80, 60, 60))]))
+            return rows
+        def body():
+            startup = ft.Text(describe_startup(), size=11, color=DS["text_secondary"])
+            if not METRICS.calls: return [startup, ft.Text("暂无调用记录", color=DS["text_secondary"])]
+            health = [ft.Text(f"{p}：错误率 {h['error_rate']:.0%}" + (f"，P95 {h['p95']:.1f}s" if h['p95'] else "") + ("，熔断中" if h['open'] else ""), size=11, color=DS["danger"] if h['open'] else DS["text_secondary"])
+                      for p, h in HEALTH.snapshot().items()]
+            return [startup, ft.Text("按厂商", size=12, weight="bold", color=DS["text_hint"]), *table("provider"), *health,
+                    ft.Text("按角色", size=12, weight="bold", color=DS["text_hint"]), *table("role"),
+                    ft.Text("耗时为 均值/P95；异常为 失败/重试/解析失败", size=10, color=DS["text_hint"])]
+        def export(e):
+            if not METRICS.calls: return show_toast("暂无调用记录", False)
+            try: show_toast(f"已导出 {METRICS.export(datetime.now().strftime('diagnostics_%Y%m%d_%H%M%S.json'))}")
+            except OSError as err: show_toast(f"导出失败: {err}", False)
+        def clear(e):
+            METRICS.clear()
+            dialog.content.controls = body()
+            page.update()
+        dialog.content = ft.Column(body(), scroll=ft.ScrollMode.AUTO, tight=True)
+        dialog.actions = [ft.TextButton("清空", on_click=clear), ft.TextButton("导出 JSON", on_click=export), ft.TextButton("关闭", on_click=lambda e: page.close(dialog))]
         page.open(dialog)
 
     # ---------------- 页面渲染 ----------------
-    def render_home():
+    def build_task_row(t):
+        """缩略图先用占位图，由 load_thumbs 在后台解码后替换"""
+        image = ft.Image(src_base64=THUMB_PLACEHOLDER, width=50, height=50, fit=ft.ImageFit.COVER, border_radius=8)
+        status = ft.Text("", size=12)
+        icon = ft.Text("", size=20)
+        row = ft.Container(
+            bgcolor=DS["surface"], border_radius=12, border=ft.border.all(1, DS["border"]), padding=10,
+            on_click=lambda e, t=t: open_detail(t),
+            content=ft.Row([
+                image,
+                ft.Column([ft.Text(t['name'], size=14, weight="bold"), status], expand=True, spacing=2),
+                icon, ft.Text("›", size=20, color=DS["text_hint"])
+            ])
+        )
+        entry = task_rows[t['id']] = {"task": t, "row": row, "status": status, "icon": icon, "image": image}
+        update_task_row(entry)
+        return entry
+
+    def load_thumbs(entries):
+        """后台线程逐张解码缩略图，经 UpdateCoalescer 合并刷新"""
+        for entry in entries:
+            entry["image"].src_base64 = IMAGE_CACHE.thumb(entry["task"]['path']) or THUMB_PLACEHOLDER
+            ui.request(entry["task"]['id'])
+
+    def update_task_row(entry):
+        """只改状态文字与图标，不重建行、不重新解码缩略图"""
+        t = entry["task"]
+        icon, color, text = "⏳", DS["text_hint"], "等待中"
+        rep = find_task(t['dup_of']) if t.get('dup_of') else None
+        if rep is not None:
+            icon, color = "🔗", DS["text_secondary"]
+            text = f"与 {rep['name']} 近似 · " + (f"共享 {len(rep.get('data') or [])} 个问题" if t['status'] == 'done' else "将共享其结果")
+        elif t['status'] == 'analyzing': icon, color, text = "🔄", DS["primary"], t.get('progress_msg', '分析中')
+        elif t['status'] == 'done':
+            icon, color, text = "✅", DS["success"], f"发现 {len(t['data'])} 个问题" if t['data'] else "未发现问题"
+            if t.get('bytes_saved', 0) > 0: text += f" · 省流 {fmt_bytes(t['bytes_saved'])}"
+            if t.get('cache_hits'): text += f" · 缓存命中 {t['cache_hits']}"
+        elif t['status'] == 'error': icon, color, text = "❌", DS["danger"], t.get('error', '失败')[:20]
+        entry["status"].value, entry["status"].color, entry["icon"].value = text, color, icon
+
+    def render_home(update=True):
+        """任务增删时重建列表结构；已有任务复用原行控件"""
         home_list.controls.clear()
         if not tasks:
+            task_rows.clear()
             home_list.controls.append(ft.Container(content=ft.Column([ft.Text("📷", size=60), ft.Text("添加施工图片", size=19, weight="bold"), ft.Text("点击下方 ➕ 添加图片", size=14, color=DS["text_secondary"])], horizontal_alignment="center", alignment="center"), expand=True, alignment=ft.alignment.center))
         else:
+            fresh = []
             for t in tasks:
-                icon, color, text = "⏳", DS["text_hint"], "等待中"
-                if t['status'] == 'analyzing': icon, color, text = "🔄", DS["primary"], t.get('progress_msg', '分析中')
-                elif t['status'] == 'done': icon, color, text = "✅", DS["success"], f"发现 {len(t['data'])} 个问题" if t['data'] else "未发现问题"
-                elif t['status'] == 'error': icon, color, text = "❌", DS["danger"], t.get('error', '失败')[:20]
-
-                home_list.controls.append(
-                    ft.Container(
-                        bgcolor=DS["surface"], border_radius=12, border=ft.border.all(1, DS["border"]), padding=10,
-                        on_click=lambda e, t=t: open_detail(t),
-                        content=ft.Row([
-                            ft.Image(src_base64=get_b64(t['path']), width=50, height=50, fit=ft.ImageFit.COVER, border_radius=8),
-                            ft.Column([ft.Text(t['name'], size=14, weight="bold"), ft.Text(text, size=12, color=color)], expand=True, spacing=2),
-                            ft.Text(icon, size=20), ft.Text("›", size=20, color=DS["text_hint"])
-                        ])
-                    )
-                )
+                entry = task_rows.get(t['id'])
+                if entry is None:
+                    entry = build_task_row(t)
+                    fresh.append(entry)
+                home_list.controls.append(entry["row"])
+            if fresh and update: threading.Thread(target=load_thumbs, args=(fresh,), daemon=True).start()
+        if update: page.update()
+
+    def issue_text(it):
+        return f"【{it.get('risk_level','')}】\n{it.get('issue','')}\n\n📋 依据：{it.get('regulation','')}\n✅ 整改：{it.get('correction','')}"
+
+    def set_summary_filter(**kw):
+        summary_state.update(kw)
+        render_summary()
         page.update()
 
-    def render_summary():
+    def summary_header():
+        lvl_f, cat_f = summary_state["level"], summary_state["category"]
+        stat_row = ft.Row(wrap=True, spacing=8)
+        for lvl in RISK_LEVELS:
+            n = issue_index.count(lvl)
+            if n:
+                st, active = RISK_STYLE[lvl], lvl_f == lvl
+                stat_row.controls.append(ft.Container(content=ft.Text(f"{st['icon']} {lvl[:4]} {n}个", size=12, color="white" if active else st['border'], weight="bold"), bgcolor=st['border'] if active else st['bg'], border=ft.border.all(1, st['border']), border_radius=8, padding=ft.padding.symmetric(horizontal=10, vertical=5),
+                                                      on_click=lambda e, l=lvl: set_summary_filter(level=None if summary_state["level"] == l else l)))
+        cat_drop = ft.Dropdown(options=[ft.dropdown.Option("全部类别")] + [ft.dropdown.Option(c, f"{c}（{n}）") for c, n in issue_index.categories().items()],
+                               value=cat_f or "全部类别", text_size=13, border_color=DS["border"],
+                               on_change=lambda e: set_summary_filter(category=None if e.control.value == "全部类别" else e.control.value))
+        title = f"共发现 {issue_index.count()} 个问题"
+        if lvl_f or cat_f: title += f"，筛选后 {issue_index.count(lvl_f, cat_f)} 个（点击等级标签筛选）"
+        return ft.Container(bgcolor=DS["surface"], border_radius=12, border=ft.border.all(1, DS["border"]), padding=14, content=ft.Column([ft.Text(title, size=16, weight="bold"), stat_row, cat_drop]))
+
+    def render_summary(keep_shown=False):
+        """从问题索引分页渲染；keep_shown 时重绘已加载的条数 (编辑/删除后)"""
+        limit = max(summary_state["shown"], SUMMARY_PAGE_SIZE) if keep_shown else SUMMARY_PAGE_SIZE
         summary_list.controls.clear()
-        all_issues = [i for t in tasks if t['status'] == 'done' and t.get('data') for i in [dict(item, _src=t['name']) for item in t['data']]]
-                    
-        if not all_issues:
+        summary_state["shown"] = 0
+        if not len(issue_index):
             summary_list.controls.append(ft.Container(bgcolor=DS["surface"], border_radius=14, border=ft.border.all(1, DS["border"]), padding=30, content=ft.Column([ft.Text("📊", size=52), ft.Text("暂无分析结果", size=17, weight="bold"), ft.Text("请先主页添加并分析", size=13, color=DS["text_secondary"])], horizontal_alignment="center")))
         else:
-            counts = {}
-            for iss in all_issues: counts[iss.get("risk_level","")] = counts.get(iss.get("risk_level",""),0)+1
-            stat_row = ft.Row(wrap=True, spacing=8)
-            for lvl in ["严重安全隐患","一般安全隐患","严重质量缺陷","一般质量缺陷"]:
-                if counts.get(lvl,0):
-                    st = RISK_STYLE[lvl]
-                    stat_row.controls.append(ft.Container(content=ft.Text(f"{st['icon']} {lvl[:4]} {counts[lvl]}个", size=12, color=st['border'], weight="bold"), bgcolor=st['bg'], border=ft.border.all(1, st['border']), border_radius=8, padding=ft.padding.symmetric(horizontal=10, vertical=5)))
-            
-            summary_list.controls.append(ft.Container(bgcolor=DS["surface"], border_radius=12, border=ft.border.all(1, DS["border"]), padding=14, content=ft.Column([ft.Text(f"共发现 {len(all_issues)} 个问题", size=16, weight="bold"), stat_row])))
-            
-            for i, issue in enumerate(sorted(all_issues, key=lambda x: RISK_STYLE.get(x.get("risk_level",""), RISK_STYLE["一般质量缺陷"])["priority"]), 1):
-                summary_list.controls.append(ft.Text(f"  📷 {issue.get('_src','')}", size=11, color=DS["text_hint"]))
-                e_cb = lambda it, it_ref=issue: show_edit_dialog(it_ref, render_summary)
-                d_cb = lambda it, it_ref=issue: show_delete_confirm(it_ref, lambda: [tk.__setitem__('data', [i for i in tk['data'] if i is not it_ref]) for tk in tasks if tk.get('data')] or render_summary())
-                c_cb = lambda it: copy_to_clipboard(f"【{it.get('risk_level','')}】\n{it.get('issue','')}\n\n📋 依据：{it.get('regulation','')}\n✅ 整改：{it.get('correction','')}")
-                det_cb = lambda it: show_detail_dialog(it)
-                summary_list.controls.append(build_risk_card(issue, i, e_cb, d_cb, c_cb, det_cb))
+            summary_list.controls.append(summary_header())
+            append_summary_page(limit)
+
+    def append_summary_page(limit=SUMMARY_PAGE_SIZE):
+        lvl_f, cat_f = summary_state["level"], summary_state["category"]
+        if summary_list.controls and getattr(summary_list.controls[-1], "data", None) == "more": summary_list.controls.pop()
+        for _, task, issue in issue_index.query(lvl_f, cat_f, offset=summary_state["shown"], limit=limit):
+            summary_state["shown"] += 1
+            summary_list.controls.append(ft.Text(f"  📷 {task['name']}", size=11, color=DS["text_hint"]))
+            e_cb = lambda it: show_edit_dialog(it, lambda: persist_issues(issue_index.update(it)) or render_summary(True))
+            d_cb = lambda it: show_delete_confirm(it, lambda: persist_issues(issue_index.delete(it)) or render_summary(True))
+            c_cb = lambda it: copy_to_clipboard(issue_text(it))
+            summary_list.controls.append(build_risk_card(issue, summary_state["shown"], e_cb, d_cb, c_cb, show_detail_dialog))
+        remaining = issue_index.count(lvl_f, cat_f) - summary_state["shown"]
+        if remaining > 0:
+            summary_list.controls.append(ft.TextButton(f"加载更多（剩余 {remaining} 个）", data="more", on_click=lambda e: append_summary_page() or page.update()))
+
+    # ---------------- 历史记录 (跨会话全文检索) ----------------
+    HISTORY_SINCE = {"全部时间": None, "今天": 0, "近7天": 7, "近30天": 30}
+
+    def history_since(label):
+        days = HISTORY_SINCE.get(label)
+        if days is None: return None
+        return datetime.combine(datetime.now().date(), datetime.min.time()).timestamp() - days * 86400
+
+    def set_history_filter(**kw):
+        history_state.update(kw)
+        render_history()
+        page.update()
+
+    def flush_history_search(keys):
+        if history_state["typed"] != history_state["query"]: set_history_filter(query=history_state["typed"])
+
+    history_search = UpdateCoalescer(flush_history_search, HISTORY_SEARCH_INTERVAL)
+
+    def type_history_query(value):
+        """输入中的检索词合并到帧间隔内再查询，回车立即查询"""
+        history_state["typed"] = value.strip()
+        history_search.request()
+
+    def render_history():
+        history_list.controls.clear()
+        history_state["shown"] = 0
+        append_history_page()
+
+    def append_history_page():
+        if history_list.controls and getattr(history_list.controls[-1], "data", None) == "more": history_list.controls.pop()
+        total, rows = archive().search(history_state["query"], level=history_state["level"], since=history_state["since"], limit=SUMMARY_PAGE_SIZE, offset=history_state["shown"])
+        history_state["total"] = total
+        history_count.value = f"共 {total} 条历史问题" if total else ("未找到匹配的问题" if history_state["query"] or history_state["level"] or history_state["since"] else "暂无历史记录，分析完成的照片会自动存入")
+        for row in rows:
+            history_state["shown"] += 1
+            st = RISK_STYLE.get(row["risk_level"], RISK_STYLE["一般质量缺陷"])
+            history_list.controls.append(ft.Container(
+                bgcolor=DS["surface"], border_radius=12, border=ft.border.only(left=ft.BorderSide(4, st["border"])), padding=10,
+                on_click=lambda e, it=row: show_detail_dialog(it),
+                content=ft.Row([
+                    ft.Image(src_base64=archive().thumb(row["photo_id"]) or None, width=56, height=56, fit=ft.ImageFit.COVER, border_radius=8),
+                    ft.Column([
+                        ft.Text(f"{st['icon']} {row['issue'] or ''}", size=14, weight="bold", max_lines=2, overflow=ft.TextOverflow.ELLIPSIS),
+                        ft.Text(f"📋 {row['regulation'] or '—'}", size=12, color=DS["text_secondary"], max_lines=1, overflow=ft.TextOverflow.ELLIPSIS),
+                        ft.Text(f"📷 {row['name']} · {datetime.fromtimestamp(row['analyzed_at']).strftime('%Y-%m-%d %H:%M')}", size=11, color=DS["text_hint"]),
+                    ], spacing=2, expand=True),
+                ], vertical_alignment=ft.CrossAxisAlignment.START)))
+        remaining = total - history_state["shown"]
+        if remaining > 0:
+            history_list.controls.append(ft.TextButton(f"加载更多（剩余 {remaining} 个）", data="more", on_click=lambda e: append_history_page() or page.update()))
+
+    def clear_history():
+        if not len(archive()): return show_toast("暂无历史记录", False)
+        dialog = ft.AlertDialog(title=ft.Text("清空历史"), content=ft.Text("确定删除全部历史检查记录吗？当前队列不受影响。"))
+        def conf(e):
+            archive().clear()
+            page.close(dialog)
+            set_history_filter()
+            show_toast("历史记录已清空")
+        dialog.actions = [ft.TextButton("取消", on_click=lambda e: page.close(dialog)), ft.ElevatedButton("确定", on_click=conf, bgcolor=DS["danger"], color="white")]
+        page.open(dialog)
 
     def render_detail(task):
         detail_list.controls.clear()
+        rep = find_task(task['dup_of']) if task.get('dup_of') else None
+        if rep is not None:
+            def detach(e):
+                detach_duplicate(task)
+                update_task_row(task_rows[task['id']])
+                render_detail(task)
+                page.update()
+            detail_list.controls.append(ft.Container(bgcolor=DS["info_light"], border_radius=12, padding=12, content=ft.Column([
+                ft.Text(f"🔗 与 {rep['name']} 近似（相差 {task.get('dup_dist', 0)}/64），共享其分析结果", size=13, weight="bold"),
+                ft.Row([ft.TextButton("查看代表照片", on_click=lambda e: open_detail(rep)), ft.TextButton("单独分析", on_click=detach)])])))
+            if rep['status'] != 'done':
+                detail_list.controls.append(ft.Text(f"等待 {rep['name']} 分析完成", size=13, color=DS["text_secondary"]))
+                return
+            locked = lambda it: show_toast("请在代表照片中编辑", False)
+            c_cb = lambda it: copy_to_clipboard(issue_text(it))
+            for i, item in enumerate(rep.get('data') or [], 1):
+                detail_list.controls.append(build_risk_card(item, i, locked, locked, c_cb, show_detail_dialog))
+            return
         if task['status'] == 'waiting': detail_list.controls.append(ft.Container(bgcolor=DS["surface"], border_radius=14, padding=30, content=ft.Column([ft.Text("⏳", size=48), ft.Text("等待分析", size=17, weight="bold", color=DS["text_hint"])], horizontal_alignment="center")))
-        elif task['status'] == 'analyzing': detail_list.controls.append(ft.Container(bgcolor=DS["surface"], border_radius=14, padding=30, content=ft.Column([ft.Text("🔄", size=48), ft.Text("正在分析...", size=17, weight="bold", color=DS["primary"]), ft.Text(task.get('progress_msg',''), size=13, color=DS["text_secondary"])], horizontal_alignment="center")))
+        elif task['status'] == 'analyzing':
+            detail_list.controls.append(ft.Container(bgcolor=DS["surface"], border_radius=14, padding=30, content=ft.Column([ft.Text("🔄", size=48), ft.Text("正在分析...", size=17, weight="bold", color=DS["primary"]), ft.Text(task.get('progress_msg',''), size=13, color=DS["text_secondary"])], horizontal_alignment="center")))
+            # 流式模式下已到达的问题先行展示，分析完成后才可编辑/删除
+            locked = lambda it: show_toast("分析完成后可编辑", False)
+            c_cb = lambda it: copy_to_clipboard(issue_text(it))
+            for i, item in enumerate(list(task.get('data') or []), 1):
+                detail_list.controls.append(build_risk_card(item, i, locked, locked, c_cb, show_detail_dialog))
         elif task['status'] == 'error': detail_list.controls.append(ft.Container(bgcolor=DS["surface"], border_radius=14, padding=30, content=ft.Column([ft.Text("❌", size=48), ft.Text("分析失败", size=17, weight="bold", color=DS["danger"]), ft.Text(task.get('error',''), size=13)], horizontal_alignment="center")))
         elif task['status'] == 'done':
             data = task.get('data') or []
+            if task.get('scene'): detail_list.controls.append(ft.Text(f"📍 {task['scene']}", size=13, color=DS["text_secondary"]))
             if not data: detail_list.controls.append(ft.Container(bgcolor=DS["surface"], border_radius=14, padding=30, content=ft.Column([ft.Text("✅", size=48), ft.Text("未发现问题", size=17, weight="bold", color=DS["success"])], horizontal_alignment="center")))
             else:
                 for i, item in enumerate(sorted(data, key=lambda x: RISK_STYLE.get(x.get("risk_level",""), RISK_STYLE["一般质量缺陷"])["priority"]), 1):
-                    e_cb = lambda it, it_ref=item: show_edit_dialog(it_ref, lambda: render_detail(task) or page.update())
-                    d_cb = lambda it, it_ref=item: show_delete_confirm(it_ref, lambda: task.__setitem__('data', [x for x in task['data'] if x is not it_ref]) or render_detail(task) or page.update())
-                    c_cb = lambda it: copy_to_clipboard(f"【{it.get('risk_level','')}】\n{it.get('issue','')}\n\n📋 依据：{it.get('regulation','')}\n✅ 整改：{it.get('correction','')}")
+                    e_cb = lambda it, it_ref=item: show_edit_dialog(it_ref, lambda: persist_issues(issue_index.update(it_ref)) or render_detail(task) or page.update())
+                    d_cb = lambda it, it_ref=item: show_delete_confirm(it_ref, lambda: persist_issues(issue_index.delete(it_ref)) or render_detail(task) or page.update())
+                    c_cb = lambda it: copy_to_clipboard(issue_text(it))
                     det_cb = lambda it: show_detail_dialog(it)
                     detail_list.controls.append(build_risk_card(item, i, e_cb, d_cb, c_cb, det_cb))
 
     def copy_all():
-        issues = [i for t in tasks if t['status'] == 'done' and t.get('data') for i in [dict(item, _src=t['name']) for item in t['data']]]
-        if not issues: return show_toast("暂无可复制的问题", False)
-        lines = ["🏗️ 质量安全检查问题清单", f"检查时间：{datetime.now().strftime('%Y-%m-%d %H:%M')}", f"发现问题：{len(issues)} 个", "=" * 40, ""]
-        for i, iss in enumerate(sorted(issues, key=lambda x: RISK_STYLE.get(x.get('risk_level', ''), {"priority":4})["priority"]), 1):
-            lines += [f"{i}. 【{iss.get('risk_level', '')}】", f"   来源：{iss.get('_src', '')}", f"   {iss.get('issue', '')}", f"   📋 依据：{iss.get('regulation', '')}", f"   ✅ 整改：{iss.get('correction', '')}", ""]
+        if not len(issue_index): return show_toast("暂无可复制的问题", False)
+        lines = ["🏗️ 质量安全检查问题清单", f"检查时间：{datetime.now().strftime('%Y-%m-%d %H:%M')}", f"发现问题：{len(issue_index)} 个", "=" * 40, ""]
+        for i, (_, task, iss) in enumerate(issue_index.query(), 1):
+            lines += [f"{i}. 【{iss.get('risk_level', '')}】", f"   来源：{task['name']}", f"   {iss.get('issue', '')}", f"   📋 依据：{iss.get('regulation', '')}", f"   ✅ 整改：{iss.get('correction', '')}", ""]
         copy_to_clipboard("\n".join(lines))
 
+    def export_all():
+        if not tasks: return show_toast("暂无可导出的图片", False)
+        dialog = ft.AlertDialog(title=ft.Text("导出报告"))
+        def run(fmt):
+            page.close(dialog)
+            snapshot = list(tasks)      # 只复制引用；报告逐张写入文件
+            path = os.path.join(EXPORT_DIR, datetime.now().strftime(f"检查报告_%Y%m%d_%H%M%S.{fmt}"))
+            def progress(i, total):
+                status_text.value = f"正在导出 {i}/{total or len(snapshot)}..."
+                page.update()
+            def work():
+                try:
+                    os.makedirs(EXPORT_DIR, exist_ok=True)
+                    n = export_report(path, snapshot, fmt, on_progress=progress)
+                    show_toast(f"已导出 {n} 个问题 → {os.path.abspath(path)}")
+                except OSError as err: show_toast(f"导出失败: {err}", False)
+            threading.Thread(target=work, daemon=True).start()
+        dialog.content = ft.Column([ft.TextButton(label, on_click=lambda e, f=fmt: run(f)) for fmt, label in EXPORT_FORMATS.items()], tight=True)
+        dialog.actions = [ft.TextButton("取消", on_click=lambda e: page.close(dialog))]
+        page.open(dialog)
+
     def clear_all():
         if not tasks: return
         dialog = ft.AlertDialog(title=ft.Text("确认清空"), content=ft.Text("确定要清空所有图片吗？"))
         def conf(e):
+            engine.cancel_pending()
+            batch["active"] = False
             tasks.clear()
+            issue_index.clear()
+            dup_index.clear()
+            IMAGE_CACHE.clear()
+            store.clear()
             count_text.value = "0/20"
             render_home()
             page.close(dialog)
@@ -505,6 +741,7 @@ def main(page: ft.Page):
         page.open(dialog)
 
     # ---------------- 视图容器 (SPA 切换) ----------------
+    start_btn = ft.ElevatedButton("▶ 开始分析", on_click=start_analysis, bgcolor=DS["primary"], color="white", expand=True)
     v_home = ft.Column([
         ft.Container(bgcolor=DS["primary"], height=56, padding=ft.padding.symmetric(horizontal=16), content=ft.Row([ft.Text("🏗️ 安全质检助手 V5.0", color="white", size=17, weight="bold", expand=True), count_text])),
         ft.Container(bgcolor=DS["surface"], padding=10, border=ft.border.only(bottom=ft.BorderSide(1, DS["border"])), content=ft.Row([ft.Text("检查场景", size=13), prompt_dropdown])),
@@ -512,60 +749,122 @@ def main(page: ft.Page):
         ft.Container(bgcolor=DS["surface"], height=68, padding=10, border=ft.border.only(top=ft.BorderSide(1, DS["border"])), content=ft.Row([
             ft.ElevatedButton("🗑 清空", on_click=lambda e: clear_all(), bgcolor=DS["surface2"], color=DS["text_secondary"]),
             ft.ElevatedButton("📋 复制全部", on_click=lambda e: copy_all(), bgcolor=DS["success_light"], color=DS["success"]),
-            ft.ElevatedButton("▶ 开始分析", on_click=start_analysis, bgcolor=DS["primary"], color="white", expand=True)
+            start_btn
         ])),
         ft.Container(content=status_text, padding=ft.padding.only(left=14, bottom=4))
     ], expand=True, spacing=0)
     
-    v_summary = ft.Column([
-        ft.Container(bgcolor=DS["primary"], height=56, padding=16, content=ft.Text("📊 问题汇总", color="white", size=17, weight="bold")),
-        ft.Container(content=summary_list, expand=True),
-        ft.Container(bgcolor=DS["surface"], height=68, padding=10, border=ft.border.only(top=ft.BorderSide(1, DS["border"])), content=ft.Row([
-            ft.ElevatedButton("📋 复制全部问题", on_click=lambda e: copy_all(), bgcolor=DS["primary"], color="white", expand=True)
-        ]))
-    ], expand=True, spacing=0, visible=False)
-    
-    v_detail = ft.Column([
-        ft.Container(bgcolor=DS["primary"], height=56, padding=ft.padding.symmetric(horizontal=10), content=ft.Row([
-            ft.IconButton(ft.icons.ARROW_BACK_IOS_NEW, icon_color="white", on_click=lambda e: close_detail()), detail_title_text
-        ])), detail_image, ft.Container(content=detail_list, expand=True)
-    ], expand=True, spacing=0, visible=False)
-    
-    main_stack = ft.Stack([v_home, v_summary, v_detail], expand=True)
+    # 汇总页/详情页首次进入时才构建并挂到页面上，首帧只渲染主页
+    def build_summary_view():
+        return ft.Column([
+            ft.Container(bgcolor=DS["primary"], height=56, padding=16, content=ft.Text("📊 问题汇总", color="white", size=17, weight="bold")),
+            ft.Container(content=summary_list, expand=True),
+            ft.Container(bgcolor=DS["surface"], height=68, padding=10, border=ft.border.only(top=ft.BorderSide(1, DS["border"])), content=ft.Row([
+                ft.ElevatedButton("📤 导出报告", on_click=lambda e: export_all(), bgcolor=DS["success_light"], color=DS["success"]),
+                ft.ElevatedButton("📋 复制全部问题", on_click=lambda e: copy_all(), bgcolor=DS["primary"], color="white", expand=True)
+            ]))
+        ], expand=True, spacing=0, visible=False)
+
+    history_count = ft.Text("", size=12, color=DS["text_secondary"])
+
+    def build_history_view():
+        search = ft.TextField(hint_text="搜索问题、规范、整改措施（空格分隔多个词）", prefix_icon=ft.icons.SEARCH, text_size=13, border_color=DS["border"], dense=True, expand=True,
+                              on_submit=lambda e: set_history_filter(query=e.control.value.strip()),
+                              on_change=lambda e: type_history_query(e.control.value))
+        since_drop = ft.Dropdown(options=[ft.dropdown.Option(k) for k in HISTORY_SINCE], value="全部时间", text_size=13, border_color=DS["border"], dense=True, width=110,
+                                 on_change=lambda e: set_history_filter(since=history_since(e.control.value)))
+        level_drop = ft.Dropdown(options=[ft.dropdown.Option("全部等级")] + [ft.dropdown.Option(l) for l in RISK_LEVELS], value="全部等级", text_size=13, border_color=DS["border"], dense=True, expand=True,
+                                 on_change=lambda e: set_history_filter(level=None if e.control.value == "全部等级" else e.control.value))
+        return ft.Column([
+            ft.Container(bgcolor=DS["primary"], height=56, padding=ft.padding.symmetric(horizontal=16), content=ft.Row([
+                ft.Text("🕘 历史记录", color="white", size=17, weight="bold", expand=True),
+                ft.IconButton(ft.icons.DELETE_SWEEP, icon_color="white", tooltip="清空历史", on_click=lambda e: clear_history())])),
+            ft.Container(bgcolor=DS["surface"], padding=10, border=ft.border.only(bottom=ft.BorderSide(1, DS["border"])), content=ft.Column([
+                ft.Row([search]), ft.Row([since_drop, level_drop]), history_count], spacing=6)),
+            ft.Container(content=history_list, expand=True)
+        ], expand=True, spacing=0, visible=False)
+
+    def build_detail_view():
+        return ft.Column([
+            ft.Container(bgcolor=DS["primary"], height=56, padding=ft.padding.symmetric(horizontal=10), content=ft.Row([
+                ft.IconButton(ft.icons.ARROW_BACK_IOS_NEW, icon_color="white", on_click=lambda e: close_detail()), detail_title_text
+            ])), detail_image, ft.Container(content=detail_list, expand=True)
+        ], expand=True, spacing=0, visible=False)
+
+    main_stack = ft.Stack([v_home], expand=True)
+    views = {"home": v_home}
+    VIEW_BUILDERS = {"summary": build_summary_view, "history": build_history_view, "detail": build_detail_view}
+
+    def show_view(name):
+        if name not in views:
+            views[name] = VIEW_BUILDERS[name]()
+            main_stack.controls.append(views[name])
+        for n, v in views.items(): v.visible = n == name
+        return views[name]
 
     def on_nav(e):
         nonlocal current_tab
         idx = e.control.selected_index
         if idx == 0:
-            current_tab = 0; v_home.visible = True; v_summary.visible = False; v_detail.visible = False; page.update()
+            current_tab = 0; show_view("home")
+            for entry in task_rows.values(): update_task_row(entry)  # 汇总页删改后同步问题数
+            page.update()
         elif idx == 1:
-            current_tab = 1; render_summary(); v_home.visible = False; v_summary.visible = True; v_detail.visible = False; page.update()
-        elif idx == 2: file_picker.pick_files(allow_multiple=True, file_type=ft.FilePickerFileType.IMAGE)
-        elif idx == 3: open_settings()
+            current_tab = 1; render_summary(); show_view("summary"); page.update()
+        elif idx == 2:
+            current_tab = 2; show_view("history"); render_history(); page.update()
+        elif idx == 3: file_picker.pick_files(allow_multiple=True, file_type=ft.FilePickerFileType.IMAGE)
+        elif idx == 4: open_settings()
 
     page.navigation_bar = ft.NavigationBar(
         selected_index=0, bgcolor=DS["surface"],
-        destinations=[ft.NavigationDestination(icon=ft.icons.HOME, label="主页"), ft.NavigationDestination(icon=ft.icons.BAR_CHART, label="汇总"), ft.NavigationDestination(icon=ft.icons.ADD_PHOTO_ALTERNATE, label="添加"), ft.NavigationDestination(icon=ft.icons.SETTINGS, label="设置")],
+        destinations=[ft.NavigationDestination(icon=ft.icons.HOME, label="主页"), ft.NavigationDestination(icon=ft.icons.BAR_CHART, label="汇总"), ft.NavigationDestination(icon=ft.icons.HISTORY, label="历史"), ft.NavigationDestination(icon=ft.icons.ADD_PHOTO_ALTERNATE, label="添加"), ft.NavigationDestination(icon=ft.icons.SETTINGS, label="设置")],
         on_change=on_nav
     )
 
     def open_detail(task):
-        v_detail.current_task = task
         detail_title_text.value = f"  {task['name']}"
-        detail_image.src_base64 = get_b64(task['path'])
+        detail_image.src_base64 = IMAGE_CACHE.preview(task['path'])
         detail_image.visible = True
         render_detail(task)
-        v_home.visible = False; v_summary.visible = False; v_detail.visible = True
+        show_view("detail").current_task = task
         page.update()
         
     def close_detail():
-        v_detail.visible = False
-        if current_tab == 0: v_home.visible = True
-        elif current_tab == 1: v_summary.visible = True
+        v_detail = views["detail"]
+        if v_detail.current_task['id'] in task_rows: update_task_row(task_rows[v_detail.current_task['id']])
+        show_view("summary" if current_tab == 1 else "home")
         page.update()
 
+    for t in tasks:
+        issue_index.set_task(t)
+        if t.get('phash') is not None and not t.get('dup_of'): dup_index.add(t['phash'], t['id'])
+    count_text.value = f"{len(tasks)}/20"
+    render_home(update=False)
     page.add(ft.Container(content=main_stack, expand=True))
-    render_home()
+    STARTUP.setdefault("first_paint", time.perf_counter() - T_LAUNCH)   # 多会话 (Web) 时只记首个会话
+
+    def restore_thumbs():
+        t = time.perf_counter()
+        load_thumbs(list(task_rows.values()))
+        STARTUP.setdefault("thumbs", time.perf_counter() - t)
+    if task_rows: threading.Thread(target=restore_thumbs, daemon=True).start()
+
+    config_ready.wait()
+    if config.get("last_prompt") in DEFAULT_PROMPTS: prompt_dropdown.value = config["last_prompt"]
+    engine.scheduler.workers = config.get("max_workers", MAX_WORKERS)
+    # 上次被中断的任务：已完成的角色结果保存在会话库中，只补做剩余调用
+    interrupted = [t for t in tasks if t.pop('interrupted', False)]
+    if interrupted and config.get("api_key"):
+        submit_batch(interrupted)
+        show_toast(f"已恢复上次会话，继续分析 {len(interrupted)} 张")
+    else: page.update()
+    # 首帧之后在后台预先导入模型客户端 (openai/httpx)，首次分析时无需再等待
+    threading.Thread(target=warm_client, daemon=True).start()
+
+def describe_startup():
+    labels = (("import", "导入"), ("session", "会话"), ("config", "配置"), ("first_paint", "首帧"), ("thumbs", "首帧后缩略图"))
+    return "启动耗时：" + "，".join(f"{label} {STARTUP[k] * 1000:.0f}ms" for k, label in labels if k in STARTUP)
 
 if __name__ == "__main__":
     ft.app(main)